@@ -0,0 +1 @@
+# Copyright 2015 jydo inc. All rights reserved.
@@ -0,0 +1,84 @@
+# Copyright 2015 jydo inc. All rights reserved.
+"""
+Microbenchmarks for the checksum presets across message sizes.
+
+Every case checksums a number of messages. With distinct messages every one is seen for the first time, the cost of
+checking what clients send. With repeated messages the same one is checked over and over, the cost of polls and
+constant responses, which CRCs computed in Python answer from their cache.
+
+Example:
+    python -m bench.checksum_bench --output checksum_results.json
+"""
+import argparse
+import time
+
+from imitar import checksum
+
+from .results import write_results
+
+CHECKSUMS = ['SUM8', 'XOR8', 'CRC8', 'CRC8_MAXIM', 'CRC16_XMODEM', 'CRC16_CCITT_FALSE', 'CRC16_ARC', 'CRC16_MODBUS',
+             'CRC32']
+
+
+def messages(size, count, distinct):
+    if not distinct:
+        return [b'x' * size] * count
+
+    # The index makes every message different, the CRC caches never hit.
+    return [i.to_bytes(4, 'big') + b'x' * max(size - 4, 0) for i in range(count)]
+
+
+def run_case(name, size, count, distinct, repeat):
+    """
+    Checksums count messages with a fresh copy of the preset and returns the best time of repeat runs.
+    """
+    best = None
+
+    for _ in range(repeat):
+        preset = getattr(checksum, name)
+
+        if isinstance(preset, checksum.Crc):
+            # Start every run with an empty cache.
+            preset = checksum.Crc(preset.bits, preset.poly, preset.init, preset.reflect, preset.xor_out)
+
+        batch = messages(size, count, distinct)
+        start = time.perf_counter()
+
+        for message in batch:
+            preset.compute(message)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the checksums.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[8, 64, 1024], help='Message sizes in bytes')
+    parser.add_argument('--count', type=int, default=1000, help='Messages per case')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per case, the best one is reported')
+    parser.add_argument('--checksums', nargs='+', default=CHECKSUMS, help='Only run these presets')
+    parser.add_argument('--output', default=None, help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    results = []
+
+    for name in args.checksums:
+        for size in args.sizes:
+            for distinct in (True, False):
+                elapsed = run_case(name, size, args.count, distinct, args.repeat)
+                results.append({
+                    'checksum': name,
+                    'message_size': size,
+                    'distinct': distinct,
+                    'messages': args.count,
+                    'seconds': elapsed,
+                    'microseconds_per_message': elapsed / args.count * 1e6,
+                    'megabytes_per_second': size * args.count / elapsed / 1e6 if elapsed else None,
+                })
+
+    write_results('checksum', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
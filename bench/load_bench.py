@@ -0,0 +1,173 @@
+# Copyright 2015 jydo inc. All rights reserved.
+"""
+End to end load generator. Opens N concurrent clients against an emulator, each client sends a query and waits for its
+response as fast as it can, while one extra client changes state at a fixed interval so every other client receives a
+broadcast. Reports requests per second along with round trip and broadcast latency percentiles.
+
+By default the emulator runs in this process on a free port, pass --host and --port to drive an emulator running
+elsewhere (this keeps the load generator from competing with the emulator for the GIL).
+
+Example:
+    python -m bench.load_bench fake_tv --clients 100 --duration 10 --output load_results.json
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from logging import WARNING
+
+from imitar.async_tcp_server import AsyncTcpServer
+from imitar.client import AsyncClient
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.tcp_server import TcpServer
+
+from .results import summarize_latencies, write_results
+
+
+class Scenario:
+    """
+    Describes how to load an emulator: the query every client polls with, how to tell a query response from a
+    broadcast, and the commands that trigger broadcasts.
+    """
+    def __init__(self, emulator_class, query, broadcast_prefix, broadcast_values, broadcast_command, broadcast_message):
+        self.emulator_class = emulator_class
+        self.query = query
+        self.broadcast_prefix = broadcast_prefix
+        self.broadcast_values = broadcast_values
+        self.broadcast_command = broadcast_command
+        self.broadcast_message = broadcast_message
+
+
+SCENARIOS = {
+    'fake_tv': Scenario(FakeTvEmulator, 'POWR ?', 'VOLM ', range(0, 101), 'VOLM {}', 'VOLM {}'),
+    'extron_mps_601': Scenario(ExtronMps601Emulator, '0LS', 'In', range(1, 7), '{}!', 'In{} All'),
+}
+TRANSPORTS = {'tcp': TcpServer, 'async': AsyncTcpServer}
+
+
+class LoadClient:
+    def __init__(self, scenario, client, broadcast_sent):
+        self.scenario = scenario
+        self.client = client
+        self.broadcast_sent = broadcast_sent
+        self.round_trips = []
+        self.broadcast_latencies = []
+        client.subscribe(self.on_broadcast, scenario.broadcast_prefix)
+
+    def on_broadcast(self, message):
+        sent = self.broadcast_sent.get(message)
+
+        if sent is not None:
+            self.broadcast_latencies.append(time.perf_counter() - sent)
+
+    async def query_loop(self, deadline):
+        while time.perf_counter() < deadline:
+            sent = time.perf_counter()
+            await self.client.request(self.scenario.query)
+            self.round_trips.append(time.perf_counter() - sent)
+
+
+async def open_client(scenario, host, port, broadcast_sent, welcome):
+    client = AsyncClient(host, port, welcome=welcome,
+                         is_broadcast=lambda message: message.startswith(scenario.broadcast_prefix))
+
+    return LoadClient(scenario, await client.connect(), broadcast_sent)
+
+
+async def broadcast_loop(scenario, host, port, deadline, interval, broadcast_sent, welcome):
+    """
+    Changes state at a fixed interval from a dedicated client. broadcast_sent maps the expected broadcast message to
+    when the change was requested, values cycle so the interval times the number of values has to be longer than the
+    worst broadcast latency for the mapping to stay unambiguous.
+    """
+    # Responses to the changes aren't waited for, they go to the client's (absent) subscribers.
+    client = await AsyncClient(host, port, welcome=welcome, is_broadcast=lambda message: True).connect()
+    count = 0
+
+    for value in itertools.cycle(scenario.broadcast_values):
+        if time.perf_counter() >= deadline:
+            break
+
+        broadcast_sent[scenario.broadcast_message.format(value)] = time.perf_counter()
+        client.send(scenario.broadcast_command.format(value))
+        count += 1
+        await asyncio.sleep(interval)
+
+    await client.close()
+
+    return count
+
+
+async def run_load(scenario, host, port, clients, duration, broadcast_interval, welcome):
+    broadcast_sent = {}
+    # Connect one at a time, the point is to measure steady state load rather than how the emulator copes with a
+    # connection storm.
+    load_clients = [await open_client(scenario, host, port, broadcast_sent, welcome) for _ in range(clients)]
+    start = time.perf_counter()
+    deadline = start + duration
+    tasks = [client.query_loop(deadline) for client in load_clients]
+
+    if broadcast_interval > 0:
+        tasks.append(broadcast_loop(scenario, host, port, deadline, broadcast_interval, broadcast_sent, welcome))
+
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    # Give the last broadcasts a moment to arrive.
+    await asyncio.sleep(0.1)
+
+    await asyncio.gather(*[client.client.close() for client in load_clients])
+
+    round_trips = [rtt for client in load_clients for rtt in client.round_trips]
+    broadcast_latencies = [latency for client in load_clients for latency in client.broadcast_latencies]
+
+    return {
+        'clients': clients,
+        'seconds': elapsed,
+        'requests': len(round_trips),
+        'requests_per_second': len(round_trips) / elapsed,
+        'round_trip': summarize_latencies(round_trips),
+        'broadcasts_sent': results[-1] if broadcast_interval > 0 else 0,
+        'broadcast': summarize_latencies(broadcast_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test an emulator with many concurrent clients.')
+    parser.add_argument('emulator', choices=sorted(SCENARIOS), help='The emulator to load')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 100], help='Concurrent client counts to run')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds to run each client count for')
+    parser.add_argument('--broadcast-interval', type=float, default=0.05,
+                        help='Seconds between state changes that trigger broadcasts, 0 disables broadcasts')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='tcp',
+                        help='The transport for the in process emulator')
+    parser.add_argument('--host', default='127.0.0.1', help='Host of an already running emulator')
+    parser.add_argument('--port', type=int, default=None, help='Port of an already running emulator')
+    parser.add_argument('--output', default=None, help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    scenario = SCENARIOS[args.emulator]
+    emulator = None
+    port = args.port
+
+    if port is None:
+        emulator = scenario.emulator_class(0, transport_class=TRANSPORTS[args.transport])
+        emulator.logger.setLevel(WARNING)
+        emulator.transport.start()
+        port = emulator.transport.port
+
+    welcome = scenario.emulator_class.welcome_message is not None
+    results = []
+
+    try:
+        for clients in args.clients:
+            results.append(asyncio.run(run_load(scenario, args.host, port, clients, args.duration,
+                                                args.broadcast_interval, welcome)))
+    finally:
+        if emulator is not None:
+            emulator.transport.shutdown()
+
+    write_results('load', dict(vars(args), emulator=args.emulator), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright 2015 jydo inc. All rights reserved.
+"""
+Microbenchmarks for every MessageParser across message sizes, burst sizes, and fragmentation patterns.
+
+A burst is a number of messages arriving back to back. The fragment size is how many bytes each simulated recv
+delivers, 0 means the whole burst arrives in a single recv.
+
+Example:
+    python -m bench.parser_bench --output parser_results.json
+"""
+import argparse
+import time
+
+from imitar.message_parser import CharacterMessageParser, FixedLengthMessageParser, VariableLengthMessageParser, \
+    CursorCharacterMessageParser, CursorFixedLengthMessageParser, CursorVariableLengthMessageParser
+
+from .results import write_results
+
+HEADER = b'\xaa'
+DELIMITER = b'\r\n'
+
+
+def character_stream(size, burst):
+    return (b'x' * size + DELIMITER) * burst
+
+
+def variable_length_stream(size, burst):
+    # The length is a single byte, so the payload can't be larger than 255 bytes.
+    size = min(size, 255)
+    return (HEADER + bytes([size]) + b'x' * size) * burst
+
+
+def fixed_length_stream(size, burst):
+    return (HEADER + b'x' * (size - 1)) * burst
+
+
+PARSERS = [
+    ('CharacterMessageParser', lambda size: CharacterMessageParser(DELIMITER), character_stream),
+    ('CursorCharacterMessageParser', lambda size: CursorCharacterMessageParser(DELIMITER), character_stream),
+    ('VariableLengthMessageParser', lambda size: VariableLengthMessageParser(HEADER), variable_length_stream),
+    ('CursorVariableLengthMessageParser', lambda size: CursorVariableLengthMessageParser(HEADER),
+     variable_length_stream),
+    ('FixedLengthMessageParser', lambda size: FixedLengthMessageParser(HEADER, size), fixed_length_stream),
+    ('CursorFixedLengthMessageParser', lambda size: CursorFixedLengthMessageParser(HEADER, size), fixed_length_stream),
+]
+
+
+def fragment(stream, fragment_size):
+    if fragment_size == 0:
+        return [stream]
+
+    return [stream[i:i + fragment_size] for i in range(0, len(stream), fragment_size)]
+
+
+def run_case(make_parser, make_stream, size, burst, fragment_size, repeat):
+    """
+    Feeds a burst through a parser the same way a transport does and returns the best time of repeat runs.
+    """
+    parser = make_parser(size)
+    chunks = fragment(make_stream(size, burst), fragment_size)
+    best = None
+    count = 0
+
+    for _ in range(repeat):
+        buffer = parser.new_buffer()
+        count = 0
+        start = time.perf_counter()
+
+        for chunk in chunks:
+            buffer.extend(chunk)
+            messages, buffer = parser.process_buffer(buffer)
+            count += len(messages)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the message parsers.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[16, 256, 4096], help='Message sizes in bytes')
+    parser.add_argument('--bursts', type=int, nargs='+', default=[1, 32, 512], help='Messages per burst')
+    parser.add_argument('--fragments', type=int, nargs='+', default=[0, 4096, 64],
+                        help='Bytes delivered per recv, 0 delivers the whole burst at once')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per case, the best one is reported')
+    parser.add_argument('--parsers', nargs='+', default=None, help='Only run these parser classes')
+    parser.add_argument('--output', default=None, help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    results = []
+
+    for name, make_parser, make_stream in PARSERS:
+        if args.parsers is not None and name not in args.parsers:
+            continue
+
+        for size in args.sizes:
+            for burst in args.bursts:
+                for fragment_size in args.fragments:
+                    elapsed, count = run_case(make_parser, make_stream, size, burst, fragment_size, args.repeat)
+                    stream_length = len(make_stream(size, burst))
+                    results.append({
+                        'parser': name,
+                        'message_size': size,
+                        'burst': burst,
+                        'fragment_size': fragment_size,
+                        'messages': count,
+                        'seconds': elapsed,
+                        'messages_per_second': count / elapsed if elapsed else None,
+                        'megabytes_per_second': stream_length / elapsed / 1e6 if elapsed else None,
+                    })
+
+    write_results('parser', vars(args), results, args.output)
+
+
+if __name__ == '__main__':
+    main()
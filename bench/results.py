@@ -0,0 +1,59 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import datetime
+import json
+import platform
+import sys
+
+import imitar
+
+
+def percentile(samples, pct):
+    """
+    Returns the nearest-rank percentile of samples, samples must already be sorted.
+    """
+    if not samples:
+        return None
+
+    index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples) + 0.5)) - 1))
+
+    return samples[index]
+
+
+def summarize_latencies(samples):
+    """
+    Summarizes latency samples (in seconds) as milliseconds.
+    """
+    samples = sorted(samples)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 4)
+
+    return {
+        'count': len(samples),
+        'p50_ms': ms(percentile(samples, 50)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'p999_ms': ms(percentile(samples, 99.9)),
+        'max_ms': ms(samples[-1] if samples else None),
+    }
+
+
+def write_results(suite, params, results, output=None):
+    """
+    Writes benchmark results as JSON so they can be compared between releases. Writes to stdout if output is None.
+    """
+    document = {
+        'suite': suite,
+        'imitar_version': imitar.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat(),
+        'params': params,
+        'results': results,
+    }
+
+    if output is None:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(output, 'w') as f:
+            json.dump(document, f, indent=2)
@@ -0,0 +1,477 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+from logging import DEBUG, INFO
+
+from .frames import encode_delimiter, encode_message
+from .inbound import InboundLimiter, DISCONNECT, DROP, PAUSE, new_inbound_stats
+from .log import get_logger
+from .metrics import new_transport_stats
+from .outbound import OutboundQueue, DROP_OLDEST, BLOCK, new_outbound_stats
+from .recording import RECEIVED, SENT
+from .scheduler import default_scheduler
+from .session import Session, expired_sessions
+from .tcp_server import create_listening_socket
+
+logger = get_logger('async_tcp_server')
+
+
+class ClientProtocol(asyncio.Protocol, Session):
+    """
+    Per connection state for the AsyncTcpServer. This fills the same role as ClientWorker does for the TcpServer, but
+    it is driven by the event loop instead of owning a thread.
+
+    Data is handed straight to the asyncio transport until its write buffer passes the server's outbound_limit and it
+    asks us to pause, after that messages wait in a bounded OutboundQueue until the transport resumes.
+
+    Protocols are the Sessions passed to handle_message.
+    """
+    __slots__ = ('server', 'message_queue', 'limiter', 'transport', 'paused', 'reading', 'rate_paused', 'corked',
+                 'recorder', 'connection_id')
+
+    def __init__(self, server):
+        Session.__init__(self, None, server.message_parser.new_buffer(), server.scheduler.time())
+        self.server = server
+        self.message_queue = OutboundQueue(server.outbound_limit, server.overflow_policy, server.outbound_stats)
+        self.limiter = server.new_inbound_limiter()
+        self.transport = None
+        self.paused = False
+        self.reading = True
+        self.rate_paused = False
+        self.corked = None
+        self.recorder = server.recorder
+        self.connection_id = None
+
+    def connection_made(self, transport):
+        self.address = transport.get_extra_info('peername')
+
+        if self.server.max_connections is not None and len(self.server.clients) >= self.server.max_connections:
+            logger.debug('Rejecting connection from %s, max_connections reached', self.address)
+            self.server.stats['connections_rejected'] += 1
+            transport.abort()
+            return
+
+        self.transport = transport
+
+        if self.recorder is not None:
+            self.connection_id = self.recorder.open()
+
+        self.server.clients.add(self)
+        self.server.stats['connections_accepted'] += 1
+        transport.set_write_buffer_limits(high=self.server.outbound_limit)
+        # asyncio only disables Nagle for sockets created with an explicit IPPROTO_TCP, ours aren't.
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.debug('Accepting connection from %s', self.address)
+
+        if self.server.welcome_frame is not None:
+            self.send_data(self.server.welcome_frame)
+
+    def connection_lost(self, exc):
+        if self.transport is None:
+            # Rejected in connection_made.
+            return
+
+        logger.debug('%s disconnected, cleaning up.', self.address)
+        self.server.stats['connections_closed'] += 1
+        self.server.clients.discard(self)
+        self.transport = None
+        self.buffer = self.server.message_parser.new_buffer()
+        self.message_queue.clear()
+
+        if self.recorder is not None:
+            self.recorder.close_connection(self.connection_id)
+
+    def pause_writing(self):
+        self.paused = True
+        self.stalled_since = self.server.scheduler.time()
+
+    def resume_writing(self):
+        self.paused = False
+        self.stalled_since = None
+
+        while self.message_queue and not self.paused and self.transport is not None:
+            data = self.message_queue.peek()
+            self.message_queue.consume(len(data))
+            self.write(data)
+
+        if not self.reading and not self.message_queue.full and self.transport is not None:
+            self.reading = True
+
+            if not self.rate_paused:
+                self.transport.resume_reading()
+
+    def resume_reading(self):
+        self.rate_paused = False
+
+        if self.reading and self.transport is not None:
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.last_active = self.server.scheduler.time()
+
+        if self.recorder is not None:
+            self.recorder.record(self.connection_id, RECEIVED, data)
+
+        self.buffer.extend(data)
+        messages, self.buffer = self.server.message_parser.process_buffer(self.buffer)
+        stats = self.server.stats
+        stats['bytes_in'] += len(data)
+        stats['messages_parsed'] += len(messages)
+        overflow = self.limiter.check_buffer(self.buffer)
+
+        if overflow == DISCONNECT:
+            logger.debug('%s sent too much data without a complete message, disconnecting.', self.address)
+            self.transport.abort()
+            return
+        elif overflow == DROP:
+            self.buffer = self.server.message_parser.new_buffer()
+
+        messages, action = self.limiter.admit(messages)
+        # Hold the responses to everything in this read back and hand them to the transport together, so they go out in
+        # one vectored write instead of one send per response.
+        self.corked = []
+
+        try:
+            if self.server.handle_messages is not None:
+                messages = [message for message in messages if message != b'']
+                responses = ()
+
+                # Nothing complete was read, or the rate limit dropped all of it.
+                if messages:
+                    try:
+                        responses = self.server.handle_messages(messages, self)
+                    except Exception as e:
+                        logger.exception('Error during handle_messages: %s', e)
+
+                for response in responses:
+                    self.send_response(response)
+            else:
+                for message in messages:
+                    if message != b'':
+                        try:
+                            response = self.server.handle_message(message, self)
+                        except Exception as e:
+                            logger.exception('Error during handle_message: %s', e)
+                            continue
+
+                        self.send_response(response)
+        finally:
+            corked, self.corked = self.corked, None
+
+            if corked and self.transport is not None and not self.transport.is_closing():
+                self.transport.writelines(corked)
+
+        if action == DISCONNECT and self.transport is not None:
+            logger.debug('%s exceeded the rate limit, disconnecting.', self.address)
+            self.transport.close()
+        elif action == PAUSE and self.transport is not None:
+            # Stop reading until the client is back within the rate limit.
+            self.rate_paused = True
+            self.transport.pause_reading()
+            self.server.scheduler.call_later(self.limiter.resume_delay(), self.resume_reading,
+                                             executor=self.server.call_in_loop, owner=self)
+
+    def send_response(self, response):
+        """
+        Sends a value returned by handle_message to the client, and to every other client if it should be broadcast.
+        """
+        broadcast = True
+
+        if type(response) == tuple:
+            response, broadcast = response
+
+        if response is None:
+            return
+
+        # Encode once, the same frame is sent to this client and every client the response is broadcast to.
+        data = self.server.encode_message(response)
+        self.send_data(data)
+
+        if broadcast:
+            self.server.broadcast_message(data, self)
+
+    def write(self, data):
+        self.server.stats['bytes_out'] += len(data)
+
+        if self.recorder is not None:
+            # Recorded as it is handed to the transport rather than queued, data drop-oldest discards was never sent.
+            self.recorder.record(self.connection_id, SENT, data)
+
+        if self.corked is not None:
+            self.corked.append(data)
+        else:
+            self.transport.write(data)
+
+    def send_data(self, data):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        if not self.paused and not self.message_queue:
+            self.write(data)
+            return
+
+        if not self.message_queue.put(data):
+            logger.debug('Outbound buffer for %s overflowed, disconnecting.', self.address)
+            self.transport.abort()
+            return
+
+        if self.message_queue.policy == BLOCK and self.message_queue.full and self.reading:
+            # Stop reading requests from this client until it catches up on what we've already sent it.
+            self.server.outbound_stats['blocked'] += 1
+            self.reading = False
+            self.transport.pause_reading()
+
+    def send_message(self, message):
+        self.send_data(self.server.encode_message(message))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncTcpServer:
+    """
+    An asyncio based alternative to the TcpServer. Every client is served by a ClientProtocol on a single event loop,
+    so there is no limit on the number of concurrent clients. The handle_message and MessageParser contracts are the
+    same as the TcpServer, so an Emulator can use either transport.
+
+    If no loop is given the server runs its own event loop in a background thread, otherwise it is started on the
+    given loop and the caller is responsible for running it.
+    """
+    def __init__(self, port, handle_message, message_parser, encoding='ascii', delimiter='\r\n', welcome_message=None,
+                 debug=False, loop=None, outbound_limit=65536, overflow_policy=DROP_OLDEST, reuse_port=False,
+                 handle_messages=None, recorder=None, buffer_limit=65536, buffer_policy=DROP, rate_limit=None,
+                 rate_burst=None, rate_policy=PAUSE, scheduler=None, backlog=128, max_connections=None,
+                 idle_timeout=None, broadcast_limit=10000):
+        """
+        :param outbound_limit: The most bytes that may be waiting to be sent to a single client, in addition to what the
+        asyncio transport buffers. Optional, defaults to 64KiB.
+        :param overflow_policy: What to do when a client's outbound buffer is full, one of drop-oldest, disconnect, or
+        block. See OutboundQueue for details. Optional, defaults to drop-oldest.
+        :param reuse_port: Listen with SO_REUSEPORT so several processes can share the port. Optional, defaults to
+        False.
+        :param handle_messages: If set, called with every message parsed from a single read and the session instead of
+        calling handle_message for each one, see TcpServer. Optional.
+        :param recorder: A Recorder that records everything clients send and are sent, see imitar.recording. Optional.
+        :param buffer_limit: The most bytes a client may send without completing a message, see TcpServer for this and
+        the other inbound limits. Optional, defaults to 64KiB.
+        :param buffer_policy: drop or disconnect. Optional, defaults to drop.
+        :param rate_limit: The most messages per second a client may send. Optional, defaults to no limit.
+        :param rate_burst: The most messages a client may send at once. Optional, defaults to rate_limit.
+        :param rate_policy: drop, disconnect, or pause. Optional, defaults to pause.
+        :param scheduler: The Scheduler used to resume reading from paused clients and to reap connections. Optional,
+        defaults to the shared real time scheduler.
+        :param backlog: How many connections the OS may queue before they are accepted, asyncio accepts every pending
+        connection when the socket is readable. Optional, defaults to 128.
+        :param max_connections: The most clients connected at once, see TcpServer. Optional, defaults to no limit.
+        :param idle_timeout: Close idle and half-open clients after this many seconds, see TcpServer. Optional, defaults
+        to never.
+        :param broadcast_limit: The most broadcasts from other threads that may wait for the loop, the oldest are
+        dropped past it. Optional, defaults to 10000.
+        """
+        self.port = port
+        self.handle_message = handle_message
+        self.handle_messages = handle_messages
+        self.recorder = recorder
+        self.message_parser = message_parser
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.welcome_message = welcome_message
+        self.debug = debug
+        self.loop = loop
+        self.outbound_limit = outbound_limit
+        self.overflow_policy = overflow_policy
+        self.reuse_port = reuse_port
+        self.buffer_limit = buffer_limit
+        self.buffer_policy = buffer_policy
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.rate_policy = rate_policy
+        self.scheduler = scheduler or default_scheduler()
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.broadcast_limit = broadcast_limit
+        # Broadcasts from other threads wait here for one drain callback on the loop, rather than each being handed
+        # to call_soon_threadsafe without bound.
+        self.broadcast_queue = deque()
+        self._broadcast_lock = threading.Lock()
+        self._drain_scheduled = False
+        self.outbound_stats = new_outbound_stats()
+        self.inbound_stats = new_inbound_stats()
+        self.stats = new_transport_stats()
+        self.metrics = None
+        self.clients = set()
+        self.socket = None
+        self.server = None
+        self.loop_thread = None
+        self._owns_loop = loop is None
+        self.encoded_delimiter = encode_delimiter(delimiter, encoding)
+        self.welcome_frame = self.encode_message(welcome_message) if welcome_message is not None else None
+        # Fail on invalid limits now rather than when the first client connects.
+        self.new_inbound_limiter()
+
+        if self.debug:
+            logger.setLevel(DEBUG)
+        else:
+            logger.setLevel(INFO)
+
+    def encode_message(self, message):
+        """
+        Returns a str, bytes, or Frame message as a Frame, see imitar.frames.
+        """
+        return encode_message(message, self.encoding, self.delimiter, self.encoded_delimiter)
+
+    def new_inbound_limiter(self):
+        return InboundLimiter(self.buffer_limit, self.buffer_policy, self.rate_limit, self.rate_burst, self.rate_policy,
+                              self.inbound_stats, self.scheduler.time)
+
+    def create_server_socket(self):
+        sock = create_listening_socket(self.port, self.backlog, self.reuse_port)
+        self.port = sock.getsockname()[1]
+        self.socket = sock
+
+    async def create_server(self):
+        self.create_server_socket()
+        self.server = await self.loop.create_server(lambda: ClientProtocol(self), sock=self.socket,
+                                                    backlog=self.backlog)
+
+        if self.idle_timeout is not None:
+            self.scheduler.call_every(min(self.idle_timeout / 2, 1.0), self.reap_connections,
+                                      executor=self.call_in_loop, owner=self)
+
+    def in_loop(self):
+        """
+        Returns True if the caller is running on this server's event loop.
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def call_in_loop(self, fn, *args):
+        if self.in_loop():
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def start(self):
+        if self._owns_loop:
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=False)
+            self.loop_thread.start()
+
+        if self.in_loop():
+            # Being started from a callback on the loop, we can't block waiting for the server to be created.
+            return self.loop.create_task(self.create_server())
+
+        asyncio.run_coroutine_threadsafe(self.create_server(), self.loop).result()
+
+    def _broadcast(self, message, from_client=None):
+        start = time.perf_counter()
+        data = self.encode_message(message)
+
+        for client in list(self.clients):
+            # Only broadcast to clients that aren't the one that sent the message.
+            if from_client is None or client != from_client:
+                client.send_data(data)
+
+        if self.metrics is not None:
+            self.metrics.observe_broadcast(time.perf_counter() - start)
+
+    def _drain_broadcasts(self):
+        with self._broadcast_lock:
+            self._drain_scheduled = False
+
+        while self.broadcast_queue:
+            self._broadcast(*self.broadcast_queue.popleft())
+
+    def broadcast_message(self, message, from_client=None):
+        """
+        Sends a message to every connected client except from_client. Safe to call from any thread.
+        """
+        if self.in_loop():
+            self._broadcast(message, from_client)
+            return
+
+        with self._broadcast_lock:
+            if len(self.broadcast_queue) >= self.broadcast_limit:
+                # The loop has fallen behind, drop the oldest broadcast rather than queue without bound.
+                self.broadcast_queue.popleft()
+                self.stats['broadcasts_dropped'] += 1
+
+            self.broadcast_queue.append((message, from_client))
+
+            if self._drain_scheduled:
+                return
+
+            self._drain_scheduled = True
+
+        self.loop.call_soon_threadsafe(self._drain_broadcasts)
+
+    def gauges(self):
+        """
+        Returns the current size of the server's queues, safe to call from any thread.
+        """
+        clients = list(self.clients)
+
+        return {
+            'clients': len(clients),
+            'broadcast_queue': len(self.broadcast_queue),
+            'message_queue': sum(len(client.message_queue) for client in clients),
+            'message_queue_bytes': sum(client.message_queue.size for client in clients),
+        }
+
+    def reap_connections(self):
+        """
+        Closes idle and half-open clients, see idle_timeout. Runs periodically on the event loop.
+        """
+        for client, reason in expired_sessions(list(self.clients), self.scheduler.time(), self.idle_timeout):
+            logger.debug('Closing %s connection from %s', reason.replace('_', '-'), client.address)
+            self.stats['connections_reaped_' + reason] += 1
+            # A half-open client will never flush what is waiting for it, don't wait for it to.
+            client.transport.abort()
+
+    def _close_all_clients(self):
+        for client in list(self.clients):
+            client.close()
+
+    def close_all_clients(self):
+        """
+        Use this to close all the clients without shutting the server down. Safe to call from any thread.
+        """
+        self.call_in_loop(self._close_all_clients)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+
+        self._close_all_clients()
+
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    def shutdown(self):
+        logger.debug('Stopping server')
+        self.scheduler.cancel_all(self)
+
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        if self.in_loop():
+            task = self.loop.create_task(self.close())
+
+            if self._owns_loop:
+                task.add_done_callback(lambda _: self.loop.stop())
+
+            return
+
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+
+        if self._owns_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
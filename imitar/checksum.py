@@ -0,0 +1,257 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import binascii
+import functools
+import operator
+from abc import ABCMeta, abstractmethod
+
+from .frames import Frame
+from .message_parser import MessageParser
+
+# CRCs computed a byte at a time in Python remember the results for this many distinct messages, then start over.
+CRC_CACHE_SIZE = 1024
+
+
+class Checksum(metaclass=ABCMeta):
+    """
+    A checksum over a run of bytes. compute accepts anything that supports the buffer protocol, so frames can be
+    checked through a memoryview without copying them.
+    """
+    width = 1
+
+    @abstractmethod
+    def compute(self, data) -> int:
+        pass
+
+
+class Sum8(Checksum):
+    """
+    The sum of every byte modulo 256, e.g. Samsung MDC and many projectors.
+    """
+    def compute(self, data):
+        # sum iterates the buffer in C, there is no per byte Python code to speed up with a table.
+        return sum(data) & 0xFF
+
+
+class Xor8(Checksum):
+    """
+    Every byte XORed together.
+    """
+    def compute(self, data):
+        return functools.reduce(operator.xor, data, 0)
+
+
+@functools.lru_cache(maxsize=None)
+def crc_table(bits, poly, reflect):
+    """
+    Returns the 256 entry lookup table for a CRC, so computing it takes one lookup per byte instead of eight shifts.
+    """
+    table = []
+    mask = (1 << bits) - 1
+
+    for i in range(256):
+        if reflect:
+            crc = i
+
+            for _ in range(8):
+                crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+        else:
+            crc = i << (bits - 8)
+            top = 1 << (bits - 1)
+
+            for _ in range(8):
+                crc = (crc << 1) ^ poly if crc & top else crc << 1
+
+        table.append(crc & mask)
+
+    return tuple(table)
+
+
+def reflect_bits(value, bits):
+    return int('{:0{}b}'.format(value, bits)[::-1], 2)
+
+
+class Crc(Checksum):
+    def __init__(self, bits, poly, init=0, reflect=False, xor_out=0):
+        """
+        A table driven CRC with the parameters used by the CRC catalogue, e.g. Crc(16, 0x8005, 0xFFFF, True) is
+        CRC-16/MODBUS. See the module level presets for the common ones.
+
+        CRCs with the CCITT polynomial (0x1021) and the reflected CRC-32 polynomial (0x04C11DB7) are computed in C by
+        binascii. Every other CRC takes one table lookup per byte in Python, so its results are cached per message:
+        polls and constant responses are checked with a dict lookup, but a message seen for the first time costs
+        roughly 60ns a byte, see bench.checksum_bench.
+
+        :param bits: The width of the CRC, 8, 16, or 32.
+        :param poly: The generator polynomial, not reflected.
+        :param init: The initial value of the register. Optional, defaults to 0.
+        :param reflect: Whether input bytes and the result are bit reflected. Optional, defaults to False.
+        :param xor_out: XORed with the result. Optional, defaults to 0.
+        """
+        if bits not in (8, 16, 32):
+            raise ValueError('bits must be 8, 16, or 32')
+
+        self.bits = bits
+        self.width = bits // 8
+        self.poly = poly
+        self.init = init
+        self.reflect = reflect
+        self.xor_out = xor_out
+        self.table = crc_table(bits, reflect_bits(poly, bits) if reflect else poly, reflect)
+        self._register = reflect_bits(init, bits) if reflect else init
+        self._results = {}
+
+    def compute(self, data):
+        crc = self._register
+
+        if self.bits == 16 and self.poly == 0x1021 and not self.reflect:
+            # The CCITT polynomial is implemented in C by binascii.
+            return binascii.crc_hqx(data, crc) ^ self.xor_out
+
+        if self.bits == 32 and self.poly == 0x04C11DB7 and self.reflect:
+            # So is CRC-32, which inverts the register before and after, undo that to support any init and xor_out.
+            return binascii.crc32(data, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF ^ self.xor_out
+
+        key = bytes(data)
+        result = self._results.get(key)
+
+        if result is not None:
+            return result
+
+        table = self.table
+
+        if self.reflect:
+            for byte in key:
+                crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+        elif self.bits == 8:
+            for byte in key:
+                crc = table[crc ^ byte]
+        else:
+            shift = self.bits - 8
+            mask = (1 << self.bits) - 1
+
+            for byte in key:
+                crc = table[(crc >> shift) ^ byte] ^ ((crc << 8) & mask)
+
+        result = crc ^ self.xor_out
+
+        if len(self._results) >= CRC_CACHE_SIZE:
+            self._results.clear()
+
+        self._results[key] = result
+
+        return result
+
+    def __repr__(self):
+        return 'Crc({}, {:#x}, {:#x}, {}, {:#x})'.format(self.bits, self.poly, self.init, self.reflect, self.xor_out)
+
+
+SUM8 = Sum8()
+XOR8 = Xor8()
+CRC8 = Crc(8, 0x07)
+CRC8_MAXIM = Crc(8, 0x31, reflect=True)
+CRC16_XMODEM = Crc(16, 0x1021)
+CRC16_CCITT_FALSE = Crc(16, 0x1021, 0xFFFF)
+CRC16_ARC = Crc(16, 0x8005, reflect=True)
+CRC16_MODBUS = Crc(16, 0x8005, 0xFFFF, reflect=True)
+CRC32 = Crc(32, 0x04C11DB7, 0xFFFFFFFF, reflect=True, xor_out=0xFFFFFFFF)
+
+
+class ChecksumFraming:
+    def __init__(self, checksum, header=b'', covers_header=False, byteorder='big'):
+        """
+        Builds and validates frames made of a header, a payload, and a checksum trailer:
+
+            framing = ChecksumFraming(SUM8, header=b'\\xaa')
+            framing.build(b'\\x11\\x00\\x01\\x01')  # b'\\xaa\\x11\\x00\\x01\\x01\\x13'
+
+        :param checksum: A Checksum, e.g. SUM8 or CRC16_MODBUS.
+        :param header: The bytes every frame starts with. Optional, defaults to none.
+        :param covers_header: Whether the checksum includes the header. Optional, defaults to False.
+        :param byteorder: The byte order of checksums wider than a byte, big or little. Optional, defaults to big.
+        """
+        self.checksum = checksum
+        self.header = bytes(header)
+        self.covers_header = covers_header
+        self.byteorder = byteorder
+        self._start = 0 if covers_header else len(self.header)
+
+    def build(self, payload):
+        """
+        Returns payload with the header and checksum added as a Frame, transports send it as is.
+        """
+        frame = bytearray(self.header)
+        frame += payload
+
+        with memoryview(frame) as view:
+            checksum = self.checksum.compute(view[self._start:])
+
+        frame += checksum.to_bytes(self.checksum.width, self.byteorder)
+
+        return Frame(frame)
+
+    def build_many(self, payloads):
+        return [self.build(payload) for payload in payloads]
+
+    def is_valid(self, frame):
+        """
+        Returns True if frame starts with the header and ends with the right checksum.
+        """
+        width = self.checksum.width
+        end = len(frame) - width
+
+        if end < len(self.header):
+            return False
+
+        with memoryview(frame) as view:
+            if view[:len(self.header)] != self.header:
+                return False
+
+            expected = int.from_bytes(view[end:], self.byteorder)
+
+            return self.checksum.compute(view[self._start:end]) == expected
+
+    def payload(self, frame):
+        """
+        Returns frame without its header and checksum.
+        """
+        return bytes(frame[len(self.header):len(frame) - self.checksum.width])
+
+    def validate_many(self, frames):
+        """
+        Returns (payloads, invalid), the payloads of every valid frame and the number of invalid frames.
+        """
+        payloads = [self.payload(frame) for frame in frames if self.is_valid(frame)]
+
+        return payloads, len(frames) - len(payloads)
+
+
+class ChecksumMessageParser(MessageParser):
+    def __init__(self, parser, framing):
+        """
+        Validates the frames another MessageParser splits a stream into. Handlers are given the payload of every valid
+        frame, frames with a bad checksum are dropped and counted in invalid, the way a real device ignores them. The
+        parser has to return whole frames, e.g. a VariableLengthMessageParser with include_header:
+
+            ChecksumMessageParser(CursorVariableLengthMessageParser(b'\\xaa', 3, 1, include_header=True),
+                                  ChecksumFraming(SUM8, header=b'\\xaa'))
+
+        :param parser: The MessageParser that splits the stream into frames.
+        :param framing: The ChecksumFraming the frames use, emulators should build their responses with it too.
+        """
+        self.parser = parser
+        self.framing = framing
+        self.invalid = 0
+
+    def new_buffer(self):
+        return self.parser.new_buffer()
+
+    def process_buffer(self, buffer):
+        frames, buffer = self.parser.process_buffer(buffer)
+
+        if not frames:
+            return frames, buffer
+
+        payloads, invalid = self.framing.validate_many(frames)
+        self.invalid += invalid
+
+        return payloads, buffer
@@ -0,0 +1,390 @@
+# Copyright 2015 jydo inc. All rights reserved.
+"""
+Clients for driving emulators from tests and load generators. AsyncClient runs on an asyncio event loop, Client and
+ClientPool wrap it for synchronous code by running the loop in a background thread.
+
+Requests are pipelined: any number can be in flight on one connection and each is answered by the messages the
+emulator sends back in order. Messages that aren't responses, such as the broadcasts other clients' changes trigger,
+go to subscribers instead:
+
+    with Client('127.0.0.1', 4000, is_broadcast=lambda message: message.startswith('Sig')) as client:
+        client.subscribe(print)
+        client.request('1!')                   # 'In1 All'
+        client.request_many(['1!', '2!', '3!'])  # Sent in one write.
+"""
+import asyncio
+import collections
+import itertools
+import socket
+import threading
+
+from .frames import encode_delimiter, encode_message
+from .message_parser import CursorCharacterMessageParser
+
+
+def same_command(request, message):
+    """
+    A correlate function for protocols that echo the command in the response, e.g. 'VOLM ?' is answered by 'VOLM 20'.
+    """
+    return request.split(' ', 1)[0] == message.split(' ', 1)[0]
+
+
+class AsyncClient(asyncio.Protocol):
+    def __init__(self, host, port, message_parser=None, encoding='ascii', delimiter='\r\n', welcome=False,
+                 is_broadcast=None, correlate=None, timeout=5.0):
+        """
+        A connection to an emulator. The message_parser, encoding, and delimiter have the same meaning as for the
+        emulator, so a client frames messages the same way the device it talks to does.
+
+        By default every message answers the oldest request still waiting for a response, and messages that arrive
+        while no request is waiting are broadcasts.
+
+        :param message_parser: The MessageParser for messages from the emulator. Optional, defaults to splitting on the
+        delimiter.
+        :param encoding: The encoding of messages, None to send and receive bytes. Optional, defaults to ascii.
+        :param delimiter: Appended to every message that isn't already a Frame. Optional, defaults to \\r\\n.
+        :param welcome: Whether the emulator sends a welcome message, connect waits for it. Optional, defaults to False.
+        :param is_broadcast: Returns True if a message is a broadcast rather than a response. Optional.
+        :param correlate: Called as correlate(request, message), returns True if the message answers the request. The
+        message answers the oldest request it correlates with, e.g. same_command. Optional, defaults to the oldest
+        request.
+        :param timeout: Seconds to wait for connecting and for responses, None to wait forever. Optional, defaults to
+        5 seconds.
+        """
+        self.host = host
+        self.port = port
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.encoded_delimiter = encode_delimiter(delimiter, encoding)
+        self.message_parser = message_parser or CursorCharacterMessageParser(self.encoded_delimiter, encoding)
+        self.welcome = welcome
+        self.is_broadcast = is_broadcast
+        self.correlate = correlate
+        self.timeout = timeout
+        self.welcome_message = None
+        self.transport = None
+        self.buffer = self.message_parser.new_buffer()
+        self.pending = collections.deque()
+        self.subscribers = {}
+        self._subscriber_ids = itertools.count()
+        self._welcomed = None
+        self._closed = None
+
+    @property
+    def connected(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self._closed = loop.create_future()
+        self._welcomed = loop.create_future()
+
+        if not self.welcome:
+            self._welcomed.set_result(None)
+
+        await asyncio.wait_for(loop.create_connection(lambda: self, self.host, self.port), self.timeout)
+        await asyncio.wait_for(asyncio.shield(self._welcomed), self.timeout)
+
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Requests are small and latency matters more than packet count, don't let Nagle hold them back.
+        transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        error = exc or ConnectionError('Connection to {}:{} closed'.format(self.host, self.port))
+
+        while self.pending:
+            _, future = self.pending.popleft()
+
+            if not future.done():
+                future.set_exception(error)
+
+        if not self._welcomed.done():
+            self._welcomed.set_exception(error)
+
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+        messages, self.buffer = self.message_parser.process_buffer(self.buffer)
+
+        for message in messages:
+            if message:
+                self.message_received(message)
+
+    def message_received(self, message):
+        if not self._welcomed.done():
+            self.welcome_message = message
+            self._welcomed.set_result(message)
+            return
+
+        if self.is_broadcast is None or not self.is_broadcast(message):
+            for index, (request, future) in enumerate(self.pending):
+                if self.correlate is None or self.correlate(request, message):
+                    del self.pending[index]
+
+                    if not future.done():
+                        future.set_result(message)
+
+                    return
+
+        for callback, prefix in list(self.subscribers.values()):
+            if prefix is None or message.startswith(prefix):
+                callback(message)
+
+    def subscribe(self, callback, prefix=None):
+        """
+        Calls callback(message) with every broadcast, or only broadcasts starting with prefix.
+
+        :return: A function that unsubscribes the callback.
+        """
+        subscriber_id = next(self._subscriber_ids)
+        self.subscribers[subscriber_id] = (callback, prefix)
+
+        return lambda: self.subscribers.pop(subscriber_id, None)
+
+    def encode(self, message):
+        return encode_message(message, self.encoding, self.delimiter, self.encoded_delimiter)
+
+    def send(self, *messages):
+        """
+        Sends messages that don't get a response, in one write.
+        """
+        if not self.connected:
+            raise ConnectionError('Not connected to {}:{}'.format(self.host, self.port))
+
+        self.transport.writelines([self.encode(message) for message in messages])
+
+    async def request_many(self, messages, timeout=None):
+        """
+        Sends every message in one write and returns their responses in the same order.
+
+        If the responses don't all arrive in time the connection is closed, since responses arriving late would be taken
+        for the responses to later requests. Reconnect, or let a pool do it, to carry on.
+
+        :param timeout: Seconds to wait for all the responses. Optional, defaults to the client's timeout.
+        """
+        if not self.connected:
+            raise ConnectionError('Not connected to {}:{}'.format(self.host, self.port))
+
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        for message in messages:
+            future = loop.create_future()
+            self.pending.append((message, future))
+            futures.append(future)
+
+        self.send(*messages)
+
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            if self.transport is not None:
+                self.transport.close()
+
+            raise
+        except BaseException:
+            # Cancelled, the requests stay pending so their responses are dropped when they arrive rather than taken
+            # for the responses to later requests.
+            for future in futures:
+                future.cancel()
+
+            raise
+
+    async def request(self, message, timeout=None):
+        """
+        Sends message and returns its response.
+        """
+        responses = await self.request_many([message], timeout)
+
+        return responses[0]
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+        if self._closed is not None:
+            await self._closed
+
+    async def __aenter__(self):
+        if not self.connected:
+            await self.connect()
+
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class AsyncClientPool:
+    def __init__(self, size=1, **options):
+        """
+        Keeps up to size connections to every emulator it is asked for and hands them out in turn. Requests are
+        pipelined, so a connection can be shared by any number of tasks at once.
+
+        :param size: Connections per host and port. Optional, defaults to 1.
+        :param options: Keyword arguments for every AsyncClient, e.g. welcome or is_broadcast.
+        """
+        self.size = size
+        self.options = options
+        self.clients = {}
+        self._turns = {}
+
+    async def get(self, host, port):
+        """
+        Returns the next connection to host and port, connecting it first if needed.
+        """
+        key = (host, port)
+        clients = self.clients.setdefault(key, [])
+        turn = self._turns.get(key, 0)
+        self._turns[key] = (turn + 1) % self.size
+
+        if turn >= len(clients):
+            clients.append(None)
+
+        # Slots hold the task connecting them, so tasks asking for the same slot at once share one connection.
+        connecting = clients[turn]
+
+        if connecting is None or (connecting.done() and (connecting.cancelled() or connecting.exception() is not None or
+                                                         not connecting.result().connected)):
+            # Reconnect with a new client, subscriptions don't carry over.
+            connecting = clients[turn] = asyncio.ensure_future(AsyncClient(host, port, **self.options).connect())
+
+        return await asyncio.shield(connecting)
+
+    async def request(self, host, port, message, timeout=None):
+        client = await self.get(host, port)
+
+        return await client.request(message, timeout)
+
+    async def close(self):
+        connecting = [task for clients in self.clients.values() for task in clients if task is not None]
+        self.clients = {}
+        clients = await asyncio.gather(*connecting, return_exceptions=True)
+        await asyncio.gather(*[client.close() for client in clients if isinstance(client, AsyncClient)])
+
+
+class LoopThread:
+    """
+    An event loop running in a daemon thread, for calling AsyncClients from synchronous code.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def call(self, fn, *args):
+        """
+        Calls fn on the loop and returns its result.
+        """
+        async def call():
+            return fn(*args)
+
+        return self.run(call())
+
+    def stop(self):
+        if self.loop.is_closed():
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class Client:
+    def __init__(self, host, port, loop_thread=None, connect=True, **options):
+        """
+        A blocking AsyncClient, see it for the options. Subscribers are called on the client's loop thread.
+
+        :param loop_thread: The LoopThread to run on. Optional, defaults to one owned by this client.
+        :param connect: Whether to connect right away. Optional, defaults to True.
+        """
+        self._owns_loop = loop_thread is None
+        self.loop_thread = loop_thread or LoopThread()
+        self.client = AsyncClient(host, port, **options)
+
+        if connect:
+            self.connect()
+
+    @property
+    def connected(self):
+        return self.client.connected
+
+    @property
+    def welcome_message(self):
+        return self.client.welcome_message
+
+    def connect(self):
+        try:
+            self.loop_thread.run(self.client.connect())
+        except BaseException:
+            if self._owns_loop:
+                self.loop_thread.stop()
+
+            raise
+
+        return self
+
+    def subscribe(self, callback, prefix=None):
+        unsubscribe = self.loop_thread.call(self.client.subscribe, callback, prefix)
+
+        return lambda: self.loop_thread.call(unsubscribe)
+
+    def send(self, *messages):
+        self.loop_thread.call(self.client.send, *messages)
+
+    def request(self, message, timeout=None):
+        return self.loop_thread.run(self.client.request(message, timeout))
+
+    def request_many(self, messages, timeout=None):
+        return self.loop_thread.run(self.client.request_many(messages, timeout))
+
+    def close(self):
+        if not self.loop_thread.loop.is_closed():
+            self.loop_thread.run(self.client.close())
+
+        if self._owns_loop:
+            self.loop_thread.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ClientPool:
+    def __init__(self, size=1, **options):
+        """
+        A blocking AsyncClientPool, every connection runs on a single loop thread.
+        """
+        self.loop_thread = LoopThread()
+        self.pool = AsyncClientPool(size, **options)
+
+    def request(self, host, port, message, timeout=None):
+        return self.loop_thread.run(self.pool.request(host, port, message, timeout))
+
+    def request_many(self, host, port, messages, timeout=None):
+        async def request_many():
+            client = await self.pool.get(host, port)
+            return await client.request_many(messages, timeout)
+
+        return self.loop_thread.run(request_many())
+
+    def close(self):
+        self.loop_thread.run(self.pool.close())
+        self.loop_thread.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
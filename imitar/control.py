@@ -0,0 +1,431 @@
+# Copyright 2015 jydo inc. All rights reserved.
+"""
+A local control channel for changing an emulator's state from outside, e.g. unplugging an input in the middle of a
+test or flooding a controller with signal changes. Commands are JSON objects, one per line, sent over a loopback port
+or a Unix socket, every command is answered by a JSON object with ok set to true, or false and an error:
+
+    {"op": "apply", "changes": [{"key": "active_input", "value": 3}]}
+    {"op": "every", "interval": 0.01, "duration": 60, "changes": [{"key": "connection_state", "index": 2,
+     "toggle": true}]}
+
+Ops:
+    apply: Makes changes and calls at once, atomically. Replies with the state version.
+    get: Replies with the values of keys, or every value.
+    every: Applies changes and calls every interval seconds, for duration seconds or until cancelled. Replies with the
+           script id.
+    after: Applies changes and calls once, after delay seconds. Replies with the script id.
+    cancel: Cancels the script with the id script, or every script. Replies with the number cancelled.
+
+A change sets key to value, or toggles it if toggle is true. With an index it changes one element of a tuple value
+instead. A call is a method and its args, only methods listed in the emulator's control_methods can be called. The id
+of a command, if it has one, is copied to its reply.
+
+Control is the Python binding:
+
+    with Control(port=9000) as control:
+        control.every(0.01, toggle('connection_state', 2), duration=60)
+"""
+import inspect
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from .log import get_logger
+
+logger = get_logger('control')
+
+
+class ControlError(Exception):
+    pass
+
+
+def set_value(key, value, index=None):
+    change = {'key': key, 'value': value}
+
+    if index is not None:
+        change['index'] = index
+
+    return change
+
+
+def toggle(key, index=None):
+    change = {'key': key, 'toggle': True}
+
+    if index is not None:
+        change['index'] = index
+
+    return change
+
+
+def method_call(method, *args):
+    return {'method': method, 'args': list(args)}
+
+
+def _toggled(value):
+    if isinstance(value, bool):
+        return not value
+
+    if isinstance(value, int) and value in (0, 1):
+        return 1 - value
+
+    if value in ('0', '1'):
+        return '1' if value == '0' else '0'
+
+    raise ControlError("{!r} can't be toggled".format(value))
+
+
+def _changed_value(current, change):
+    if change.get('toggle'):
+        return _toggled(current)
+
+    value = change['value']
+
+    # JSON has no tuples, keep state values immutable.
+    return tuple(value) if isinstance(value, list) else value
+
+
+def changed_values(values, changes):
+    """
+    Returns the values changes result in, given the current values.
+
+    :raises ControlError: If a change can't be made, e.g. its index is out of range.
+    """
+    changed = {}
+
+    for change in changes:
+        key = change.get('key')
+
+        if key not in values:
+            raise ControlError('Unknown state key {!r}'.format(key))
+
+        if not change.get('toggle') and 'value' not in change:
+            raise ControlError('A change needs a value or toggle')
+
+        current = changed[key] if key in changed else values[key]
+
+        if 'index' in change:
+            index = change['index']
+
+            if not isinstance(current, tuple):
+                raise ControlError("{} isn't a tuple, it can't be changed by index".format(key))
+
+            if type(index) != int or not -len(current) <= index < len(current):
+                raise ControlError('Index {!r} is out of range for {}'.format(index, key))
+
+            elements = list(current)
+            elements[index] = _changed_value(elements[index], change)
+            changed[key] = tuple(elements)
+        else:
+            changed[key] = _changed_value(current, change)
+
+    return changed
+
+
+def _check_seconds(name, seconds, positive=False):
+    if type(seconds) not in (int, float) or not (seconds > 0 if positive else seconds >= 0):
+        raise ControlError('{} must be a {} number of seconds, not {!r}'.format(
+            name, 'positive' if positive else 'non-negative', seconds))
+
+
+class Controller:
+    def __init__(self, emulator):
+        """
+        Executes control commands against an emulator, see the module documentation for the commands. Every emulator
+        has one as emulator.controller, a ControlServer exposes it to other processes.
+        """
+        self.emulator = emulator
+        self.scripts = {}
+        self._script_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def validate(self, changes, calls):
+        """
+        Raises ControlError unless changes and calls can be applied to the current state. Scripts are validated before
+        they are scheduled, so a mistake is reported to whoever sent them rather than failing on the emulator's loop.
+        """
+        changed_values(self.emulator.state.snapshot()[1], changes)
+
+        for call in calls:
+            method = call.get('method')
+
+            if method not in self.emulator.control_methods:
+                raise ControlError('{!r} is not a control method of {}'.format(method, type(self.emulator).__name__))
+
+            try:
+                inspect.signature(getattr(self.emulator, method)).bind(*call.get('args', ()))
+            except TypeError as e:
+                raise ControlError('Bad arguments for {}: {}'.format(method, e))
+
+    def apply(self, changes=(), calls=()):
+        """
+        Makes every change in a single state update, then makes every call, all under the state lock so handlers never
+        see part of them.
+
+        :return: The state version after applying them.
+        """
+        state = self.emulator.state
+
+        with state.lock:
+            state.update(changed_values(state, changes))
+
+            for call in calls:
+                getattr(self.emulator, call['method'])(*call.get('args', ()))
+
+            return state.version
+
+    def every(self, interval, changes=(), calls=(), duration=None):
+        """
+        Applies changes and calls every interval seconds on the emulator's scheduler, like call_every.
+
+        :param duration: Stop after this many seconds. Optional, defaults to running until cancelled.
+        :return: The script id, see cancel.
+        """
+        _check_seconds('interval', interval, positive=True)
+
+        if duration is not None:
+            _check_seconds('duration', duration)
+
+        self.validate(changes, calls)
+        script_id, timers = self._new_script()
+        timers.append(self.emulator.call_every(interval, self._run, script_id, changes, calls))
+
+        if duration is not None:
+            timers.append(self.emulator.call_later(duration, self.cancel, script_id))
+
+        self._started(script_id)
+
+        return script_id
+
+    def after(self, delay, changes=(), calls=()):
+        _check_seconds('delay', delay)
+        self.validate(changes, calls)
+        script_id, timers = self._new_script()
+        timers.append(self.emulator.call_later(delay, self._finish, script_id, changes, calls))
+        self._started(script_id)
+
+        return script_id
+
+    def _new_script(self):
+        # Scripts are registered before their timers exist, so a timer that fails right away can cancel its script.
+        script_id = next(self._script_ids)
+        timers = []
+
+        with self._lock:
+            self.scripts[script_id] = timers
+
+        return script_id, timers
+
+    def _started(self, script_id):
+        with self._lock:
+            cancelled = script_id not in self.scripts
+
+        if cancelled:
+            # Cancelled before all of its timers were added.
+            self.cancel(script_id)
+
+    def _run(self, script_id, changes, calls):
+        try:
+            self.apply(changes, calls)
+        except Exception:
+            # The state may have changed since the script was validated, e.g. restored, don't let it fail every tick.
+            logger.exception('Error running control script %s, cancelling it', script_id)
+            self.cancel(script_id)
+
+    def _finish(self, script_id, changes, calls):
+        with self._lock:
+            self.scripts.pop(script_id, None)
+
+        self._run(script_id, changes, calls)
+
+    def cancel(self, script_id=None):
+        """
+        Cancels a script, or every script if no id is given.
+
+        :return: The number of scripts cancelled.
+        """
+        with self._lock:
+            if script_id is None:
+                scripts = list(self.scripts.values())
+                self.scripts.clear()
+            else:
+                scripts = [self.scripts.pop(script_id)] if script_id in self.scripts else []
+
+        for timers in scripts:
+            for timer in timers:
+                timer.cancel()
+
+        return len(scripts)
+
+    def execute(self, command):
+        """
+        Executes a command dict and returns its reply dict.
+        """
+        op = command.get('op')
+        changes = command.get('changes', ())
+        calls = command.get('calls', ())
+
+        if op == 'apply':
+            self.validate(changes, calls)
+            reply = {'version': self.apply(changes, calls)}
+        elif op == 'get':
+            version, values = self.emulator.state.snapshot()
+            keys = command.get('keys') or values
+            reply = {'version': version, 'values': {key: values[key] for key in keys if key in values}}
+        elif op == 'every':
+            reply = {'script': self.every(command['interval'], changes, calls, command.get('duration'))}
+        elif op == 'after':
+            reply = {'script': self.after(command['delay'], changes, calls)}
+        elif op == 'cancel':
+            reply = {'cancelled': self.cancel(command.get('script'))}
+        else:
+            raise ControlError('Unknown op {!r}'.format(op))
+
+        reply['ok'] = True
+
+        return reply
+
+    def handle_line(self, line):
+        """
+        Executes a command encoded as a line of JSON and returns the JSON encoded reply.
+        """
+        command = {}
+
+        try:
+            command = json.loads(line)
+            reply = self.execute(command)
+        except (ControlError, ValueError, KeyError, IndexError, TypeError) as e:
+            reply = {'ok': False, 'error': str(e)}
+        except Exception as e:
+            logger.exception('Error executing control command: %s', e)
+            reply = {'ok': False, 'error': str(e)}
+
+        if isinstance(command, dict) and 'id' in command:
+            reply['id'] = command['id']
+
+        return json.dumps(reply).encode('utf-8')
+
+
+class ControlServer:
+    def __init__(self, controller, port=None, path=None, host='127.0.0.1'):
+        """
+        Serves a Controller from a background thread, one line of JSON per command.
+
+        :param controller: The Controller to serve.
+        :param port: The port to listen on, 0 picks a free port.
+        :param path: Listen on a Unix socket at this path instead of a port.
+        :param host: The interface to listen on. Optional, defaults to localhost only.
+        """
+        handler = self._handler(controller)
+        self.path = path
+
+        if path is not None:
+            self.server = socketserver.ThreadingUnixStreamServer(path, handler)
+            self.port = None
+        else:
+            self.server = socketserver.ThreadingTCPServer((host, port), handler)
+            self.port = self.server.server_address[1]
+
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @staticmethod
+    def _handler(controller):
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write(controller.handle_line(line) + b'\n')
+
+        return Handler
+
+    @property
+    def address(self):
+        return self.path if self.path is not None else 'localhost:{}'.format(self.port)
+
+    def start(self):
+        self.thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Control:
+    def __init__(self, port=None, path=None, host='127.0.0.1', timeout=5.0):
+        """
+        Connects to a ControlServer on a port or a Unix socket path. Methods raise ControlError if the emulator rejects
+        a command.
+        """
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host, port), timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.file = self.socket.makefile('rwb')
+
+    def execute(self, op, **command):
+        command['op'] = op
+        self.file.write(json.dumps(command).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+
+        if not line:
+            raise ControlError('The control connection was closed')
+
+        reply = json.loads(line)
+
+        if not reply['ok']:
+            raise ControlError(reply['error'])
+
+        return reply
+
+    def apply(self, *changes, calls=()):
+        """
+        Makes changes (see set_value and toggle) and calls (see method_call) atomically.
+
+        :return: The state version after applying them.
+        """
+        return self.execute('apply', changes=list(changes), calls=list(calls))['version']
+
+    def update(self, **values):
+        return self.apply(*[set_value(key, value) for key, value in values.items()])
+
+    def call(self, method, *args):
+        return self.apply(calls=[method_call(method, *args)])
+
+    def get(self, *keys):
+        return self.execute('get', keys=list(keys))['values']
+
+    def every(self, interval, *changes, calls=(), duration=None):
+        """
+        Applies changes and calls every interval seconds, for duration seconds or until cancelled.
+
+        :return: The script id, see cancel.
+        """
+        return self.execute('every', interval=interval, duration=duration, changes=list(changes),
+                            calls=list(calls))['script']
+
+    def after(self, delay, *changes, calls=()):
+        return self.execute('after', delay=delay, changes=list(changes), calls=list(calls))['script']
+
+    def cancel(self, script=None):
+        return self.execute('cancel', script=script)['cancelled']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
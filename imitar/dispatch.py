@@ -0,0 +1,201 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import inspect
+import re
+
+_SPECIAL = set('.^$*+?{}[]\\|()')
+_QUANTIFIERS = set('*+?{')
+
+
+def command(pattern, name=None, depends=None):
+    """
+    Marks an Emulator method as the handler for messages that fully match pattern. Named groups in the pattern are
+    passed to the handler as keyword arguments. A method may be decorated more than once.
+
+        @command(r'VOLM \\?', name='VOLM', depends=('volume',))
+        @command(r'VOLM (?P<value>[^ ]*)', name='VOLM')
+        def handle_volume(self, value='?'):
+            ...
+
+    A handler with a session parameter is also passed the Session of the client that sent the message.
+
+    :param pattern: A regular expression (str or bytes, matching the type of the parsed messages).
+    :param name: The name metrics are recorded under. Optional, defaults to the method name.
+    :param depends: Declares the route a pure query: its response only depends on these keys of the emulator's state
+    and handling it changes nothing, so it can't depend on the session either. Responses of pure queries are cached per
+    message until one of the values changes, see Emulator.dispatch. Optional.
+    """
+    def decorator(fn):
+        fn.__dict__.setdefault('_imitar_routes', []).append((pattern, name, depends))
+        return fn
+
+    return decorator
+
+
+def _has_top_level_alternation(text):
+    depth = 0
+    escaped = False
+    in_class = False
+
+    for char in text:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+
+    return False
+
+
+def literal_prefix(pattern):
+    """
+    Returns the literal text every match of pattern starts with, which may be empty.
+    """
+    is_bytes = isinstance(pattern, bytes)
+    text = pattern.decode('latin-1') if is_bytes else pattern
+    prefix = []
+    i = 0
+
+    if _has_top_level_alternation(text):
+        return pattern[:0]
+
+    while i < len(text):
+        char = text[i]
+        length = 1
+
+        if char == '\\':
+            escaped = text[i + 1:i + 2]
+
+            if escaped == 'x' and re.fullmatch(r'[0-9a-fA-F]{2}', text[i + 2:i + 4]):
+                char = chr(int(text[i + 2:i + 4], 16))
+                length = 4
+            elif escaped and not escaped.isalnum():
+                char = escaped
+                length = 2
+            else:
+                break
+        elif char in _SPECIAL:
+            break
+
+        if text[i + length:i + length + 1] in _QUANTIFIERS:
+            # The character might be repeated or left out, so it isn't part of every match.
+            break
+
+        prefix.append(char)
+        i += length
+
+    prefix = ''.join(prefix)
+
+    return prefix.encode('latin-1') if is_bytes else prefix
+
+
+def accepts_session(fn):
+    """
+    Returns True if fn has a session parameter.
+    """
+    try:
+        return 'session' in inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+class Route:
+    __slots__ = ('pattern', 'regex', 'handler', 'name', 'depends', 'takes_session')
+
+    def __init__(self, pattern, handler, name, depends=None):
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.DOTALL)
+        self.handler = handler
+        self.name = name
+        self.depends = tuple(depends) if depends is not None else None
+        self.takes_session = accepts_session(handler)
+
+
+class _TrieNode:
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+
+class CommandRouter:
+    """
+    Maps messages to handlers. Routes are stored in a trie keyed by the literal prefix of their pattern, so finding the
+    candidates for a message costs one dict lookup per character of the prefix no matter how many routes there are.
+    Only the candidates' regular expressions are tried, routes with the longest matching prefix first and in the order
+    they were added after that. Routes without a literal prefix are tried last, so give patterns a literal prefix
+    where the protocol allows it.
+    """
+    def __init__(self):
+        self.root = _TrieNode()
+        self.routes = []
+
+    def add(self, pattern, handler, name=None, depends=None):
+        """
+        Adds a route, handler is called with the pattern's named groups as keyword arguments. See command for depends.
+        """
+        route = Route(pattern, handler, name or getattr(handler, '__name__', str(pattern)), depends)
+        node = self.root
+
+        for key in literal_prefix(pattern):
+            node = node.children.setdefault(key, _TrieNode())
+
+        node.routes.append(route)
+        self.routes.append(route)
+
+        return route
+
+    def match(self, message):
+        """
+        Returns (route, match) for the route that handles message, or (None, None) if there isn't one.
+        """
+        node = self.root
+        candidates = [node.routes] if node.routes else []
+
+        for key in message:
+            node = node.children.get(key)
+
+            if node is None:
+                break
+
+            if node.routes:
+                candidates.append(node.routes)
+
+        for routes in reversed(candidates):
+            for route in routes:
+                match = route.regex.fullmatch(message)
+
+                if match is not None:
+                    return route, match
+
+        return None, None
+
+    @classmethod
+    def from_class(cls, klass):
+        """
+        Builds a router from the methods of klass marked with the command decorator, including inherited ones.
+        Handlers are stored as plain functions and must be called with the instance as the first argument.
+        """
+        router = cls()
+        seen = set()
+
+        for base in klass.__mro__:
+            for attr, value in vars(base).items():
+                if attr in seen:
+                    continue
+
+                seen.add(attr)
+
+                for pattern, name, depends in getattr(value, '_imitar_routes', ()):
+                    router.add(pattern, value, name or attr, depends)
+
+        return router
@@ -1,25 +1,142 @@
 # Copyright 2015 jydo inc. All rights reserved.
+import collections
 import signal
 import sys
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-from logging import getLogger, StreamHandler, DEBUG, INFO
+from logging import DEBUG, INFO
 
+from .control import Controller, ControlServer
+from .dispatch import CommandRouter, accepts_session
+from .frames import encode_delimiter, encode_message
+from .log import get_logger
+from .metrics import Metrics, MetricsServer
+from .scheduler import default_scheduler
+from .state import DeviceState
 from .tcp_server import TcpServer
 
-_logger = getLogger('device_server')
-_logger.addHandler(StreamHandler(stream=sys.stdout))
+_logger = get_logger('device_server')
+# Pure query responses are cached per message, clear the cache if this many distinct messages have been cached.
+QUERY_CACHE_SIZE = 1024
 
 
 class Emulator(metaclass=ABCMeta):
     welcome_message = None
     logger = _logger
+    router = CommandRouter()
+    # Methods the control channel may call, e.g. ones that change state in ways a plain change can't express.
+    control_methods = frozenset()
 
-    def __init__(self, port, message_parser, delimiter='\r\n', encoding='ascii', debug=False):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Compile the routes of methods marked with the command decorator once per class.
+        cls.router = CommandRouter.from_class(cls)
+
+    def __init__(self, port, message_parser, delimiter='\r\n', encoding='ascii', debug=False,
+                 transport_class=TcpServer, transport_options=None, metrics=False, metrics_port=None,
+                 handle_signals=True, scheduler=None, traffic_log=None, recorder=None, coalesce=None, control_port=None,
+                 control_path=None):
+        """
+        :param transport_class: The server used to talk to clients, TcpServer or AsyncTcpServer. Optional, defaults to
+        TcpServer.
+        :param transport_options: Extra keyword arguments for the transport, e.g. outbound_limit, overflow_policy,
+        buffer_limit, or rate_limit. Optional.
+        :param metrics: If True record runtime metrics, available from self.metrics. Optional, defaults to False.
+        :param metrics_port: If set, serve metrics in the Prometheus text format at http://localhost:port/metrics,
+        implies metrics=True. Optional.
+        :param handle_signals: If True SIGINT and SIGTERM shut the emulator down and exit. Turn this off when the
+        emulator isn't the only thing running in the process. Optional, defaults to True.
+        :param scheduler: The Scheduler that runs delayed and periodic actions, see call_later. Tests can pass
+        Scheduler(VirtualClock()) to control time. Optional, defaults to a real time scheduler shared by every emulator
+        in the process.
+        :param traffic_log: A TrafficLog that logs the messages the emulator receives and the responses it sends, see
+        imitar.log. Optional.
+        :param recorder: A Recorder that records every client session for replay, see imitar.recording and
+        imitar.replay. Optional.
+        :param coalesce: A dict of state key to a window in seconds. Changes to those keys are broadcast at most once
+        per window, see broadcast_on_change. Optional.
+        :param control_port: If set, accept control commands on this localhost port, see imitar.control. self.controller
+        executes them in process either way. Optional.
+        :param control_path: If set, accept control commands on a Unix socket at this path instead. Optional.
+        """
+        self._query_cache = {}
+        # The route name of every cached query, so a cache hit can still be labelled in the metrics.
+        self._query_routes = {}
+        self._query_keys = {}
+        self._query_generation = 0
+        self._handling = threading.local()
+        self.state = DeviceState(context=self._change_context)
+        self.state.subscribe(self._state_changed)
+        self.coalesce = dict(coalesce or {})
+        # How many broadcast_on_change subscriptions watch each key.
+        self._broadcast_keys = collections.Counter()
+        self._coalescing = {}
+        # Owns the timers that belong to the current state, which restore cancels, see call_later.
+        self._state_timers = object()
+        self.checkpoints = {}
+        self.controller = Controller(self)
+        self.control_server = None
         self.port = port
         self.debug = debug
-        self.transport = TcpServer(self.port, self.handle_message, message_parser, encoding, delimiter,
-                                   self.welcome_message, debug)
-        self._setup_signal_handlers()
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.encoded_delimiter = encode_delimiter(delimiter, encoding)
+        self.metrics = None
+        self.metrics_server = None
+        self.scheduler = scheduler or default_scheduler()
+        self.traffic_log = traffic_log
+        self.recorder = recorder
+        metrics = metrics or metrics_port is not None
+        # Transports pass every message along with the client's Session, drop it for handlers written without one.
+        self._handle_message = self.handle_message
+
+        if not accepts_session(self.handle_message):
+            self._handle_message = lambda message, session=None: self.handle_message(message)
+
+        self._handle_messages = self.handle_messages
+
+        if not accepts_session(self.handle_messages):
+            self._handle_messages = lambda messages, session=None: self.handle_messages(messages)
+
+        handle_message = self._handle_message_with_metrics if metrics else self._handle_message
+        transport_options = dict(transport_options or {})
+
+        # Transports resume clients paused by the rate limit on the emulator's scheduler, so a VirtualClock controls
+        # them too.
+        transport_options.setdefault('scheduler', self.scheduler)
+
+        if recorder is not None:
+            transport_options['recorder'] = recorder
+
+        if traffic_log is not None:
+            handle_message = traffic_log.wrap(handle_message, self.encode_message)
+
+        if type(self).handle_messages is not Emulator.handle_messages:
+            # Only subclasses that handle batches themselves get the batch path, everyone else keeps the per message
+            # error handling of the transports.
+            handle_messages = self._handle_messages_with_metrics if metrics else self._handle_messages
+
+            if traffic_log is not None:
+                handle_messages = traffic_log.wrap_batch(handle_messages, self.encode_message)
+
+            transport_options['handle_messages'] = handle_messages
+
+        self.transport = transport_class(self.port, handle_message, message_parser, encoding, delimiter,
+                                         self.welcome_message, debug, **transport_options)
+
+        if metrics:
+            self.metrics = Metrics(self.transport, {'emulator': type(self).__name__, 'port': port}, self.state)
+            self.transport.metrics = self.metrics
+
+            if metrics_port is not None:
+                self.metrics_server = MetricsServer([self.metrics], metrics_port)
+
+        if control_port is not None or control_path is not None:
+            self.control_server = ControlServer(self.controller, control_port, control_path)
+
+        if handle_signals:
+            self._setup_signal_handlers()
 
         if debug:
             self.logger.setLevel(DEBUG)
@@ -29,21 +146,365 @@ class Emulator(metaclass=ABCMeta):
     def start(self):
         self.transport.start()
 
-    def shutdown(self, signum, sigframe):
+        if self.metrics is not None:
+            self.metrics.labels['port'] = self.transport.port
+
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+            self.logger.info('Serving metrics on http://localhost:%s/metrics', self.metrics_server.port)
+
+        if self.control_server is not None:
+            self.control_server.start()
+            self.logger.info('Accepting control commands on %s', self.control_server.address)
+
+    def stop(self):
+        """
+        Stops serving clients without exiting the process.
+        """
+        self.scheduler.cancel_all(self)
+        self.scheduler.cancel_all(self._state_timers)
         self.transport.shutdown()
+
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+
+        if self.control_server is not None:
+            self.control_server.shutdown()
+
+        if self.traffic_log is not None:
+            self.traffic_log.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def snapshot(self):
+        """
+        Returns a copy of the emulator's state that restore can return it to.
+        """
+        return self.state.snapshot()[1]
+
+    def checkpoint(self, name):
+        """
+        Saves a snapshot under name, see restore.
+        """
+        self.checkpoints[name] = self.snapshot()
+
+    def restore(self, snapshot, disconnect=False, broadcast=False):
+        """
+        Returns the emulator to a snapshot without restarting it, e.g. to reuse one running emulator between tests.
+        Timers started with call_later or call_every with state=True, e.g. a pending power off, are cancelled since they
+        belong to the state being discarded, as are control scripts. Other timers, e.g. a periodic one started in
+        __init__, keep running.
+
+        :param snapshot: A dict returned by snapshot, or the name of a checkpoint.
+        :param disconnect: If True close every client connection too. Optional, defaults to False.
+        :param broadcast: If True broadcast the changes to connected clients like any other change. Optional, defaults
+        to False.
+        """
+        if isinstance(snapshot, str):
+            snapshot = self.checkpoints[snapshot]
+
+        if disconnect:
+            self.transport.close_all_clients()
+
+        # The changes restore makes are queued with quiet set, see _change_context.
+        self._handling.quiet = not broadcast
+
+        try:
+            self.state.restore(snapshot)
+        finally:
+            self._handling.quiet = False
+
+        # Cancelled after restoring so timers that subscribers started in reaction to the restore go too.
+        self.scheduler.cancel_all(self._state_timers)
+        self._coalescing.clear()
+        self.controller.cancel()
+
+    def shutdown(self, signum, sigframe):
+        self.stop()
         sys.exit(0)
 
+    def call_later(self, delay, fn, *args, state=False):
+        """
+        Runs fn(*args) after delay seconds on the transport's loop, so it never races the handlers. Use this instead of
+        sleeping in a handler to emulate a device that takes time to respond.
+
+        :param state: If True the timer belongs to the current state, e.g. it finishes a change, and restore cancels it.
+        Optional, defaults to False.
+        :return: A Timer, call its cancel method to stop it.
+        """
+        owner = self._state_timers if state else self
+
+        return self.scheduler.call_later(delay, fn, *args, executor=self.transport.call_in_loop, owner=owner)
+
+    def call_every(self, interval, fn, *args, state=False):
+        """
+        Runs fn(*args) every interval seconds on the transport's loop until the emulator is stopped or the returned
+        Timer is cancelled. See call_later for state.
+        """
+        owner = self._state_timers if state else self
+
+        return self.scheduler.call_every(interval, fn, *args, executor=self.transport.call_in_loop, owner=owner)
+
     def _setup_signal_handlers(self):
         signal.signal(signal.SIGINT, self.shutdown)
         signal.signal(signal.SIGTERM, self.shutdown)
 
+    def dispatch(self, message, default=None, session=None):
+        """
+        Calls the handler of the command route that matches message, see the command decorator. Returns default if no
+        route matches. Handlers with a session parameter are passed session.
+
+        The responses of pure query routes (routes with depends) are cached already encoded as Frames, so repeating a
+        query costs a dict lookup until one of the state values it depends on changes, see self.state.
+
+        If the handler changes a state value watched with broadcast_on_change its response is broadcast, handlers
+        return (response, False) and let the state decide. Setting a value to what it already is doesn't broadcast.
+        """
+        if type(message) == bytearray:
+            message = bytes(message)
+
+        handling = self._handling
+        response = self._query_cache.get(message)
+
+        if response is not None:
+            handling.route_name = self._query_routes.get(message)
+            return response
+
+        route, match = self.router.match(message)
+
+        if route is None:
+            handling.route_name = 'unknown'
+            return default
+
+        handling.route_name = route.name
+        version = self.state.version
+        generation = self._query_generation
+        handling.active = True
+        handling.changed = False
+
+        try:
+            if route.takes_session:
+                response = route.handler(self, session=session, **match.groupdict())
+            else:
+                response = route.handler(self, **match.groupdict())
+        finally:
+            handling.active = False
+
+        if handling.changed and type(response) == tuple and response[0] is not None:
+            response = (response[0], True)
+
+        if route.depends is not None and response is not None:
+            if type(response) == tuple:
+                response = (self.encode_message(response[0]), response[1]) if response[0] is not None else response
+            else:
+                response = self.encode_message(response)
+
+            self._cache_query(message, response, route, version, generation)
+
+        return response
+
+    def _cache_query(self, message, response, route, version, generation):
+        # Under the state lock, so the check and the insert can't interleave with an invalidate of the fields.
+        with self.state.lock:
+            # Don't cache a response if the state it was built from changed while it was being built, e.g. from
+            # another thread.
+            if version != self.state.version or generation != self._query_generation:
+                return
+
+            if len(self._query_cache) >= QUERY_CACHE_SIZE:
+                self.invalidate()
+
+            self._query_cache[message] = response
+            self._query_routes[message] = route.name
+
+            for field in route.depends:
+                self._query_keys.setdefault(field, set()).add(message)
+
+    def encode_message(self, message):
+        """
+        Returns message encoded and delimited as a Frame, ready to be sent to clients as is.
+        """
+        return encode_message(message, self.encoding, self.delimiter, self.encoded_delimiter)
+
+    def invalidate(self, *fields):
+        """
+        Drops the cached responses of pure queries that depend on any of fields, or every cached response if no fields
+        are given. Changes to self.state invalidate the responses that depend on them, call this after changing anything
+        else a query depends on.
+        """
+        with self.state.lock:
+            self._query_generation += 1
+
+            if not fields:
+                self._query_cache.clear()
+                self._query_routes.clear()
+                self._query_keys.clear()
+                return
+
+            for field in fields:
+                for message in self._query_keys.pop(field, ()):
+                    self._query_cache.pop(message, None)
+                    self._query_routes.pop(message, None)
+
+    def _state_changed(self, changes, version):
+        self.invalidate(*changes)
+
+    def _change_context(self, changes):
+        """
+        Returns (quiet, active) for the thread changing the state, the context broadcast_on_change's subscribers act
+        on. They can run on another thread, the one already passing on changes, so they can't read self._handling.
+        """
+        handling = self._handling
+        quiet = getattr(handling, 'quiet', False)
+        active = getattr(handling, 'active', False)
+
+        if active and not quiet:
+            # Tell dispatch now, the broadcast subscriber may only run after the handler has returned.
+            for key in changes:
+                if self._broadcast_keys[key] and not self.coalesce.get(key):
+                    handling.changed = True
+                    break
+
+        return quiet, active
+
+    def broadcast_on_change(self, key, render):
+        """
+        Broadcasts render(value) to every client whenever the state value key changes, e.g. from a timer or another
+        thread, unless it returns None. When a handler changes it the handler's response is broadcast instead, see
+        dispatch.
+
+            self.broadcast_on_change('volume', 'VOLM {}'.format)
+
+        If key has a window in self.coalesce, e.g. a volume that is ramped with dozens of commands a second, the first
+        change starts the window and only the value at its end is broadcast to every client, or nothing if the value
+        ended up where it started. Clients that change the value still get their reply right away.
+
+        :return: A function that stops the broadcasts.
+        """
+        def broadcast(changes, version, context):
+            old, new = changes[key]
+            window = self.coalesce.get(key)
+            quiet, active = context
+
+            if quiet:
+                return
+            elif window:
+                if key not in self._coalescing:
+                    self._coalescing[key] = old
+                    self.call_later(window, flush, state=True)
+            elif not active:
+                # A handler's change is broadcast as its response, see _change_context.
+                send(new)
+
+        def flush():
+            with self.state.lock:
+                if key not in self._coalescing:
+                    # restore discarded the window after this timer was already handed to the loop.
+                    return
+
+                old = self._coalescing.pop(key)
+                new = self.state.get(key)
+
+            if new != old:
+                send(new)
+
+        def send(value):
+            message = render(value)
+
+            if message is not None:
+                self.transport.broadcast_message(message)
+
+        with self.state.lock:
+            self._broadcast_keys[key] += 1
+            unsubscribe = self.state.subscribe(broadcast, (key,), with_context=True)
+
+        stopped = False
+
+        def stop():
+            nonlocal stopped
+
+            with self.state.lock:
+                if not stopped:
+                    stopped = True
+                    self._broadcast_keys[key] -= 1
+                    unsubscribe()
+
+        return stop
+
+    def command_label(self, message, route_name=None):
+        """
+        Returns the name a message's handling time is recorded under in the metrics, the name of its command route if
+        the emulator has any. Override this to group messages differently, keep the number of distinct labels small.
+
+        :param route_name: The name of the route dispatch matched message to, if it did, so it isn't matched again.
+        """
+        if route_name is not None:
+            return route_name
+
+        if self.router.routes:
+            route, _ = self.router.match(message)
+
+            return route.name if route is not None else 'unknown'
+
+        if isinstance(message, str):
+            return message.split(' ', 1)[0]
+
+        return 'message'
+
+    def _handle_message_with_metrics(self, message, session=None):
+        handling = self._handling
+        handling.route_name = None
+        start = time.perf_counter()
+
+        try:
+            return self._handle_message(message, session)
+        finally:
+            elapsed = time.perf_counter() - start
+            route_name, handling.route_name = handling.route_name, None
+
+            try:
+                self.metrics.observe_command(self.command_label(message, route_name), elapsed)
+            except Exception:
+                # Never let recording a metric replace the handler's response or exception.
+                self.logger.exception('Error recording the handling time of %r', message)
+
+    def _handle_messages_with_metrics(self, messages, session=None):
+        start = time.perf_counter()
+
+        try:
+            return self._handle_messages(messages, session)
+        finally:
+            self.metrics.observe_command('batch', time.perf_counter() - start)
+
+    def handle_messages(self, messages, session=None) -> list:
+        """
+        Override this to handle every message parsed from a single read at once, e.g. to apply a pipelined burst of
+        commands in one pass. Return a list with one entry per response to send, each in the form handle_message
+        returns. The transport sends the responses to the client in a single write. If a subclass doesn't override this,
+        handle_message is called for every message instead. Handling time is recorded under the 'batch' command.
+
+        :param messages: The list of parsed messages.
+        :param session: The Session of the client that sent them.
+        :return: list of tuple(response, broadcast: bool)
+        """
+        return [self._handle_message(message, session) for message in messages]
+
     @abstractmethod
-    def handle_message(self, message) -> tuple:
+    def handle_message(self, message, session=None) -> tuple:
         """
         This is where you handle incoming messages from connected clients. Return a tuple of (response, broadcast). If
         broadcast is True the response  will be sent to all connected clients.
 
+        The response may be a str, bytes (sent with the delimiter appended), or a Frame (sent as is, see imitar.frames).
+        For a bytes native emulator use a message parser without an encoding and bytes patterns, messages are then
+        passed in as bytes and never decoded.
+
+        session is the Session of the client that sent the message, for per client state such as a login. Pass it on to
+        dispatch. Subclasses may leave the parameter out if they don't need it.
+
         :param message:
+        :param session: The client's Session.
         :return: tuple(response, broadcast: bool)
         """
         pass
@@ -1,93 +1,93 @@
 # Copyright 2015 jydo inc. All rights reserved.
-import sys
-from logging import StreamHandler
-from logging import getLogger
-
+from imitar.async_tcp_server import AsyncTcpServer
+from imitar.dispatch import command
 from imitar.emulator import Emulator
-from imitar.message_parser import CharacterMessageParser
+from imitar.frames import frame
+from imitar.log import get_logger, TrafficLog
+from imitar.message_parser import CursorCharacterMessageParser
+from imitar.tcp_server import TcpServer
 
 __version__ = '1.0.0'
-_logger = getLogger('extron_emulator')
-_logger.addHandler(StreamHandler(stream=sys.stdout))
+_logger = get_logger('extron_emulator')
 DELIMITER = '\r\n'
 ENCODING = 'ascii'
+# SIS commands start with an escape character, W is accepted in its place so commands can be typed in a terminal.
+ESCAPE = r'[\x1bWw]'
+
+
+def input_status(connection_state):
+    return '{} {} {} {} {} {}*{}'.format(*connection_state)
 
 
 class ExtronMps601Emulator(Emulator):
     logger = _logger
-    message_parser = CharacterMessageParser(DELIMITER, ENCODING)
-
-    def __init__(self, port, debug=False):
-        super().__init__(port, self.message_parser, debug=debug)
-        self.connection_state = [1, 1, 1, 1, 1, 1, 1]
-        self.active_input = 1
-        self.auto_switch_mode = 0
-
-    def handle_input(self, message):
-        broadcast = False
-
-        if message[0].isnumeric() and self.auto_switch_mode == 0:
-            active_input = int(message[0])
-            self.active_input = active_input
-            resp = 'In{} All'.format(active_input)
-            broadcast = True
-        elif message[0].isnumeric():
-            # Return an error if auto-switch is enabled and the user tries to switch the input.
-            resp = 'E06'
-        else:
-            resp = str(self.active_input)
+    message_parser = CursorCharacterMessageParser(DELIMITER, ENCODING)
+    E06 = frame('E06', ENCODING, DELIMITER)
+    E10 = frame('E10', ENCODING, DELIMITER)
+    E13 = frame('E13', ENCODING, DELIMITER)
+    control_methods = frozenset({'set_connection_status', 'set_input'})
 
-        return resp, broadcast
+    def __init__(self, port, debug=False, **kwargs):
+        super().__init__(port, self.message_parser, debug=debug, **kwargs)
+        self.state.update(connection_state=(1, 1, 1, 1, 1, 1, 1), active_input=1, auto_switch_mode=0)
+        self.broadcast_on_change('connection_state', lambda connection_state: 'Sig ' + input_status(connection_state))
+        self.broadcast_on_change('active_input', 'In{} All'.format)
+        self.broadcast_on_change('auto_switch_mode', 'Ausw{}'.format)
 
-    def handle_auto_switch(self, message):
-        if message[1] == 'A':
-            return str(self.auto_switch_mode), False
+    @command(r'(?P<number>\d)!', name='!')
+    @command(r'!', name='!', depends=('active_input',))
+    def handle_input(self, number=None):
+        if number is None:
+            return str(self.state['active_input']), False
 
-        setting = int(message[1])
+        with self.state.lock:
+            if self.state['auto_switch_mode'] != 0:
+                # Return an error if auto-switch is enabled and the user tries to switch the input.
+                return self.E06, False
 
-        if 0 < setting < 3:
-            self.auto_switch_mode = setting
-            resp = 'Ausw{}'.format(setting)
-            broadcast = True
-        else:
-            resp = 'E13'
-            broadcast = False
+            self.state.update(active_input=int(number))
+
+        return 'In{} All'.format(int(number)), False
+
+    @command(ESCAPE + r'(?P<setting>\d)AUSW', name='AUSW')
+    @command(ESCAPE + r'AUSW', name='AUSW', depends=('auto_switch_mode',))
+    def handle_auto_switch(self, setting=None):
+        if setting is None:
+            return str(self.state['auto_switch_mode']), False
+
+        setting = int(setting)
+
+        if not 0 < setting < 3:
+            return self.E13, False
+
+        self.state.update(auto_switch_mode=setting)
 
-        return resp, broadcast
+        return 'Ausw{}'.format(setting), False
 
+    @command(r'0LS', name='0LS', depends=('connection_state',))
     def handle_input_status(self):
-        return '{} {} {} {} {} {}*{}'.format(*self.connection_state), False
+        return input_status(self.state['connection_state']), False
 
-    def handle_verbose_mode(self, message):
-        if message[1].isnumeric():
+    @command(ESCAPE + r'(?P<mode>\d)CV', name='CV')
+    @command(ESCAPE + r'CV', name='CV')
+    def handle_verbose_mode(self, mode=None, session=None):
+        # Verbose mode is a setting of the connection rather than the device, so it is kept in the session.
+        if mode is not None:
             # TODO: This is the correct response, but the manual isn't clear on what verbose mode means. The only device
             # that I briefly had access to was in verbose mode, so this emulator essentially always assumes verbose mode
-            return 'Vrb{}'.format(message[1]), True
-        else:
-            # TODO: when we store verbose mode state return it here.
-            return '1', False
-
-    def handle_message(self, message):
-        self.logger.info('Message received: {}'.format(message))
-
-        if 'AUSW' in message:
-            resp = self.handle_auto_switch(message)
-        elif '!' in message:
-            resp = self.handle_input(message)
-        elif '0LS' in message:
-            resp = self.handle_input_status()
-        elif 'CV' in message:
-            resp = self.handle_verbose_mode(message)
-        else:
-            resp = 'E10', False
+            if session is not None:
+                session['verbose_mode'] = int(mode)
 
-        self.logger.info('Sending response: "{}"'.format(resp[0]))
+            return 'Vrb{}'.format(mode), False
+        else:
+            return str(session.get('verbose_mode', 1) if session is not None else 1), False
 
-        return resp
+    def handle_message(self, message, session=None):
+        return self.dispatch(message, (self.E10, False), session)
 
     def start(self):
         super().start()
-        self.logger.info('ExtronMps601Emulator v{} started on port {}'.format(__version__, self.port))
+        self.logger.info('ExtronMps601Emulator v%s started on port %s', __version__, self.transport.port)
 
         if self.debug:
             self.logger.debug('Debug mode enabled')
@@ -99,54 +99,54 @@ class ExtronMps601Emulator(Emulator):
         :param status: True to set as connected, False to set as disconnected
         :return: None
         """
-        self.logger.debug('Set Connection Status: {}, {}'.format(num, int(status)))
-        self.connection_state[num] = int(status)
-        input_status, _ = self.handle_input_status()
-        message = 'Sig ' + input_status
-        self.logger.debug(message)
-        self.transport.broadcast_message(message)
+        self.logger.debug('Set Connection Status: %s, %s', num, int(status))
+
+        def set_status(connection_state):
+            connection_state = list(connection_state)
+            connection_state[num] = int(status)
+
+            return tuple(connection_state)
+
+        self.state.modify('connection_state', set_status)
 
     def set_input(self, num):
-        self.active_input = num
-        self.transport.broadcast_message('In{} All'.format(self.active_input))
+        self.state.update(active_input=num)
 
 
 if __name__ == '__main__':
     import argparse
+    import time
 
     parser = argparse.ArgumentParser(description='Start a TCP server.')
     parser.add_argument('port', type=int, help='The port to bind the TCP service to.')
     parser.add_argument('--debug', action='store_true', default=False, help='Enables debug')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port at /metrics')
+    parser.add_argument('--async', dest='use_async', action='store_true', default=False,
+                        help='Serve clients from a single asyncio event loop instead of worker threads')
+    parser.add_argument('--log-traffic', action='store_true', default=False,
+                        help='Log the messages received and responses sent')
+    parser.add_argument('--traffic-log', default=None,
+                        help='Write a binary traffic log to this file, implies --log-traffic')
+    parser.add_argument('--traffic-sample-rate', type=float, default=1.0,
+                        help='The fraction of messages to log, between 0 and 1')
+    parser.add_argument('--control-port', type=int, default=None,
+                        help='Accept control commands on this localhost port, see imitar.control')
+    parser.add_argument('--control-socket', default=None, help='Accept control commands on this Unix socket instead')
     args = parser.parse_args()
-    em = ExtronMps601Emulator(args.port, debug=args.debug)
+    transport_class = AsyncTcpServer if args.use_async else TcpServer
+    traffic_log = None
+
+    if args.log_traffic or args.traffic_log:
+        traffic_log = TrafficLog('ExtronMps601Emulator', args.traffic_sample_rate, args.traffic_log, ENCODING)
+
+    em = ExtronMps601Emulator(args.port, debug=args.debug, transport_class=transport_class,
+                              metrics_port=args.metrics_port, traffic_log=traffic_log, control_port=args.control_port,
+                              control_path=args.control_socket)
     em.start()
 
-    while True:
-        # TODO: write documentation for supported commands, write help command
-        user_input = input('Enter Command:')
-        options = user_input.split(' ')
-
-        if options[0] == 'c' and (len(options) != 3 or options[1] == '?'):
-            print('The command must be in the format of "c [input or output] [connected status]"')
-            print('0-5 are input ports, 6 is the output port')
-            print('The connected status may be 0 for disconnected or 1 for connected')
-            print('Example: "c 1 0" will set the 2nd port to the disconnected status.')
-        elif options[0] == 'c':
-            # Enable or disable the input or output selected.
-            io = int(options[1])
-            status = bool(int(options[2]))
-            em.set_connection_status(io, status)
-        elif options[0] == 's' and (len(options) != 2 or options[1] == '?'):
-            print('The command must be in the format of "s [input number]"')
-            print('0-5 are valid input numbers.')
-            print('Example: "s 1" will switch the 2nd input to the output port')
-        elif options[0] == 's':
-            inpt = int(options[1])
-
-            if inpt < 1 or inpt > 6:
-                print('The switch command only accepts values 1-6')
-            else:
-                em.set_input(inpt)
-                print('Input {} is now active'.format(em.active_input))
-        else:
-            print('Unknown command "{}"'.format(options[0]))
+    try:
+        while True:
+            time.sleep(1)
+    except (Exception, KeyboardInterrupt):
+        em.shutdown(None, None)
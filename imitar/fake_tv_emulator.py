@@ -1,24 +1,17 @@
 # Copyright 2015 jydo inc. All rights reserved.
-import sys
-from logging import getLogger, StreamHandler
-from threading import Thread
-
+from imitar.async_tcp_server import AsyncTcpServer
+from imitar.dispatch import command
 from imitar.emulator import Emulator
-from imitar.message_parser import CharacterMessageParser
+from imitar.frames import frame
+from imitar.log import get_logger, TrafficLog
+from imitar.message_parser import CursorCharacterMessageParser
+from imitar.tcp_server import TcpServer
 
 __version__ = '1.0.0'
-_logger = getLogger('fake_tv_server')
-_logger.addHandler(StreamHandler(stream=sys.stdout))
+_logger = get_logger('fake_tv_server')
 DELIMITER = '\r\n'
 ENCODING = 'ascii'
-
-
-def run_later(fn, seconds):
-    def later():
-        time.sleep(seconds)
-        fn()
-
-    Thread(target=later, daemon=True).start()
+POWER_OFF_DELAY = 3
 
 
 class FakeTvEmulator(Emulator):
@@ -28,123 +21,119 @@ class FakeTvEmulator(Emulator):
     """
     welcome_message = 'FakeTvServer v{}'.format(__version__)
     logger = _logger
-    message_parser = CharacterMessageParser(DELIMITER, ENCODING)
-
-    def __init__(self, port, debug=False):
-        super().__init__(port, self.message_parser, debug=debug)
-        self.power = '0'
-        self.volume = 0
-        self.mute = '0'
-        self.input = 'HDMI_1'
+    message_parser = CursorCharacterMessageParser(DELIMITER, ENCODING)
+    ERR = frame('ERR', ENCODING, DELIMITER)
+
+    def __init__(self, port, debug=False, **kwargs):
+        super().__init__(port, self.message_parser, debug=debug, **kwargs)
+        self.state.update(power='0', volume=0, mute='0', input='HDMI_1', powering_off=False)
         self.available_inputs = {'HDMI_1', 'HDMI_2', 'VGA', 'DVI'}
-        self.powering_off = False
-        self.command_map = {
-            'POWR': self.handle_power,
-            'VOLM': self.handle_volume,
-            'MUTE': self.handle_mute,
-            'INPT': self.handle_input
-        }
+        self.broadcast_on_change('power', self.power_message)
+        self.broadcast_on_change('volume', 'VOLM {}'.format)
+        self.broadcast_on_change('mute', 'MUTE {}'.format)
+        self.broadcast_on_change('input', 'INPT {}'.format)
+        self.power_off_timer = None
+        self.state.subscribe(self.power_changed, ('power',))
+
+    @staticmethod
+    def power_message(power):
+        # Powering off is broadcast later by power_off_broadcast.
+        return 'POWR 1' if power == '1' else None
+
+    def power_changed(self, changes, version):
+        if self.power_off_timer is not None:
+            # Powered back on (or off again) before the last power off finished, it must not go on to disconnect
+            # everyone.
+            self.power_off_timer.cancel()
+            self.power_off_timer = None
+
+        if changes['power'][1] == '0':
+            # If the device changes from power on to power off, then we want to wait three seconds to emulate power off
+            # and then broadcast to all clients that the TV is powered off. Then close all connected clients via
+            # power_off_callback three seconds later.
+            self.power_off_timer = self.call_later(POWER_OFF_DELAY, self.power_off_broadcast, state=True)
+
+    def power_off_broadcast(self):
+        msg = 'POWR 0'
+        self.state.update(powering_off=True)
+        self.logger.debug('Broadcasting %s', msg)
+        self.transport.broadcast_message(msg)
+        self.power_off_timer = self.call_later(POWER_OFF_DELAY, self.power_off_callback, state=True)
 
     def power_off_callback(self):
-        self.powering_off = False
+        self.power_off_timer = None
+        self.state.update(powering_off=False)
         self.transport.close_all_clients()
 
-    def handle_power(self, value):
-        broadcast = False
-
+    @command(r'POWR \?', name='POWR', depends=('power',))
+    @command(r'POWR (?P<value>[^ ]*)', name='POWR')
+    def handle_power(self, value='?'):
         if value not in ['?', '0', '1']:
-            return 'ERR', broadcast
-
-        if value == '0' or value == '1':
-            broadcast = True
-            last_value = self.power
-            self.power = value
-
-            if last_value == '1' and value == '0':
-                # If the device changes from power on to power off, then we want to wait three seconds to emulate power
-                # off and then broadcast to all clients that the TV is powered on. Then close all connected clients via
-                # power_off_callback
-                msg = 'POWR 0'
-                time.sleep(3)
-                self.powering_off = True
-                self.logger.debug('Broadcasting {}'.format(msg))
-                self.transport.broadcast_message(msg)
-                run_later(self.power_off_callback, 3)
-
-                return None, False
-
-        return 'POWR {}'.format(self.power), broadcast
+            return self.ERR, False
 
-    def handle_volume(self, value):
-        broadcast = False
+        if value == '?':
+            return 'POWR {}'.format(self.state['power']), False
 
-        if value != '?':
-            broadcast = True
+        if self.state.update(power=value) and value == '0':
+            # Powering off is only broadcast once the TV is off, see power_changed.
+            return None, False
 
-            try:
-                value = int(value, 10)
-            except ValueError:
-                return 'ERR', False
+        return 'POWR {}'.format(value), False
 
-            if value < 0 or value > 100:
-                return 'ERR', False
+    @command(r'VOLM \?', name='VOLM', depends=('volume',))
+    @command(r'VOLM (?P<value>[^ ]*)', name='VOLM')
+    def handle_volume(self, value='?'):
+        if value == '?':
+            return 'VOLM {}'.format(self.state['volume']), False
 
-            self.volume = value
+        try:
+            value = int(value, 10)
+        except ValueError:
+            return self.ERR, False
 
-        return 'VOLM {}'.format(self.volume), broadcast
+        if value < 0 or value > 100:
+            return self.ERR, False
 
-    def handle_mute(self, value):
-        broadcast = False
+        self.state.update(volume=value)
 
-        if value != '?':
-            broadcast = True
+        return 'VOLM {}'.format(value), False
 
-            if value == '0' or value == '1':
-                self.mute = value
-            else:
-                return 'ERR', False
+    @command(r'MUTE \?', name='MUTE', depends=('mute',))
+    @command(r'MUTE (?P<value>[^ ]*)', name='MUTE')
+    def handle_mute(self, value='?'):
+        if value == '?':
+            return 'MUTE {}'.format(self.state['mute']), False
 
-        return 'MUTE {}'.format(self.mute), broadcast
+        if value != '0' and value != '1':
+            return self.ERR, False
 
-    def handle_input(self, value):
-        broadcast = False
+        self.state.update(mute=value)
 
-        if value != '?':
-            broadcast = True
+        return 'MUTE {}'.format(value), False
 
-            if value not in self.available_inputs:
-                return 'ERR', False
+    @command(r'INPT \?', name='INPT', depends=('input',))
+    @command(r'INPT (?P<value>[^ ]*)', name='INPT')
+    def handle_input(self, value='?'):
+        if value == '?':
+            return 'INPT {}'.format(self.state['input']), False
 
-            self.input = value
+        if value not in self.available_inputs:
+            return self.ERR, False
 
-        return 'INPT {}'.format(self.input), broadcast
+        self.state.update(input=value)
 
-    def handle_message(self, message):
-        self.logger.info('Message received: "{}"'.format(message))
+        return 'INPT {}'.format(value), False
 
-        if self.powering_off:
+    def handle_message(self, message, session=None):
+        if self.state['powering_off']:
             # Discard all incoming messages until after 3 seconds after power on.
             return None
 
-        try:
-            cmd, value = message.split(' ')
-        except ValueError:
-            cmd = message
-            value = ''
-
-        handler = self.command_map.get(cmd)
-        resp = ('ERR', False)
-
-        if handler is not None:
-            resp = self.command_map[cmd](value)
-
-        self.logger.info('Sending response: "{}"'.format(resp[0]))
-
-        return resp
+        return self.dispatch(message, (self.ERR, False), session)
 
     def start(self):
         super().start()
-        self.logger.info('FakeTvServer v{} started on port {}'.format(__version__, self.port))
+        self.logger.info('FakeTvServer v%s started on port %s', __version__, self.transport.port)
 
         if self.debug:
             self.logger.debug('Debug mode enabled')
@@ -157,8 +146,28 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start a TCP server.')
     parser.add_argument('port', type=int, help='The port to bind the TCP service to.')
     parser.add_argument('--debug', action='store_true', default=False, help='Enables debug')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port at /metrics')
+    parser.add_argument('--async', dest='use_async', action='store_true', default=False,
+                        help='Serve clients from a single asyncio event loop instead of worker threads')
+    parser.add_argument('--log-traffic', action='store_true', default=False,
+                        help='Log the messages received and responses sent')
+    parser.add_argument('--traffic-log', default=None,
+                        help='Write a binary traffic log to this file, implies --log-traffic')
+    parser.add_argument('--traffic-sample-rate', type=float, default=1.0,
+                        help='The fraction of messages to log, between 0 and 1')
+    parser.add_argument('--coalesce-volume', type=float, default=None,
+                        help='Broadcast volume changes at most once per this many seconds')
     args = parser.parse_args()
-    tv = FakeTvEmulator(args.port, debug=args.debug)
+    transport_class = AsyncTcpServer if args.use_async else TcpServer
+    traffic_log = None
+
+    if args.log_traffic or args.traffic_log:
+        traffic_log = TrafficLog('FakeTvEmulator', args.traffic_sample_rate, args.traffic_log, ENCODING)
+
+    coalesce = {'volume': args.coalesce_volume} if args.coalesce_volume else None
+    tv = FakeTvEmulator(args.port, debug=args.debug, transport_class=transport_class,
+                        metrics_port=args.metrics_port, traffic_log=traffic_log, coalesce=coalesce)
     tv.start()
 
     try:
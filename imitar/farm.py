@@ -0,0 +1,299 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from logging import DEBUG, INFO
+from multiprocessing.connection import wait
+
+from .host import EmulatorHost, expand_config
+from .log import get_logger
+from .metrics import MetricsServer
+
+logger = get_logger('emulator_farm')
+SHARD = 'shard'
+REUSE_PORT = 'reuseport'
+MODES = (SHARD, REUSE_PORT)
+
+
+def collect_host(host):
+    """
+    Returns a picklable summary of the metrics of every emulator in an EmulatorHost.
+    """
+    emulators = []
+
+    for emulator in host.emulators:
+        metrics = emulator.metrics
+        emulators.append({
+            'labels': dict(metrics.labels),
+            'counters': metrics.counters(),
+            'gauges': emulator.transport.gauges(),
+            'families': list(metrics.collect()),
+        })
+
+    return emulators
+
+
+def run_worker(index, entries, conn, stats_interval, debug):
+    """
+    The entry point of a worker process. Runs the given emulators in an EmulatorHost and reports their metrics to the
+    supervisor every stats_interval seconds until it receives SIGTERM.
+    """
+    stopped = threading.Event()
+    # The supervisor decides when workers stop, don't die along with it on a ctrl-c in the terminal.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, sigframe: stopped.set())
+    host = EmulatorHost(debug=debug, metrics=True)
+
+    for emulator_class, port, state, options in entries:
+        host.add(emulator_class, port, state, **options)
+
+    host.start()
+
+    try:
+        while True:
+            conn.send(collect_host(host))
+
+            if stopped.wait(stats_interval):
+                break
+    except (BrokenPipeError, EOFError):
+        # The supervisor went away.
+        pass
+    finally:
+        host.shutdown()
+
+
+class Worker:
+    """
+    The supervisor's view of a worker process.
+    """
+    def __init__(self, index, entries):
+        self.index = index
+        self.entries = entries
+        self.process = None
+        self.conn = None
+        self.stats = []
+        self.restarts = 0
+        self.restart_at = None
+
+
+class EmulatorFarm:
+    """
+    Spreads emulators across several worker processes so parsing and handlers can use more than one core. Each worker
+    runs an EmulatorHost, and a supervisor thread in this process restarts workers that die and collects their metrics.
+
+    There are two modes:
+        shard: The emulators in the config are dealt out round robin, every emulator runs in exactly one worker.
+        reuseport: Every worker runs every emulator, listening with SO_REUSEPORT so the OS spreads connections over
+                   the workers. Each worker has its own copy of the device state and broadcasts only reach clients of
+                   the same worker, so this is only suitable for stateless or read-mostly emulators. Ports can't be 0
+                   in this mode.
+
+    Counters restart from zero when a worker is restarted.
+    """
+    def __init__(self, config, workers=None, mode=SHARD, stats_interval=1.0, restart_delay=1.0, metrics_port=None,
+                 debug=False):
+        """
+        :param config: A host config, either a path to a JSON file or a loaded dict. See EmulatorHost.
+        :param workers: The number of worker processes. Optional, defaults to the number of CPUs.
+        :param mode: shard or reuseport. Optional, defaults to shard.
+        :param stats_interval: Seconds between metrics reports from the workers. Optional, defaults to 1.
+        :param restart_delay: Seconds to wait before restarting a worker that died. Optional, defaults to 1.
+        :param metrics_port: If set, serve the metrics of every worker from one Prometheus endpoint on this port.
+        Optional.
+        :param debug: Enables debug logging for the supervisor and workers. Optional.
+        """
+        if mode not in MODES:
+            raise ValueError('mode must be one of {}'.format(', '.join(MODES)))
+
+        if isinstance(config, str):
+            with open(config) as f:
+                config = json.load(f)
+
+        self.mode = mode
+        self.stats_interval = stats_interval
+        self.restart_delay = restart_delay
+        self.debug = debug
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = [Worker(index, entries)
+                        for index, entries in enumerate(self._assign(expand_config(config), workers or os.cpu_count()))]
+        self.metrics_server = MetricsServer([self], metrics_port) if metrics_port is not None else None
+        self.monitor_thread = threading.Thread(target=self.monitor_loop, daemon=True)
+        self._wakeup_reader, self._wakeup_writer = self.context.Pipe(duplex=False)
+        self._stopping = False
+
+        if self.debug:
+            logger.setLevel(DEBUG)
+        else:
+            logger.setLevel(INFO)
+
+    def _assign(self, entries, count):
+        if self.mode == SHARD:
+            return [entries[i::count] for i in range(count) if entries[i::count]]
+
+        assigned = []
+
+        for emulator_class, port, state, options in entries:
+            if not port:
+                raise ValueError('Every emulator needs a fixed port in reuseport mode')
+
+            options = dict(options, transport_options=dict(options.get('transport_options', {}), reuse_port=True))
+            assigned.append((emulator_class, port, state, options))
+
+        return [assigned] * count
+
+    def spawn(self, worker):
+        parent_conn, child_conn = self.context.Pipe(duplex=False)
+        worker.process = self.context.Process(target=run_worker, daemon=True,
+                                              args=(worker.index, worker.entries, child_conn, self.stats_interval,
+                                                    self.debug))
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.restart_at = None
+        logger.debug('Started worker %s (pid %s)', worker.index, worker.process.pid)
+
+    def on_worker_exit(self, worker):
+        worker.process.join()
+        worker.conn.close()
+        worker.conn = None
+
+        if self._stopping:
+            return
+
+        logger.error('Worker %s (pid %s) exited with code %s, restarting in %ss', worker.index, worker.process.pid,
+                     worker.process.exitcode, self.restart_delay)
+        worker.restarts += 1
+        worker.stats = []
+        worker.restart_at = time.monotonic() + self.restart_delay
+
+    def monitor_loop(self):
+        while not self._stopping:
+            waitables = {self._wakeup_reader: None}
+
+            for worker in self.workers:
+                if worker.conn is not None:
+                    waitables[worker.process.sentinel] = worker
+                    waitables[worker.conn] = worker
+
+            pending = [worker.restart_at for worker in self.workers if worker.restart_at is not None]
+            timeout = max(0, min(pending) - time.monotonic()) if pending else None
+
+            for ready in wait(list(waitables), timeout):
+                worker = waitables[ready]
+
+                if worker is None or worker.conn is None:
+                    continue
+                elif ready is worker.conn:
+                    try:
+                        worker.stats = worker.conn.recv()
+                    except (EOFError, OSError):
+                        # The worker is exiting, its sentinel will tell us.
+                        pass
+                else:
+                    self.on_worker_exit(worker)
+
+            for worker in self.workers:
+                if worker.restart_at is not None and worker.restart_at <= time.monotonic() and not self._stopping:
+                    self.spawn(worker)
+
+    def start(self):
+        for worker in self.workers:
+            self.spawn(worker)
+
+        self.monitor_thread.start()
+
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+            logger.info('Serving metrics on http://localhost:%s/metrics', self.metrics_server.port)
+
+        logger.info('EmulatorFarm started %s workers in %s mode', len(self.workers), self.mode)
+
+    def shutdown(self, timeout=5):
+        self._stopping = True
+        self._wakeup_writer.send(None)
+        self.monitor_thread.join()
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join()
+
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+
+    def stats(self):
+        """
+        Returns the counters summed over every worker along with each worker's own metrics.
+        """
+        totals = {}
+        workers = []
+
+        for worker in self.workers:
+            emulators = worker.stats
+
+            for emulator in emulators:
+                for name, value in emulator['counters'].items():
+                    totals[name] = totals.get(name, 0) + value
+
+            workers.append({
+                'index': worker.index,
+                'pid': worker.process.pid if worker.process is not None else None,
+                'alive': worker.process is not None and worker.process.is_alive(),
+                'restarts': worker.restarts,
+                'emulators': [{'labels': emulator['labels'], 'counters': emulator['counters'],
+                               'gauges': emulator['gauges']} for emulator in emulators],
+            })
+
+        return {
+            'counters': totals,
+            'restarts': sum(worker.restarts for worker in self.workers),
+            'workers': workers,
+        }
+
+    def collect(self):
+        """
+        Yields the last metrics reported by every worker with a worker label added, so the farm can be rendered by
+        render_prometheus like any other collector.
+        """
+        for worker in self.workers:
+            for emulator in worker.stats:
+                for name, kind, help_text, samples in emulator['families']:
+                    yield name, kind, help_text, [(OrderedDict(labels, worker=worker.index), value)
+                                                  for labels, value in samples]
+
+        yield ('imitar_worker_restarts_total', 'counter', 'Worker processes restarted by the supervisor',
+               [(OrderedDict(worker=worker.index), worker.restarts) for worker in self.workers])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run emulators across several worker processes.')
+    parser.add_argument('config', help='A JSON file listing the emulators to run, see EmulatorHost')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, defaults to CPU count')
+    parser.add_argument('--mode', choices=MODES, default=SHARD, help='How emulators are spread over the workers')
+    parser.add_argument('--debug', action='store_true', default=False, help='Enables debug')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics for every worker on this port at /metrics')
+    args = parser.parse_args()
+    farm = EmulatorFarm(args.config, args.workers, args.mode, metrics_port=args.metrics_port, debug=args.debug)
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, sigframe: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, sigframe: stopped.set())
+    farm.start()
+
+    while not stopped.wait(1):
+        pass
+
+    farm.shutdown()
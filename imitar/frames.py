@@ -0,0 +1,49 @@
+# Copyright 2015 jydo inc. All rights reserved.
+
+
+class Frame(bytes):
+    """
+    A message that has already been encoded and delimited, transports write it to clients as is. Handlers can return
+    a Frame instead of a str to skip encoding, build constant replies once when the class is defined:
+
+        class MyEmulator(Emulator):
+            ERR = frame('ERR', ENCODING, DELIMITER)
+
+    Transports turn every response into a Frame before sending it, so a broadcast is encoded once and the same bytes
+    are queued for every client.
+    """
+    __slots__ = ()
+
+
+def encode_delimiter(delimiter, encoding):
+    if not delimiter:
+        return b''
+
+    if isinstance(delimiter, (bytes, bytearray)):
+        return bytes(delimiter)
+
+    return delimiter.encode(encoding or 'ascii')
+
+
+def frame(message, encoding='ascii', delimiter='\r\n'):
+    """
+    Returns message (str or bytes) encoded and delimited as a Frame.
+    """
+    return encode_message(message, encoding, delimiter, encode_delimiter(delimiter, encoding))
+
+
+def encode_message(message, encoding, delimiter, encoded_delimiter):
+    """
+    Returns message as a Frame. Frames are returned as they are, bytes only get the delimiter appended, and a str is
+    encoded along with its delimiter in one step.
+    """
+    if isinstance(message, Frame):
+        return message
+
+    if isinstance(message, str):
+        if isinstance(delimiter, str):
+            return Frame(message + delimiter, encoding or 'ascii')
+
+        message = message.encode(encoding or 'ascii')
+
+    return Frame(message + encoded_delimiter)
@@ -0,0 +1,181 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import asyncio
+import functools
+import importlib
+import json
+import signal
+import threading
+from logging import DEBUG, INFO
+
+from .async_tcp_server import AsyncTcpServer
+from .log import get_logger
+from .metrics import MetricsServer
+
+logger = get_logger('emulator_host')
+
+
+def load_class(path):
+    """
+    Imports a class from a dotted path, e.g. imitar.fake_tv_emulator.FakeTvEmulator.
+    """
+    module_name, _, class_name = path.rpartition('.')
+
+    if not module_name:
+        raise ValueError('Expected a dotted path to a class, got "{}"'.format(path))
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def expand_config(config):
+    """
+    Returns a list of (class path, port, state, options) for every emulator in a host config, with count expanded to
+    one entry per emulator.
+    """
+    emulators = []
+
+    for entry in config.get('emulators', []):
+        port = entry['port']
+
+        for i in range(entry.get('count', 1)):
+            # Port 0 lets the OS choose a port for every emulator.
+            emulators.append((entry['class'], port + i if port else 0, entry.get('state'), entry.get('options', {})))
+
+    return emulators
+
+
+class EmulatorHost:
+    """
+    Runs many emulators in a single process. Every emulator listens on its own port, but they all share one event loop
+    thread through AsyncTcpServer, so an emulator costs a listening socket and some objects rather than a handful of
+    threads. This makes it cheap to bring up a whole building or campus worth of devices.
+
+    Emulators can be added in code with add, or from a JSON config file with load_config:
+
+        {
+            "emulators": [
+                {"class": "imitar.fake_tv_emulator.FakeTvEmulator", "port": 5000, "count": 300,
+                 "state": {"volume": 20}},
+                {"class": "imitar.extron_mps_601_emulator.ExtronMps601Emulator", "port": 6000, "count": 40,
+                 "options": {"debug": false}}
+            ]
+        }
+
+    count starts that many emulators on consecutive ports, state updates each emulator's state before it starts,
+    and options are passed to the emulator's constructor.
+    """
+    def __init__(self, debug=False, metrics=False, metrics_port=None):
+        """
+        :param debug: Enables debug logging for the host and, unless overridden, every emulator. Optional.
+        :param metrics: If True record metrics for every emulator. Optional, defaults to False.
+        :param metrics_port: If set, serve the metrics of every emulator from one Prometheus endpoint on this port,
+        implies metrics=True. Optional.
+        """
+        self.debug = debug
+        self.metrics = metrics or metrics_port is not None
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=False)
+        self.emulators = []
+        self.metrics_server = None
+        self.started = False
+
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer([], metrics_port)
+
+        if self.debug:
+            logger.setLevel(DEBUG)
+        else:
+            logger.setLevel(INFO)
+
+    def add(self, emulator_class, port, state=None, **kwargs):
+        """
+        Creates an emulator that runs on the host's event loop, it is started right away if the host already is.
+
+        :param emulator_class: An Emulator subclass, or the dotted path to one.
+        :param port: The port to listen on, 0 picks a free port.
+        :param state: A dict of values to update the emulator's state with before it starts. Optional.
+        :param kwargs: Passed to the emulator's constructor.
+        :return: The emulator.
+        """
+        if isinstance(emulator_class, str):
+            emulator_class = load_class(emulator_class)
+
+        kwargs.setdefault('debug', self.debug)
+        kwargs.setdefault('metrics', self.metrics)
+        transport_class = functools.partial(AsyncTcpServer, loop=self.loop)
+        emulator = emulator_class(port, transport_class=transport_class, handle_signals=False, **kwargs)
+
+        if state:
+            emulator.state.update(state)
+
+        self.emulators.append(emulator)
+
+        if self.metrics_server is not None and emulator.metrics is not None:
+            self.metrics_server.collectors.append(emulator.metrics)
+
+        if self.started:
+            emulator.start()
+
+        return emulator
+
+    def load_config(self, config):
+        """
+        Adds every emulator listed in a config, see the class docstring for the format.
+
+        :param config: A path to a JSON file, or an already loaded dict.
+        :return: A list of the emulators that were added.
+        """
+        if isinstance(config, str):
+            with open(config) as f:
+                config = json.load(f)
+
+        return [self.add(emulator_class, port, state, **options)
+                for emulator_class, port, state, options in expand_config(config)]
+
+    def start(self):
+        self.loop_thread.start()
+        self.started = True
+
+        for emulator in self.emulators:
+            emulator.start()
+
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+            logger.info('Serving metrics on http://localhost:%s/metrics', self.metrics_server.port)
+
+        logger.info('EmulatorHost started %s emulators', len(self.emulators))
+
+    def shutdown(self):
+        for emulator in self.emulators:
+            emulator.stop()
+
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+
+        if self.started:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+
+        self.loop.close()
+        self.started = False
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run many emulators in one process.')
+    parser.add_argument('config', help='A JSON file listing the emulators to run')
+    parser.add_argument('--debug', action='store_true', default=False, help='Enables debug')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics for every emulator on this port at /metrics')
+    args = parser.parse_args()
+    host = EmulatorHost(debug=args.debug, metrics_port=args.metrics_port)
+    host.load_config(args.config)
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, sigframe: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, sigframe: stopped.set())
+    host.start()
+
+    while not stopped.wait(1):
+        pass
+
+    host.shutdown()
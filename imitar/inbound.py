@@ -0,0 +1,126 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import time
+
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+PAUSE = 'pause'
+BUFFER_POLICIES = (DROP, DISCONNECT)
+RATE_POLICIES = (DROP, DISCONNECT, PAUSE)
+
+
+class InboundLimiter:
+    __slots__ = ('buffer_limit', 'buffer_policy', 'rate_limit', 'rate_burst', 'rate_policy', 'stats', 'clock', 'tokens',
+                 'updated')
+
+    def __init__(self, buffer_limit=65536, buffer_policy=DROP, rate_limit=None, rate_burst=None, rate_policy=PAUSE,
+                 stats=None, clock=time.monotonic):
+        """
+        Protects a transport from a single client sending more than it should. Transports keep one per connection and
+        check every read against it, so a flood or a client that never sends a delimiter can't grow memory without
+        bound.
+
+        buffer_limit caps the bytes received but not yet parsed into a message. What happens when it is passed depends
+        on the buffer policy:
+            drop: The unparsed bytes are discarded, parsing starts over with the next read.
+            disconnect: The client is disconnected.
+
+        rate_limit caps the messages a client may send per second, allowing bursts of up to rate_burst messages. What
+        happens to messages over the limit depends on the rate policy:
+            drop: They are discarded without a response.
+            disconnect: The client is disconnected once the messages within the limit are handled.
+            pause: They are handled, then reading from the client stops until the limit allows them, see resume_delay.
+                   This pushes back on the client like a slow device would.
+
+        :param buffer_limit: The most unparsed bytes to hold for the client, None for no limit. Optional, defaults to
+        64KiB.
+        :param buffer_policy: drop or disconnect. Optional, defaults to drop.
+        :param rate_limit: Messages per second, None for no limit. Optional.
+        :param rate_burst: The most messages allowed at once. Optional, defaults to rate_limit.
+        :param rate_policy: drop, disconnect, or pause. Optional, defaults to pause.
+        :param stats: A dict shared by every limiter of a transport to count actions in. Optional.
+        :param clock: Returns the current time in seconds, e.g. a Scheduler's time. Optional, defaults to
+        time.monotonic.
+        """
+        if buffer_policy not in BUFFER_POLICIES:
+            raise ValueError('buffer_policy must be one of {}'.format(', '.join(BUFFER_POLICIES)))
+
+        if rate_policy not in RATE_POLICIES:
+            raise ValueError('rate_policy must be one of {}'.format(', '.join(RATE_POLICIES)))
+
+        self.buffer_limit = buffer_limit
+        self.buffer_policy = buffer_policy
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst or rate_limit
+        self.rate_policy = rate_policy
+        self.stats = stats if stats is not None else new_inbound_stats()
+        self.clock = clock
+        self.tokens = self.rate_burst
+        self.updated = clock()
+
+    def check_buffer(self, buffer):
+        """
+        Checks the buffer a read was parsed from against buffer_limit.
+
+        :return: None if the buffer is within the limit, otherwise the policy the transport should apply, drop (replace
+        the buffer with a new one) or disconnect.
+        """
+        if self.buffer_limit is None:
+            return None
+
+        pending = buffer.pending if hasattr(buffer, 'pending') else len(buffer)
+
+        if pending <= self.buffer_limit:
+            return None
+
+        self.stats['buffer_' + ('dropped' if self.buffer_policy == DROP else 'disconnected')] += 1
+
+        return self.buffer_policy
+
+    def admit(self, messages):
+        """
+        Applies the rate limit to the messages parsed from a read.
+
+        :return: (messages, action), the messages the transport should handle and None if they are all within the
+        limit, otherwise the policy the transport should apply after handling them.
+        """
+        if self.rate_limit is None:
+            return messages, None
+
+        now = self.clock()
+        self.tokens = min(self.rate_burst, self.tokens + (now - self.updated) * self.rate_limit)
+        self.updated = now
+
+        if len(messages) <= self.tokens:
+            self.tokens -= len(messages)
+            return messages, None
+
+        allowed = max(0, int(self.tokens))
+
+        if self.rate_policy == PAUSE:
+            # Go into debt for the whole read, reading resumes once it is paid off.
+            self.tokens -= len(messages)
+            self.stats['rate_paused'] += 1
+            return messages, PAUSE
+
+        self.tokens -= allowed
+
+        if self.rate_policy == DROP:
+            self.stats['rate_dropped'] += len(messages) - allowed
+            return messages[:allowed], DROP
+
+        self.stats['rate_disconnected'] += 1
+
+        return messages[:allowed], DISCONNECT
+
+    def resume_delay(self):
+        """
+        Returns how many seconds a paused client must wait before it is back within the rate limit.
+        """
+        if self.rate_limit is None or self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / self.rate_limit
+
+
+def new_inbound_stats():
+    return {'buffer_dropped': 0, 'buffer_disconnected': 0, 'rate_dropped': 0, 'rate_disconnected': 0, 'rate_paused': 0}
@@ -0,0 +1,204 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import atexit
+import queue
+import struct
+import sys
+import threading
+import time
+from logging import getLogger, StreamHandler, INFO
+from logging.handlers import QueueHandler, QueueListener
+
+# A binary traffic log is a sequence of records, each a header followed by the message bytes.
+TRAFFIC_RECORD = struct.Struct('<dBI')
+RECEIVED = 0
+SENT = 1
+_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Hands records to the background writer as they are. The stock QueueHandler formats the message on the logging
+    thread so records can be pickled, here they never leave the process, so formatting is left to the writer thread.
+    Pass immutable arguments, a bytearray that is changed after the call would be logged as it is when written.
+    """
+    def prepare(self, record):
+        return record
+
+
+def _start_listener():
+    global _listener
+
+    with _listener_lock:
+        if _listener is None:
+            _listener = QueueListener(_queue, StreamHandler(stream=sys.stdout))
+            _listener.start()
+            atexit.register(_listener.stop)
+
+
+def get_logger(name):
+    """
+    Returns the named logger, writing to stdout from a background thread so logging never blocks the I/O loop on the
+    terminal. Log with arguments rather than formatting the message yourself, e.g. logger.debug('Sent %r', data), so
+    nothing is formatted for records that are filtered out and the rest is formatted on the writer thread.
+    """
+    logger = getLogger(name)
+
+    if not any(isinstance(handler, LazyQueueHandler) for handler in logger.handlers):
+        _start_listener()
+        logger.addHandler(LazyQueueHandler(_queue))
+
+    return logger
+
+
+class BackgroundWriter:
+    """
+    Appends bytes to a file from a background thread. write only queues the data, the thread writes everything that
+    has queued up since its last write in one go.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        self.queue.put(data)
+
+    def _run(self):
+        while True:
+            chunks = [self.queue.get()]
+
+            while True:
+                try:
+                    chunks.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = chunks[-1] is None
+            self.file.write(b''.join(chunk for chunk in chunks if chunk is not None))
+            self.file.flush()
+
+            if closing:
+                self.file.close()
+                return
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class TrafficLog:
+    """
+    Logs the messages an emulator receives and the responses it sends. Pass one to an Emulator as traffic_log.
+
+    In text mode exchanges are logged to the traffic.<name> logger at info level. In binary mode they are appended to
+    path as TRAFFIC_RECORD headers (time.time(), RECEIVED or SENT, length) followed by the message, encoded with
+    encoding if it is a str, which is much cheaper to write than text. Messages are logged as they were parsed, without
+    their delimiter, and responses as they are sent, with it. Either way the work is done by a background thread, see
+    read_traffic_log to read a binary log back.
+
+    With a sample_rate below 1 only that fraction of exchanges is logged, spread evenly, e.g. 0.01 logs every 100th
+    message and its response and 0.7 logs 7 of every 10, which keeps traffic visible on a busy emulator without slowing
+    it down.
+    """
+    def __init__(self, name='emulator', sample_rate=1.0, path=None, encoding='ascii'):
+        """
+        :param name: Identifies the emulator in text logs.
+        :param sample_rate: The fraction of exchanges to log, between 0 and 1. Optional, defaults to 1.
+        :param path: Write a binary traffic log to this file instead of logging text. Optional.
+        :param encoding: Used to encode str messages in binary mode. Optional, defaults to ascii.
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError('sample_rate must be greater than 0 and at most 1')
+
+        self.name = name
+        self.sample_rate = sample_rate
+        self.encoding = encoding
+        self.count = 0
+        self.writer = BackgroundWriter(path) if path is not None else None
+        self.logger = get_logger('traffic.{}'.format(name))
+        self.logger.setLevel(INFO)
+
+    def sampled(self):
+        self.count += 1
+
+        # Log whenever count * sample_rate reaches the next whole number, exact for any rate rather than just 1 / N.
+        return int(self.count * self.sample_rate) != int((self.count - 1) * self.sample_rate)
+
+    def log(self, direction, message):
+        if self.writer is not None:
+            data = message.encode(self.encoding) if isinstance(message, str) else bytes(message)
+            self.writer.write(TRAFFIC_RECORD.pack(time.time(), direction, len(data)) + data)
+        else:
+            self.logger.info('%s %s %r', self.name, '<' if direction == RECEIVED else '>', message)
+
+    def log_response(self, response, encode=None):
+        if type(response) == tuple:
+            response = response[0]
+
+        if response is not None:
+            if self.writer is not None and encode is not None:
+                response = encode(response)
+
+            self.log(SENT, response)
+
+    def wrap(self, handle_message, encode=None):
+        """
+        Returns handle_message with its messages and responses logged.
+
+        :param encode: Returns a response as the Frame sent to clients, e.g. Emulator.encode_message, so binary logs
+        record str responses with their delimiter like Frames. Optional.
+        """
+        def handle_message_with_traffic_log(message, session=None):
+            if not self.sampled():
+                return handle_message(message, session)
+
+            self.log(RECEIVED, message)
+            response = handle_message(message, session)
+            self.log_response(response, encode)
+
+            return response
+
+        return handle_message_with_traffic_log
+
+    def wrap_batch(self, handle_messages, encode=None):
+        """
+        Returns handle_messages with its messages and responses logged, a batch is sampled as a whole. See wrap.
+        """
+        def handle_messages_with_traffic_log(messages, session=None):
+            if not self.sampled():
+                return handle_messages(messages, session)
+
+            for message in messages:
+                self.log(RECEIVED, message)
+
+            responses = handle_messages(messages, session)
+
+            for response in responses:
+                self.log_response(response, encode)
+
+            return responses
+
+        return handle_messages_with_traffic_log
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def read_traffic_log(path):
+    """
+    Yields (timestamp, direction, data) for every record in a binary traffic log.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    offset = 0
+
+    while offset + TRAFFIC_RECORD.size <= len(data):
+        timestamp, direction, length = TRAFFIC_RECORD.unpack_from(data, offset)
+        offset += TRAFFIC_RECORD.size
+        yield timestamp, direction, data[offset:offset + length]
+        offset += length
@@ -0,0 +1,270 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import threading
+from collections import deque
+
+from .frames import encode_delimiter, encode_message
+from .inbound import InboundLimiter, DISCONNECT, DROP, PAUSE, new_inbound_stats
+from .metrics import new_transport_stats
+from .outbound import new_outbound_stats
+from .recording import RECEIVED, SENT
+from .scheduler import default_scheduler
+from .session import Session
+from .tcp_server import ClientDisconnectedError
+
+
+class LoopbackClient(Session):
+    """
+    The client end of a LoopbackTransport connection. Sending runs the emulator's handlers synchronously on the calling
+    thread, so by the time send returns every response and broadcast it caused is waiting to be read. It is also the
+    Session passed to handle_message.
+    """
+    __slots__ = ('transport', 'inbox', 'limiter', 'held', 'rate_paused', 'closed', 'connection_id')
+
+    def __init__(self, transport):
+        super().__init__('loopback', transport.message_parser.new_buffer())
+        self.transport = transport
+        self.inbox = deque()
+        self.limiter = transport.new_inbound_limiter()
+        # What the client sends while reading from it is paused by the rate limit.
+        self.held = bytearray()
+        self.rate_paused = False
+        self.closed = False
+        self.connection_id = transport.recorder.open() if transport.recorder is not None else None
+
+    def send(self, data):
+        """
+        Sends raw bytes to the emulator, exactly as if they were received from a socket.
+        """
+        if self.closed:
+            raise ClientDisconnectedError('Loopback client is closed')
+
+        self.transport.receive_data(self, data)
+
+    def send_message(self, message):
+        """
+        Encodes message and appends the delimiter before sending it.
+        """
+        self.send(self.transport.encode_message(message))
+
+    def deliver(self, data):
+        if not self.closed:
+            if self.transport.recorder is not None:
+                self.transport.recorder.record(self.connection_id, SENT, data)
+
+            self.inbox.append(data)
+
+    def read(self):
+        """
+        Returns the next message sent to this client with its delimiter removed and decoded if the transport has an
+        encoding, or None if there is nothing to read.
+        """
+        if not self.inbox:
+            return None
+
+        data = self.inbox.popleft()
+        delimiter = self.transport.encoded_delimiter
+
+        if delimiter and data.endswith(delimiter):
+            data = data[:-len(delimiter)]
+
+        if self.transport.encoding:
+            return data.decode(self.transport.encoding)
+
+        return data
+
+    def read_all(self):
+        """
+        Returns every message waiting to be read, see read.
+        """
+        messages = []
+
+        while self.inbox:
+            messages.append(self.read())
+
+        return messages
+
+    def close(self):
+        self.transport.remove_client(self)
+
+
+class LoopbackTransport:
+    """
+    An in process transport for tests. It has the same parsing, welcome message, response, and broadcast behavior as
+    the TcpServer, but there are no sockets or threads involved: clients are created with connect and everything
+    happens synchronously on the thread that sends a message. Unlike the TcpServer, exceptions raised by handlers are
+    not logged and swallowed, they propagate to the sender so tests see them.
+
+        tv = FakeTvEmulator(0, transport_class=LoopbackTransport)
+        tv.start()
+        client = tv.transport.connect()
+        client.send_message('VOLM 10')
+        assert client.read_all() == ['FakeTvServer v1.0.0', 'VOLM 10']
+    """
+    def __init__(self, port, handle_message, message_parser, encoding='ascii', delimiter='\r\n', welcome_message=None,
+                 debug=False, handle_messages=None, recorder=None, buffer_limit=65536, buffer_policy=DROP,
+                 rate_limit=None, rate_burst=None, rate_policy=PAUSE, scheduler=None):
+        """
+        The inbound limits are the same as the TcpServer's. While a client is paused by the rate limit what it sends is
+        held until the scheduler resumes it, pass a Scheduler with a VirtualClock to control when.
+        """
+        self.port = port
+        self.handle_message = handle_message
+        self.handle_messages = handle_messages
+        self.recorder = recorder
+        self.message_parser = message_parser
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.welcome_message = welcome_message
+        self.debug = debug
+        self.clients = []
+        self.buffer_limit = buffer_limit
+        self.buffer_policy = buffer_policy
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.rate_policy = rate_policy
+        self.scheduler = scheduler or default_scheduler()
+        self.stats = new_transport_stats()
+        self.outbound_stats = new_outbound_stats()
+        self.inbound_stats = new_inbound_stats()
+        self.metrics = None
+        self.encoded_delimiter = encode_delimiter(delimiter, encoding)
+        # Handlers may broadcast from other threads, e.g. a REPL, so deliveries are serialized.
+        self.lock = threading.RLock()
+
+        self.welcome_frame = self.encode_message(welcome_message) if welcome_message is not None else None
+
+    def encode_message(self, message):
+        return encode_message(message, self.encoding, self.delimiter, self.encoded_delimiter)
+
+    def new_inbound_limiter(self):
+        return InboundLimiter(self.buffer_limit, self.buffer_policy, self.rate_limit, self.rate_burst, self.rate_policy,
+                              self.inbound_stats, self.scheduler.time)
+
+    def connect(self):
+        """
+        Returns a new LoopbackClient connected to the emulator.
+        """
+        client = LoopbackClient(self)
+
+        with self.lock:
+            self.clients.append(client)
+            self.stats['connections_accepted'] += 1
+
+            if self.welcome_frame is not None:
+                client.deliver(self.welcome_frame)
+
+        return client
+
+    def remove_client(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.stats['connections_closed'] += 1
+
+                if self.recorder is not None:
+                    self.recorder.close_connection(client.connection_id)
+
+            client.closed = True
+
+    def receive_data(self, client, data):
+        with self.lock:
+            if self.recorder is not None:
+                self.recorder.record(client.connection_id, RECEIVED, data)
+
+            if client.rate_paused:
+                client.held.extend(data)
+            else:
+                self.process_data(client, data)
+
+    def process_data(self, client, data):
+        client.buffer.extend(data)
+        messages, client.buffer = self.message_parser.process_buffer(client.buffer)
+        self.stats['bytes_in'] += len(data)
+        self.stats['messages_parsed'] += len(messages)
+        overflow = client.limiter.check_buffer(client.buffer)
+
+        if overflow == DISCONNECT:
+            self.remove_client(client)
+            return
+        elif overflow == DROP:
+            client.buffer = self.message_parser.new_buffer()
+
+        messages, action = client.limiter.admit(messages)
+
+        if self.handle_messages is not None:
+            messages = [message for message in messages if message != b'']
+
+            # Nothing complete was read, or the rate limit dropped all of it.
+            if messages:
+                for response in self.handle_messages(messages, client):
+                    self.send_response(client, response)
+        else:
+            for message in messages:
+                if message != b'':
+                    self.send_response(client, self.handle_message(message, client))
+
+        if action == DISCONNECT:
+            self.remove_client(client)
+        elif action == PAUSE:
+            client.rate_paused = True
+            self.scheduler.call_later(client.limiter.resume_delay(), self.resume_reading, client,
+                                      executor=self.call_in_loop, owner=client)
+
+    def resume_reading(self, client):
+        client.rate_paused = False
+        data, client.held = bytes(client.held), bytearray()
+
+        if data and not client.closed:
+            self.process_data(client, data)
+
+    def send_response(self, client, response):
+        broadcast = True
+
+        if type(response) == tuple:
+            response, broadcast = response
+
+        if response is None:
+            return
+
+        data = self.encode_message(response)
+        self.send_message(client, data)
+
+        if broadcast:
+            self.broadcast_message(data, client)
+
+    def send_message(self, client, message):
+        data = self.encode_message(message)
+        self.stats['bytes_out'] += len(data)
+        client.deliver(data)
+
+    def broadcast_message(self, message, from_client=None):
+        with self.lock:
+            data = self.encode_message(message)
+
+            for client in list(self.clients):
+                # Only broadcast to clients that aren't the one that sent the message.
+                if from_client is None or client != from_client:
+                    self.send_message(client, data)
+
+    def call_in_loop(self, fn, *args):
+        with self.lock:
+            fn(*args)
+
+    def gauges(self):
+        return {
+            'clients': len(self.clients),
+            'broadcast_queue': 0,
+            'message_queue': sum(len(client.inbox) for client in self.clients),
+            'message_queue_bytes': sum(len(data) for client in self.clients for data in client.inbox),
+        }
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        self.close_all_clients()
+
+    def close_all_clients(self):
+        with self.lock:
+            for client in list(self.clients):
+                self.remove_client(client)
@@ -13,6 +13,54 @@ class MessageParser(metaclass=ABCMeta):
         """
         pass
 
+    def new_buffer(self):
+        """
+        Returns an empty buffer for a new connection, transports should pass it to process_buffer after appending
+        incoming data to it.
+        """
+        return bytearray()
+
+
+class ParseBuffer(bytearray):
+    """
+    A bytearray that remembers how far it has been parsed. The cursor message parsers consume messages by moving offset
+    forward instead of reslicing the buffer, and only compact it once the consumed prefix gets large. scanned marks how
+    far a delimiter search got, so the next search can resume from there instead of starting over.
+    """
+    __slots__ = ('offset', 'scanned')
+    compact_threshold = 65536
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.offset = 0
+        self.scanned = 0
+
+    @property
+    def pending(self):
+        """
+        The number of bytes that haven't been consumed yet.
+        """
+        return len(self) - self.offset
+
+    def unread(self):
+        """
+        Returns a copy of the bytes that haven't been consumed yet.
+        """
+        return bytes(self[self.offset:])
+
+    def compact(self):
+        """
+        Drops the consumed prefix if everything has been consumed or if it has grown past compact_threshold.
+        """
+        if self.offset == len(self):
+            self.clear()
+            self.offset = 0
+            self.scanned = 0
+        elif self.offset >= self.compact_threshold:
+            del self[:self.offset]
+            self.scanned = max(0, self.scanned - self.offset)
+            self.offset = 0
+
 
 class CharacterMessageParser(MessageParser):
     def __init__(self, delimiter, encoding=None):
@@ -48,7 +96,7 @@ class CharacterMessageParser(MessageParser):
 
 
 class VariableLengthMessageParser(MessageParser):
-    def __init__(self, header, length_index=1, footer_length=0):
+    def __init__(self, header, length_index=1, footer_length=0, include_header=False):
         """
         Parses a stream that contains length delimited messages. Note: this parser assumes the length will be told to us
         via a byte at a known offset.
@@ -58,6 +106,9 @@ class VariableLengthMessageParser(MessageParser):
         byte after the header.
         :param footer_length: The size of the footer if the length byte does not count it. Most protocols don't need
         this, but for example the Samsung MDC protocol does.
+        :param include_header: Return whole frames, from the header through the footer, instead of only the bytes after
+        the length byte. Needed when the footer is a checksum over the header, see imitar.checksum. Optional, defaults
+        to False.
         """
         if header is not None and not isinstance(header, (bytes, bytearray)):
             raise ValueError('header must be None, bytes, or bytearray')
@@ -65,6 +116,7 @@ class VariableLengthMessageParser(MessageParser):
         self.header = header
         self.length_index = length_index
         self.footer_length = footer_length
+        self.include_header = include_header
 
     def process_buffer(self, buffer: bytearray):
         messages = []
@@ -95,7 +147,7 @@ class VariableLengthMessageParser(MessageParser):
                 # If we don't have the required length then we don't have a complete message yet, return.
                 break
 
-            messages.append(buffer[start_index:end_index])
+            messages.append(buffer[0 if self.include_header else start_index:end_index])
             buffer = buffer[end_index:]
 
         return messages, buffer
@@ -133,3 +185,131 @@ class FixedLengthMessageParser(MessageParser):
             buffer = buffer[self.length:]
 
         return messages, buffer
+
+
+class CursorCharacterMessageParser(CharacterMessageParser):
+    """
+    Same as the CharacterMessageParser, but works over a ParseBuffer so each call only looks at data it hasn't
+    searched yet and only copies complete messages, which keeps large bursts and long partial messages linear.
+    """
+    def new_buffer(self):
+        return ParseBuffer()
+
+    def process_buffer(self, buffer):
+        if not isinstance(buffer, ParseBuffer):
+            buffer = ParseBuffer(buffer)
+
+        messages = []
+        delimiter = self.delimiter
+        start = buffer.offset
+        # Everything up to the last delimiter is complete, split it in one go rather than a find per message.
+        end = buffer.rfind(delimiter, max(start, buffer.scanned))
+
+        if end >= 0:
+            complete = buffer[start:end]
+            start = end + len(delimiter)
+
+            if self.encoding is not None:
+                messages = [message.decode(self.encoding) for message in complete.split(delimiter)]
+            else:
+                # Immutable messages can be hashed, e.g. to look up cached query responses.
+                messages = bytes(complete).split(delimiter)
+
+        buffer.offset = start
+        # The tail of the buffer could be the beginning of a delimiter, so it has to be searched again.
+        buffer.scanned = max(start, len(buffer) - len(delimiter) + 1)
+        buffer.compact()
+
+        return messages, buffer
+
+
+class CursorVariableLengthMessageParser(VariableLengthMessageParser):
+    """
+    Same as the VariableLengthMessageParser, but works over a ParseBuffer instead of reslicing the buffer for every
+    message.
+    """
+    def new_buffer(self):
+        return ParseBuffer()
+
+    def process_buffer(self, buffer):
+        if not isinstance(buffer, ParseBuffer):
+            buffer = ParseBuffer(buffer)
+
+        messages = []
+        offset = buffer.offset
+
+        with memoryview(buffer) as view:
+            while True:
+                header_index = offset
+
+                if self.header is not None:
+                    header_index = buffer.find(self.header, max(offset, buffer.scanned))
+
+                    if header_index < 0:
+                        # If we don't have the header yet return, there's no need to search this data again.
+                        buffer.scanned = max(offset, len(buffer) - len(self.header) + 1)
+                        break
+
+                # Skip anything before the header, it's garbage.
+                offset = header_index
+                length_index = offset + self.length_index
+
+                if length_index >= len(buffer):
+                    # If we haven't received the length bit yet return
+                    break
+
+                start_index = length_index + 1
+                end_index = start_index + buffer[length_index] + self.footer_length
+
+                if end_index > len(buffer):
+                    # If we don't have the required length then we don't have a complete message yet, return.
+                    break
+
+                messages.append(view[offset if self.include_header else start_index:end_index].tobytes())
+                offset = end_index
+
+        buffer.offset = offset
+        buffer.compact()
+
+        return messages, buffer
+
+
+class CursorFixedLengthMessageParser(FixedLengthMessageParser):
+    """
+    Same as the FixedLengthMessageParser, but works over a ParseBuffer instead of reslicing the buffer for every
+    message.
+    """
+    def new_buffer(self):
+        return ParseBuffer()
+
+    def process_buffer(self, buffer):
+        if not isinstance(buffer, ParseBuffer):
+            buffer = ParseBuffer(buffer)
+
+        messages = []
+        offset = buffer.offset
+
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= self.length:
+                header_index = offset
+
+                if self.header is not None:
+                    header_index = buffer.find(self.header, max(offset, buffer.scanned))
+
+                    if header_index < 0:
+                        buffer.scanned = max(offset, len(buffer) - len(self.header) + 1)
+                        break
+
+                # Skip anything before the header, it's garbage.
+                offset = header_index
+
+                if len(buffer) - offset < self.length:
+                    break
+
+                messages.append(view[offset:offset + self.length].tobytes())
+                offset += self.length
+
+        buffer.offset = offset
+        buffer.compact()
+
+        return messages, buffer
@@ -0,0 +1,276 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, chosen to cover anything from a dict lookup to a handler that sleeps.
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+HELP = {
+    'connections_accepted': 'Client connections accepted',
+    'connections_closed': 'Client connections closed',
+    'bytes_in': 'Bytes received from clients',
+    'bytes_out': 'Bytes written to clients',
+    'messages_parsed': 'Messages parsed from client data',
+    'outbound_dropped': 'Outbound messages dropped by the overflow policy',
+    'outbound_disconnected': 'Clients disconnected by the overflow policy',
+    'outbound_blocked': 'Times reading from a client was paused by the overflow policy',
+    'broadcasts_dropped': 'Broadcasts dropped because the broadcast queue was full',
+    'connections_rejected': 'Client connections closed right away because max_connections was reached',
+    'connections_reaped_idle': 'Client connections closed for sending nothing for idle_timeout',
+    'connections_reaped_half_open': 'Client connections closed for not reading what they were sent for idle_timeout',
+    'accept_errors': 'Failures accepting a client connection',
+    'inbound_buffer_dropped': 'Times unparsed client data was discarded for passing the buffer limit',
+    'inbound_buffer_disconnected': 'Clients disconnected for passing the buffer limit',
+    'inbound_rate_dropped': 'Client messages discarded for passing the rate limit',
+    'inbound_rate_disconnected': 'Clients disconnected for passing the rate limit',
+    'inbound_rate_paused': 'Times reading from a client was paused for passing the rate limit',
+    'clients': 'Connected clients',
+    'broadcast_queue': 'Broadcasts waiting to be sent to clients',
+    'message_queue': 'Messages waiting to be written to clients',
+    'message_queue_bytes': 'Bytes waiting to be written to clients',
+    'state_version': 'Changes made to the device state',
+}
+
+
+def new_transport_stats():
+    """
+    Returns the counters every transport keeps, the transports increment these directly on their hot paths and
+    Metrics reads them when it is collected.
+    """
+    return {
+        'connections_accepted': 0,
+        'connections_closed': 0,
+        'bytes_in': 0,
+        'bytes_out': 0,
+        'messages_parsed': 0,
+        'broadcasts_dropped': 0,
+        'connections_rejected': 0,
+        'connections_reaped_idle': 0,
+        'connections_reaped_half_open': 0,
+        'accept_errors': 0,
+    }
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        A Prometheus style histogram. Observing a value is a bisect and a few additions, so it's cheap enough to do for
+        every message.
+
+        :param buckets: Sorted upper bounds of the buckets, the +Inf bucket is implied.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        Returns a list of (upper bound, count of values <= upper bound) including the +Inf bucket.
+        """
+        total = 0
+        result = []
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': self.cumulative_counts()}
+
+
+class Metrics:
+    """
+    Runtime metrics for an Emulator and its transport. Counters are kept by the transport (see new_transport_stats),
+    histograms are recorded here. Use snapshot() from tests and render_prometheus() for scraping.
+    """
+    def __init__(self, transport, labels=None, state=None):
+        self.transport = transport
+        self.state = state
+        self.labels = OrderedDict(labels or {})
+        self.command_latency = {}
+        self.broadcast_fanout = Histogram()
+        self.started = time.monotonic()
+        self._last_snapshot = None
+        self._lock = threading.Lock()
+
+    def observe_command(self, command, seconds):
+        histogram = self.command_latency.get(command)
+
+        if histogram is None:
+            with self._lock:
+                histogram = self.command_latency.setdefault(command, Histogram())
+
+        histogram.observe(seconds)
+
+    def observe_broadcast(self, seconds):
+        self.broadcast_fanout.observe(seconds)
+
+    def counters(self):
+        counters = dict(self.transport.stats)
+        counters.update(('outbound_' + key, value) for key, value in self.transport.outbound_stats.items())
+        counters.update(('inbound_' + key, value) for key, value in self.transport.inbound_stats.items())
+
+        return counters
+
+    def gauges(self):
+        gauges = self.transport.gauges()
+
+        if self.state is not None:
+            gauges['state_version'] = self.state.version
+
+        return gauges
+
+    def snapshot(self):
+        """
+        Returns every metric as a dict. Rates are averaged over the time since the previous call to snapshot, or since
+        the metrics were created on the first call.
+        """
+        now = time.monotonic()
+        counters = self.counters()
+        last_time, last_counters = self._last_snapshot or (self.started, {})
+        elapsed = now - last_time
+        self._last_snapshot = (now, counters)
+
+        def rate(name):
+            return (counters[name] - last_counters.get(name, 0)) / elapsed if elapsed > 0 else 0.0
+
+        return {
+            'uptime_seconds': now - self.started,
+            'counters': counters,
+            'gauges': self.gauges(),
+            'accept_rate': rate('connections_accepted'),
+            'messages_per_second': rate('messages_parsed'),
+            'broadcast_fanout': self.broadcast_fanout.snapshot(),
+            'command_latency': {command: histogram.snapshot()
+                                for command, histogram in list(self.command_latency.items())},
+        }
+
+    def collect(self):
+        """
+        Yields (name, type, help, samples) for every metric family, samples are a list of (labels, value).
+        """
+        labels = self.labels
+
+        for name, value in sorted(self.counters().items()):
+            yield 'imitar_{}_total'.format(name), 'counter', HELP.get(name, name), [(labels, value)]
+
+        for name, value in sorted(self.gauges().items()):
+            yield 'imitar_{}'.format(name), 'gauge', HELP.get(name, name), [(labels, value)]
+
+        yield ('imitar_broadcast_fanout_seconds', 'histogram', 'Time spent queuing a broadcast for every client',
+               histogram_samples(self.broadcast_fanout, labels))
+
+        samples = []
+
+        for command, histogram in sorted(list(self.command_latency.items())):
+            samples.extend(histogram_samples(histogram, OrderedDict(labels, command=command)))
+
+        yield 'imitar_command_latency_seconds', 'histogram', 'Time spent in handle_message per command', samples
+
+    def render_prometheus(self):
+        return render_prometheus([self])
+
+
+def histogram_samples(histogram, labels):
+    """
+    Returns the Prometheus samples for a histogram, suffixes are passed as part of the labels under the '__suffix__'
+    key so render_prometheus can keep every sample of a family together.
+    """
+    samples = []
+
+    for bound, count in histogram.cumulative_counts():
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        samples.append((OrderedDict(labels, __suffix__='_bucket', le=le), count))
+
+    samples.append((OrderedDict(labels, __suffix__='_sum'), histogram.sum))
+    samples.append((OrderedDict(labels, __suffix__='_count'), histogram.count))
+
+    return samples
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render_prometheus(collectors):
+    """
+    Renders the metrics of one or more collectors (anything with a collect method, like Metrics) in the Prometheus text
+    exposition format. Families with the same name are merged so several emulators can share one endpoint.
+    """
+    families = OrderedDict()
+
+    for collector in collectors:
+        for name, kind, help_text, samples in collector.collect():
+            family = families.setdefault(name, (kind, help_text, []))
+            family[2].extend(samples)
+
+    lines = []
+
+    for name, (kind, help_text, samples) in families.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+        for labels, value in samples:
+            labels = OrderedDict(labels)
+            suffix = labels.pop('__suffix__', '')
+            label_text = ','.join('{}="{}"'.format(key, _escape(val)) for key, val in labels.items())
+            label_text = '{' + label_text + '}' if label_text else ''
+            lines.append('{}{}{} {}'.format(name, suffix, label_text, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    def __init__(self, collectors, port, host='127.0.0.1'):
+        """
+        Serves metrics in the Prometheus text format at /metrics from a background thread.
+
+        :param collectors: A list of collectors, see render_prometheus. The list may be changed while serving.
+        :param port: The port to listen on, 0 picks a free port.
+        :param host: The interface to listen on. Optional, defaults to localhost only.
+        """
+        self.collectors = collectors
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = render_prometheus(server.collectors).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,120 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import itertools
+from collections import deque
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+
+class OutboundQueue:
+    __slots__ = ('max_bytes', 'policy', 'stats', 'messages', 'size', 'dropped', '_partial')
+
+    def __init__(self, max_bytes=65536, policy=DROP_OLDEST, stats=None):
+        """
+        A bounded buffer of encoded messages waiting to be written to a single client. Transports put messages in and
+        their I/O loop takes them out as the socket becomes writable, so a slow client never stalls anybody else.
+
+        What happens when a message doesn't fit depends on the policy:
+            drop-oldest: Messages are discarded from the front of the queue until the new message fits.
+            disconnect: The message is discarded and put returns False, the transport should close the client.
+            block: The message is queued anyway and put returns True, the transport should stop reading from the
+                   client until the queue drains. This pushes back on the client's own requests, but broadcasts to it
+                   are not bounded.
+
+        :param max_bytes: The most bytes that may be waiting to be sent. Optional, defaults to 64KiB.
+        :param policy: One of drop-oldest, disconnect, or block. Optional, defaults to drop-oldest.
+        :param stats: A dict shared by every queue of a transport to count overflows in. Optional.
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('policy must be one of {}'.format(', '.join(OVERFLOW_POLICIES)))
+
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.stats = stats if stats is not None else new_outbound_stats()
+        # Most clients are idle most of the time, the deque is only allocated once there is something to send.
+        self.messages = None
+        self.size = 0
+        self.dropped = 0
+        self._partial = False
+
+    def __len__(self):
+        return len(self.messages) if self.messages is not None else 0
+
+    def __bool__(self):
+        return self.size > 0
+
+    @property
+    def full(self):
+        return self.size >= self.max_bytes
+
+    def put(self, data) -> bool:
+        """
+        Queues data, applying the overflow policy if needed.
+
+        :return: False if the client should be disconnected, True otherwise.
+        """
+        if self.messages is None:
+            self.messages = deque()
+
+        if self.size + len(data) > self.max_bytes:
+            if self.policy == DISCONNECT:
+                self.dropped += 1
+                self.stats['dropped'] += 1
+                self.stats['disconnected'] += 1
+                return False
+            elif self.policy == DROP_OLDEST:
+                # Never drop a message that has been partially written, the client would receive half of it.
+                keep = 1 if self._partial else 0
+
+                while len(self.messages) > keep and self.size + len(data) > self.max_bytes:
+                    self.size -= len(self.messages[keep])
+                    del self.messages[keep]
+                    self.dropped += 1
+                    self.stats['dropped'] += 1
+
+        self.messages.append(data)
+        self.size += len(data)
+
+        return True
+
+    def peek(self):
+        return self.messages[0]
+
+    def peek_many(self, limit):
+        """
+        Returns up to limit messages from the front of the queue, for a vectored write.
+        """
+        if len(self) <= limit:
+            return list(self.messages or ())
+
+        return list(itertools.islice(self.messages, limit))
+
+    def consume(self, count):
+        """
+        Removes count bytes from the front of the queue after they have been written to the socket.
+        """
+        self.size -= count
+
+        while count > 0:
+            head = self.messages[0]
+
+            if count >= len(head):
+                self.messages.popleft()
+                self._partial = False
+                count -= len(head)
+            else:
+                # Partial write, keep the rest of the message at the front of the queue without copying it.
+                self.messages[0] = memoryview(head)[count:]
+                self._partial = True
+                count = 0
+
+    def clear(self):
+        self.messages = None
+        self.size = 0
+        self._partial = False
+
+
+def new_outbound_stats():
+    return {'dropped': 0, 'disconnected': 0, 'blocked': 0}
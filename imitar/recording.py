@@ -0,0 +1,127 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .log import BackgroundWriter, RECEIVED, SENT
+
+# A recording starts with MAGIC followed by frames, each a FRAME header (time.time(), connection id, kind, length) and
+# then length bytes of data. Frames are only ever appended, so a recording can be read while it is being written.
+MAGIC = b'IMTREC01'
+FRAME = struct.Struct('<dIBI')
+CONNECTED = 2
+CLOSED = 3
+KINDS = (RECEIVED, SENT, CONNECTED, CLOSED)
+
+
+class Recorder:
+    """
+    Records the raw bytes every client sends to an emulator and everything the emulator sends back, per connection, so
+    sessions can be replayed later with imitar.replay. Pass one to an Emulator as recorder, or to a transport as the
+    recorder option. Frames are written by a background thread, recording only costs the I/O loop a struct.pack.
+
+    Recording to a file that already exists appends to it, numbering connections after the ones already recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+        appending = os.path.exists(path) and os.path.getsize(path) > 0
+
+        if appending:
+            with Recording(path) as recording:
+                self._next_id = max((connection + 1 for _, connection, _, _ in recording.frames()), default=0)
+
+        self.writer = BackgroundWriter(path)
+
+        if not appending:
+            self.writer.write(MAGIC)
+
+    def record(self, connection, kind, data=b''):
+        self.writer.write(FRAME.pack(time.time(), connection, kind, len(data)) + bytes(data))
+
+    def open(self):
+        """
+        Records a new connection and returns its id.
+        """
+        with self._lock:
+            connection = self._next_id
+            self._next_id += 1
+
+        self.record(connection, CONNECTED)
+
+        return connection
+
+    def close_connection(self, connection):
+        self.record(connection, CLOSED)
+
+    def close(self):
+        self.writer.close()
+
+
+class Recording:
+    """
+    Reads a recording through a memory map, so even large recordings are read without loading them into memory. Use it
+    as a context manager, or call close when done.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = None
+
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            if self._map[:len(MAGIC)] != MAGIC:
+                self.close()
+                raise ValueError('{} is not an imitar recording'.format(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def frames(self):
+        """
+        Yields (timestamp, connection, kind, data) for every frame. data is a memoryview into the recording, release it
+        or copy it with bytes() before closing the recording.
+        """
+        if self._map is None:
+            return
+
+        data = self._map
+        view = memoryview(data)
+        offset = len(MAGIC)
+
+        # Stop at a frame that is still being written.
+        while offset + FRAME.size <= len(data):
+            timestamp, connection, kind, length = FRAME.unpack_from(data, offset)
+            offset += FRAME.size
+
+            if offset + length > len(data):
+                break
+
+            yield timestamp, connection, kind, view[offset:offset + length]
+            offset += length
+
+    def sessions(self):
+        """
+        Returns a dict of connection id to the list of (timestamp, kind, data) frames of that connection.
+        """
+        sessions = {}
+
+        for timestamp, connection, kind, data in self.frames():
+            sessions.setdefault(connection, []).append((timestamp, kind, bytes(data)))
+
+        return sessions
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.close()
@@ -0,0 +1,221 @@
+# Copyright 2015 jydo inc. All rights reserved.
+"""
+Replays sessions captured by a Recorder against an emulator and compares what the emulator sends back with what was
+recorded. Every recorded connection is replayed by its own client, starting and sending at the same offsets as in the
+recording divided by the speed, or as fast as possible with a speed of 0. Pass clients to replay every connection
+several times in parallel to use a recording as load.
+
+Responses are only expected to match the recording exactly when every connection is replayed once and the order
+messages arrive in doesn't depend on timing, e.g. broadcasts from other connections may interleave differently at a
+higher speed.
+
+Example:
+    python -m imitar.replay session.rec --emulator imitar.fake_tv_emulator.FakeTvEmulator --speed 0
+    python -m imitar.replay session.rec --port 4000 --speed 10 --clients 50 --no-diff
+"""
+import asyncio
+import difflib
+import time
+
+from .recording import Recording, RECEIVED, SENT, CLOSED
+
+
+def split_messages(data, delimiter):
+    """
+    Splits data into messages ending with delimiter, a trailing partial message is kept as is.
+    """
+    if not delimiter:
+        return [data] if data else []
+
+    messages = [message + delimiter for message in data.split(delimiter)]
+    messages[-1] = messages[-1][:-len(delimiter)]
+
+    if not messages[-1]:
+        messages.pop()
+
+    return messages
+
+
+class SessionResult:
+    def __init__(self, connection, copy, expected, received, messages_sent, delimiter):
+        self.connection = connection
+        self.copy = copy
+        self.expected = expected
+        self.received = received
+        self.messages_sent = messages_sent
+        self.delimiter = delimiter
+
+    @property
+    def matched(self):
+        return self.expected == self.received
+
+    def diff(self):
+        """
+        Returns a unified diff of the recorded and replayed responses as a list of lines.
+        """
+        expected = [repr(message) for message in split_messages(self.expected, self.delimiter)]
+        received = [repr(message) for message in split_messages(self.received, self.delimiter)]
+        name = 'connection {} copy {}'.format(self.connection, self.copy)
+
+        return list(difflib.unified_diff(expected, received, name + ' (recorded)', name + ' (replayed)', lineterm=''))
+
+
+class ReplayReport:
+    def __init__(self, results, elapsed):
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def mismatches(self):
+        return [result for result in self.results if not result.matched]
+
+    def summary(self):
+        messages = sum(result.messages_sent for result in self.results)
+
+        return {
+            'sessions': len(self.results),
+            'mismatches': len(self.mismatches),
+            'frames_sent': messages,
+            'elapsed_seconds': self.elapsed,
+            'frames_per_second': messages / self.elapsed if self.elapsed > 0 else 0.0,
+        }
+
+
+async def _sleep_until(loop, start, offset, speed):
+    if speed > 0:
+        delay = start + offset / speed - loop.time()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def replay_session(host, port, frames, origin, start, speed, delimiter, timeout, connection=0, copy=0):
+    """
+    Replays the frames of one recorded connection and returns a SessionResult.
+
+    :param frames: The connection's list of (timestamp, kind, data), see Recording.sessions.
+    :param origin: The timestamp the replay's start corresponds to.
+    :param start: The loop time the replay started at.
+    """
+    loop = asyncio.get_running_loop()
+    expected = b''.join(data for _, kind, data in frames if kind == SENT)
+    received = bytearray()
+    changed = asyncio.Event()
+    messages_sent = 0
+    await _sleep_until(loop, start, frames[0][0] - origin, speed)
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def read_loop():
+        while True:
+            data = await reader.read(65536)
+            changed.set()
+
+            if not data:
+                return
+
+            received.extend(data)
+
+    reading = asyncio.ensure_future(read_loop())
+
+    try:
+        for timestamp, kind, data in frames:
+            if kind == RECEIVED:
+                await _sleep_until(loop, start, timestamp - origin, speed)
+                writer.write(data)
+                await writer.drain()
+                messages_sent += 1
+            elif kind == CLOSED:
+                break
+
+        # Wait for the rest of the responses, giving up once nothing has arrived for timeout seconds.
+        while len(received) < len(expected) and not reading.done():
+            changed.clear()
+
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+    finally:
+        reading.cancel()
+        writer.close()
+
+    return SessionResult(connection, copy, expected, bytes(received), messages_sent, delimiter)
+
+
+async def replay_async(path, host, port, speed=1.0, clients=1, delimiter=b'\r\n', timeout=1.0):
+    """
+    Replays every session in the recording at path against the emulator at host:port and returns a ReplayReport.
+
+    :param speed: How much faster than recorded to replay, 0 replays as fast as possible. Optional, defaults to 1.
+    :param clients: How many parallel clients replay each recorded connection. Optional, defaults to 1.
+    :param delimiter: Used to split responses into messages for diffs. Optional, defaults to CRLF.
+    :param timeout: How long to wait for missing responses after a session's last frame. Optional, defaults to 1s.
+    """
+    with Recording(path) as recording:
+        sessions = recording.sessions()
+
+    if not sessions:
+        return ReplayReport([], 0.0)
+
+    loop = asyncio.get_running_loop()
+    origin = min(frames[0][0] for frames in sessions.values())
+    start = loop.time()
+    wall_start = time.perf_counter()
+    results = await asyncio.gather(*[
+        replay_session(host, port, frames, origin, start, speed, delimiter, timeout, connection, copy)
+        for connection, frames in sorted(sessions.items()) for copy in range(clients)
+    ])
+
+    return ReplayReport(results, time.perf_counter() - wall_start)
+
+
+def replay(path, host, port, **kwargs):
+    """
+    Runs replay_async on a new event loop, for callers that aren't running one.
+    """
+    return asyncio.run(replay_async(path, host, port, **kwargs))
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import sys
+
+    from .host import load_class
+
+    parser = argparse.ArgumentParser(description='Replay a recording against an emulator.')
+    parser.add_argument('recording', help='A file written by a Recorder')
+    parser.add_argument('--host', default='127.0.0.1', help='The host of the emulator to replay against')
+    parser.add_argument('--port', type=int, default=None, help='The port of the emulator to replay against')
+    parser.add_argument('--emulator', default=None,
+                        help='Start this emulator class (a dotted path) in process instead of using --host and --port')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How much faster than recorded to replay, 0 replays as fast as possible')
+    parser.add_argument('--clients', type=int, default=1, help='Parallel clients replaying each recorded connection')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Seconds to wait for missing responses')
+    parser.add_argument('--no-diff', dest='diff', action='store_false', default=True,
+                        help="Don't compare the responses with the recording")
+    args = parser.parse_args()
+    emulator = None
+    port = args.port
+
+    if args.emulator is not None:
+        emulator = load_class(args.emulator)(0, handle_signals=False)
+        emulator.start()
+        port = emulator.transport.port
+    elif port is None:
+        parser.error('Either --port or --emulator is required')
+
+    try:
+        report = replay(args.recording, args.host, port, speed=args.speed, clients=args.clients, timeout=args.timeout)
+    finally:
+        if emulator is not None:
+            emulator.stop()
+
+    print(json.dumps(report.summary(), indent=2))
+
+    if args.diff and report.mismatches:
+        for result in report.mismatches[:10]:
+            print('\n'.join(result.diff()))
+
+        sys.exit(1)
@@ -0,0 +1,211 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import heapq
+import itertools
+import threading
+import time
+
+from .log import get_logger
+
+logger = get_logger('scheduler')
+
+
+class MonotonicClock:
+    @staticmethod
+    def time():
+        return time.monotonic()
+
+
+class VirtualClock:
+    """
+    A clock that only moves when advance is called, for tests. Timers of schedulers using this clock run on the thread
+    that calls advance, in deadline order, so a test can skip over a projector's warm up instantly and
+    deterministically. This works best with the LoopbackTransport, where handlers also run on the test's thread.
+    """
+    def __init__(self, start=0.0):
+        self.now = start
+        self.schedulers = []
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward, running every timer that comes due along the way, including timers scheduled by
+        those timers.
+        """
+        target = self.now + seconds
+
+        while True:
+            deadlines = [deadline for deadline in (scheduler.next_deadline() for scheduler in self.schedulers)
+                         if deadline is not None and deadline <= target]
+
+            if not deadlines:
+                break
+
+            self.now = max(self.now, min(deadlines))
+
+            for scheduler in self.schedulers:
+                scheduler.run_due()
+
+        self.now = target
+
+
+class Timer:
+    __slots__ = ('when', 'interval', 'fn', 'args', 'executor', 'owner', 'cancelled')
+
+    def __init__(self, when, interval, fn, args, executor, owner):
+        self.when = when
+        self.interval = interval
+        self.fn = fn
+        self.args = args
+        self.executor = executor
+        self.owner = owner
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs delayed and periodic actions from a heap of timers. With the default clock a single background thread waits
+    for the next deadline, however many emulators and timers share the scheduler. Timers are handed to their executor
+    when they come due, emulators use their transport's call_in_loop so timers run on the I/O loop alongside the
+    handlers and never block it by sleeping.
+    """
+    def __init__(self, clock=None):
+        """
+        :param clock: MonotonicClock or VirtualClock. Optional, defaults to a MonotonicClock.
+        """
+        self.clock = clock or MonotonicClock()
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        if isinstance(self.clock, VirtualClock):
+            self.clock.schedulers.append(self)
+
+    def time(self):
+        return self.clock.time()
+
+    def call_at(self, when, fn, *args, interval=None, executor=None, owner=None):
+        """
+        Runs fn(*args) at when, according to the scheduler's clock.
+
+        :param interval: If set, run fn again every interval seconds after that.
+        :param executor: Called as executor(fn, *args) to run the timer, e.g. a transport's call_in_loop. Optional,
+        by default fn runs on the scheduler's thread (or the thread advancing a VirtualClock).
+        :param owner: Anything, cancel_all(owner) cancels every timer of that owner.
+        :return: A Timer, call its cancel method to stop it.
+        :raises ValueError: If interval isn't positive.
+        """
+        if interval is not None and not interval > 0:
+            # A timer that is always due would keep run_due from ever returning.
+            raise ValueError('interval must be positive, not {!r}'.format(interval))
+
+        timer = Timer(when, interval, fn, args, executor, owner)
+
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._counter), timer))
+
+            if not isinstance(self.clock, VirtualClock):
+                self._ensure_thread()
+                self._condition.notify()
+
+        return timer
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        return self.call_at(self.time() + delay, fn, *args, **kwargs)
+
+    def call_every(self, interval, fn, *args, **kwargs):
+        return self.call_at(self.time() + interval, fn, *args, interval=interval, **kwargs)
+
+    def cancel_all(self, owner):
+        with self._condition:
+            for _, _, timer in self._heap:
+                if timer.owner is owner:
+                    timer.cancel()
+
+    def next_deadline(self):
+        with self._condition:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+
+            return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now):
+        due = []
+
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                when, _, timer = heapq.heappop(self._heap)
+
+                if timer.cancelled:
+                    continue
+
+                due.append(timer)
+
+                if timer.interval is not None:
+                    # Schedule from the deadline rather than now so periodic timers don't drift.
+                    timer.when = when + timer.interval
+                    heapq.heappush(self._heap, (timer.when, next(self._counter), timer))
+
+        return due
+
+    def run_due(self):
+        """
+        Runs every timer whose deadline has passed.
+        """
+        for timer in self._pop_due(self.time()):
+            try:
+                if timer.executor is not None:
+                    timer.executor(timer.fn, *timer.args)
+                else:
+                    timer.fn(*timer.args)
+            except Exception as e:
+                logger.exception('Error running timer %s: %s', timer.fn, e)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_loop, daemon=True)
+            self._thread.start()
+
+    def _run_loop(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    deadline = self.next_deadline()
+
+                    if deadline is not None and deadline <= self.time():
+                        break
+
+                    self._condition.wait(None if deadline is None else deadline - self.time())
+
+                if self._stopped:
+                    return
+
+            self.run_due()
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    Returns the real time Scheduler shared by every emulator in the process.
+    """
+    global _default_scheduler
+
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+
+        return _default_scheduler
@@ -0,0 +1,71 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import itertools
+
+_ids = itertools.count(1)
+
+
+class Session:
+    """
+    The state of a single client connection. Every transport keeps one per client (ClientWorker, ClientProtocol, and
+    LoopbackClient are sessions) and passes it to handle_message, so an emulator can keep per client state such as a
+    login or a verbose mode:
+
+        def handle_message(self, message, session=None):
+            if not session.get('authenticated'):
+                ...
+
+    Sessions use __slots__ and only allocate a dict for per client values once one is set, so an idle connection costs
+    a few hundred bytes and tens of thousands of them fit in memory easily.
+    """
+    __slots__ = ('id', 'address', 'buffer', 'values', 'last_active', 'stalled_since')
+
+    def __init__(self, address=None, buffer=None, now=0.0):
+        self.id = next(_ids)
+        self.address = address
+        self.buffer = buffer
+        self.values = None
+        # When the client last sent something, and since when data for it has been waiting on a socket that isn't
+        # writable, for reaping dead connections.
+        self.last_active = now
+        self.stalled_since = None
+
+    def get(self, key, default=None):
+        if self.values is None:
+            return default
+
+        return self.values.get(key, default)
+
+    def __getitem__(self, key):
+        if self.values is None:
+            raise KeyError(key)
+
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        if self.values is None:
+            self.values = {}
+
+        self.values[key] = value
+
+    def __contains__(self, key):
+        return self.values is not None and key in self.values
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(type(self).__name__, self.id, self.address)
+
+
+def expired_sessions(sessions, now, idle_timeout):
+    """
+    Returns (session, reason) for every session that should be closed. A session is half-open if data for it has been
+    waiting longer than idle_timeout for its socket to become writable, the client has stopped reading or is gone, and
+    idle if it hasn't sent anything for longer than idle_timeout.
+    """
+    expired = []
+
+    for session in sessions:
+        if session.stalled_since is not None and now - session.stalled_since > idle_timeout:
+            expired.append((session, 'half_open'))
+        elif now - session.last_active > idle_timeout:
+            expired.append((session, 'idle'))
+
+    return expired
@@ -0,0 +1,176 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import collections
+import threading
+
+
+class StateLock:
+    """
+    A reentrant lock that calls on_release whenever its owner releases it for the last time, so DeviceState can notify
+    subscribers once nothing is locked. Use it like a threading.RLock.
+    """
+    __slots__ = ('_lock', '_depth', '_on_release')
+
+    def __init__(self, on_release):
+        self._lock = threading.RLock()
+        # Only changed by the thread holding the lock.
+        self._depth = 0
+        self._on_release = on_release
+
+    def acquire(self, blocking=True, timeout=-1):
+        acquired = self._lock.acquire(blocking, timeout)
+
+        if acquired:
+            self._depth += 1
+
+        return acquired
+
+    def release(self):
+        self._depth -= 1
+        outermost = self._depth == 0
+        self._lock.release()
+
+        if outermost:
+            self._on_release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class DeviceState:
+    """
+    The state of an emulated device as a set of named values. Handlers, timers, and other threads (e.g. a REPL) can all
+    change it safely: updates are applied atomically under a lock, every update that changes something increments
+    version, and subscribers are told exactly which values changed. Emulators subscribe to it to invalidate cached
+    query responses and to broadcast changes to clients, see Emulator.broadcast_on_change.
+
+    Store immutable values (tuples rather than lists), a value changed in place isn't noticed.
+    """
+    def __init__(self, values=None, context=None):
+        """
+        :param values: The initial values. Optional.
+        :param context: Called as context(changes) on the thread making every update, with the lock held. Subscribers
+        that ask for it are passed what it returns, e.g. what the changing thread was doing, since they may be called
+        on another thread. Optional.
+        """
+        self._values = dict(values or {})
+        self._context = context
+        self._subscribers = []
+        # Changes waiting to be passed to subscribers, and held by whichever thread is passing them on.
+        self._pending = collections.deque()
+        self._notifying = threading.Lock()
+        self.lock = StateLock(self._notify)
+        self.version = 0
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def snapshot(self):
+        """
+        Returns (version, a copy of every value) as of a single point in time.
+        """
+        with self.lock:
+            return self.version, dict(self._values)
+
+    def update(self, values=None, **kwargs):
+        """
+        Sets one or more values at once. Subscribers are called in version order once the lock is released, when update
+        returns or at the end of the caller's own with state.lock block. Calling them without the lock held keeps a
+        subscriber that takes another lock, e.g. a transport's to broadcast, from deadlocking with a thread that holds
+        that lock and is waiting for this one.
+
+        :return: A dict of key: (old value, new value) for the values that actually changed, empty if none did.
+        """
+        values = dict(values or {}, **kwargs)
+
+        with self.lock:
+            changes = {}
+
+            for key, value in values.items():
+                old = self._values.get(key)
+
+                if key not in self._values or old != value:
+                    changes[key] = (old, value)
+                    self._values[key] = value
+
+            if changes:
+                self.version += 1
+                context = self._context(changes) if self._context is not None else None
+                self._pending.append((changes, self.version, context))
+
+            return changes
+
+    def _notify(self):
+        while self._pending:
+            if not self._notifying.acquire(blocking=False):
+                # Another thread is passing changes on, it picks these up too so they stay in version order. Waiting
+                # for it could deadlock on whatever its subscribers are waiting for.
+                return
+
+            try:
+                while self._pending:
+                    changes, version, context = self._pending.popleft()
+
+                    for keys, callback, with_context in list(self._subscribers):
+                        if keys is None or not keys.isdisjoint(changes):
+                            if with_context:
+                                callback(changes, version, context)
+                            else:
+                                callback(changes, version)
+            finally:
+                self._notifying.release()
+
+    def restore(self, values):
+        """
+        Replaces every value with values, e.g. a dict returned by snapshot. Keys that aren't in values are removed and
+        reported as changed to None.
+
+        :return: See update.
+        """
+        with self.lock:
+            removed = {key: None for key in self._values if key not in values}
+            changes = self.update({**values, **removed})
+
+            for key in removed:
+                del self._values[key]
+
+            return changes
+
+    def modify(self, key, fn):
+        """
+        Atomically replaces a value with fn(value), e.g. to change one input of a tuple.
+
+        :return: See update.
+        """
+        with self.lock:
+            return self.update({key: fn(self._values.get(key))})
+
+    def subscribe(self, callback, keys=None, with_context=False):
+        """
+        Calls callback(changes, version) after every update that changes one of keys, or any value if keys is None.
+        changes is the dict update returns. Callbacks run without the lock held, normally on the thread that made the
+        update but on another thread if that one is already passing changes on, keep them short.
+
+        :param with_context: If True call callback(changes, version, context) instead, see the context parameter.
+        Optional, defaults to False.
+        :return: A function that removes the subscription.
+        """
+        subscription = (frozenset(keys) if keys is not None else None, callback, with_context)
+
+        with self.lock:
+            self._subscribers.append(subscription)
+
+        def unsubscribe():
+            with self.lock:
+                if subscription in self._subscribers:
+                    self._subscribers.remove(subscription)
+
+        return unsubscribe
@@ -1,134 +1,300 @@
 # Copyright 2015 jydo inc. All rights reserved.
 import errno
+import selectors
 import socket
-import sys
 import threading
-from logging import getLogger, StreamHandler, DEBUG, INFO
-from queue import Queue, Empty
+import time
+from collections import deque
+from logging import DEBUG, INFO
 
-logger = getLogger('tcp_server')
-logger.addHandler(StreamHandler(stream=sys.stdout))
+from .frames import encode_delimiter, encode_message
+from .inbound import InboundLimiter, DISCONNECT, DROP, PAUSE, new_inbound_stats
+from .log import get_logger
+from .metrics import new_transport_stats
+from .outbound import OutboundQueue, DROP_OLDEST, BLOCK, new_outbound_stats
+from .recording import RECEIVED, SENT
+from .scheduler import default_scheduler
+from .session import Session, expired_sessions
+
+logger = get_logger('tcp_server')
+# The most buffers handed to a single sendmsg call, Linux refuses more than IOV_MAX (1024).
+MAX_IOVECS = 512
 
 
 class ClientDisconnectedError(Exception):
     pass
 
 
-class ClientWorker:
-    def __init__(self, client_queue, broadcast_queue, handle_message, message_parser, encoding=None, delimiter=None,
-                 welcome_message=None):
-        self.client_queue = client_queue
-        self.broadcast_queue = broadcast_queue
-        self.handle_message = handle_message
-        self.message_parser = message_parser
-        self.delimiter = delimiter
-        self.encoding = encoding
-        self.welcome_message = welcome_message
-        self.message_queue = Queue()
-        self.buffer = bytearray()
-        self.client = None
-        self.address = None
-        self._stop = False
-        self.thread = threading.Thread(target=self.run_loop, daemon=False)
-        self.thread.start()
+def create_listening_socket(port, backlog, reuse_port=False):
+    """
+    Creates a non blocking socket listening on every interface.
+
+    :param port: The port to bind to, 0 lets the OS pick a free port.
+    :param backlog: How many connections the OS may queue before we accept them.
+    :param reuse_port: Set SO_REUSEPORT so several processes can listen on the same port and the OS spreads connections
+    between them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    if reuse_port:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported on this platform')
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+
+    return sock
+
+
+class ClientWorker(Session):
+    """
+    Holds the state of a single client connection. Workers don't own a thread, the TcpServer's selector loop calls
+    receive_data when the client socket is readable and send_pending_messages when the socket is writable. Outgoing
+    data is held in a bounded OutboundQueue, so sending never blocks the loop, and incoming data is checked against an
+    InboundLimiter. Workers are the Sessions passed to handle_message.
+    """
+    __slots__ = ('server', 'client', 'message_queue', 'limiter', 'reading', 'rate_paused', 'writing', 'connection_id')
+
+    def __init__(self, server, client, address):
+        super().__init__(address, server.message_parser.new_buffer(), server.scheduler.time())
+        self.server = server
+        self.client = client
+        self.message_queue = OutboundQueue(server.outbound_limit, server.overflow_policy, server.outbound_stats)
+        self.limiter = server.new_inbound_limiter()
+        self.reading = True
+        self.rate_paused = False
+        self.writing = False
+        self.connection_id = server.recorder.open() if server.recorder is not None else None
 
     def on_client_disconnect(self):
         if self.client is not None:
-            logger.debug('{} disconnected, cleaning up.'.format(self.address))
+            logger.debug('%s disconnected, cleaning up.', self.address)
+            self.server.stats['connections_closed'] += 1
+            self.server.remove_worker(self)
             self.client.close()
             self.client = None
 
+            if self.server.recorder is not None:
+                self.server.recorder.close_connection(self.connection_id)
+
         self.address = None
-        self.buffer = bytearray()
+        self.buffer = self.server.message_parser.new_buffer()
+        self.message_queue.clear()
 
     def receive_data(self):
         incoming = b''
 
         try:
             incoming = self.client.recv(4096)
-        except socket.timeout:
-            # This is ok
+        except (BlockingIOError, InterruptedError):
+            # Spurious wakeup, this is ok
             return
         except socket.error:
             # This will be taken care of by checking the length of incoming below.
             pass
 
         if len(incoming) == 0:
+            address = self.address
             self.on_client_disconnect()
-            raise ClientDisconnectedError('Client {} disconnected')
+            raise ClientDisconnectedError('Client {} disconnected'.format(address))
+
+        server = self.server
+        self.last_active = server.scheduler.time()
+
+        if server.recorder is not None:
+            server.recorder.record(self.connection_id, RECEIVED, incoming)
 
         self.buffer.extend(incoming)
-        logger.debug('buffer: {}'.format(self.buffer))
-        print(self.message_parser)
-        messages, self.buffer = self.message_parser.process_buffer(self.buffer)
+        messages, self.buffer = server.message_parser.process_buffer(self.buffer)
+        stats = server.stats
+        stats['bytes_in'] += len(incoming)
+        stats['messages_parsed'] += len(messages)
 
-        for message in messages:
-            if message != b'':
-                response = self.handle_message(message)
-                broadcast = True
+        overflow = self.limiter.check_buffer(self.buffer)
 
-                if type(response) == tuple:
-                    response, broadcast = response
+        if overflow == DISCONNECT:
+            logger.debug('%s sent too much data without a complete message, disconnecting.', self.address)
+            self.close()
+            return
+        elif overflow == DROP:
+            self.buffer = server.message_parser.new_buffer()
 
-                if response is None:
-                    continue
+        messages, action = self.limiter.admit(messages)
+        self.handle(messages)
 
-                self.message_queue.put(response)
+        if action == DISCONNECT:
+            logger.debug('%s exceeded the rate limit, disconnecting.', self.address)
+            self.close()
+        elif action == PAUSE and self.client is not None:
+            # Stop reading until the client is back within the rate limit.
+            self.rate_paused = True
+            self.update_interest()
+            self.server.scheduler.call_later(self.limiter.resume_delay(), self.resume_reading,
+                                             executor=self.server.call_in_loop, owner=self)
 
-                if broadcast:
-                    self.broadcast_queue.put((response, self))
+    def handle(self, messages):
+        server = self.server
 
-    def send_message(self, message):
-        if self.client is not None:
-            if self.delimiter:
-                message = message + self.delimiter
+        if server.handle_messages is not None:
+            messages = [message for message in messages if message != b'']
 
-            if self.encoding:
-                message = message.encode(self.encoding)
+            if not messages:
+                # Nothing complete was read, or the rate limit dropped all of it.
+                return
 
-            self.client.sendall(message)
+            try:
+                responses = server.handle_messages(messages, self)
+            except Exception as e:
+                logger.exception('Error during handle_messages: %s', e)
+                return
 
-    def send_pending_messages(self):
-        while not self.message_queue.empty():
-            self.send_message(self.message_queue.get())
+            for response in responses:
+                self.send_response(response)
 
-    def run_loop(self):
-        while not self._stop:
-            if self.client is None:
-                try:
-                    self.client, self.address = self.client_queue.get(timeout=0.5)
+            return
 
-                    if self.welcome_message is not None:
-                        self.client.sendall(self.welcome_message + self.delimiter.encode(self.encoding))
-                except Empty:
+        for message in messages:
+            if message != b'':
+                try:
+                    response = server.handle_message(message, self)
+                except Exception as e:
+                    logger.exception('Error during handle_message: %s', e)
                     continue
 
+                self.send_response(response)
+
+    def resume_reading(self):
+        self.rate_paused = False
+        self.update_interest()
+
+    def send_response(self, response):
+        """
+        Sends a value returned by handle_message to the client, and to every other client if it should be broadcast.
+        """
+        broadcast = True
+
+        if type(response) == tuple:
+            response, broadcast = response
+
+        if response is None:
+            return
+
+        # Encode once, the same frame is queued for this client and every client the response is broadcast to.
+        data = self.server.encode_message(response)
+        self.send_data(data)
+
+        if broadcast:
+            self.server.broadcast_queue.append((data, self))
+
+    def on_events(self, events):
+        if events & selectors.EVENT_READ:
             try:
                 self.receive_data()
             except ClientDisconnectedError:
-                # If the client disconnects then self.client is None and the message queue is cleared, so no need
-                # to continue to send_pending_messages
-                continue
+                return
             except Exception as e:
-                # TODO: should we consider the connection dead at this point?
-                logger.exception('Error during receive_data: {}'.format(e))
+                logger.exception('Error during receive_data: %s', e)
+                self.close()
+                return
+
+        if events & selectors.EVENT_WRITE:
+            self.server.pending_workers.add(self)
+
+    def update_interest(self):
+        """
+        Tells the selector which events this worker currently cares about.
+        """
+        if self.client is None:
+            return
+
+        events = 0
+
+        if self.reading and not self.rate_paused:
+            events |= selectors.EVENT_READ
+
+        if self.writing:
+            events |= selectors.EVENT_WRITE
+
+        self.server.selector.modify(self.client, events, self.on_events)
+
+    def send_data(self, data):
+        """
+        Queues already encoded data to be written by the selector loop. Must be called from the selector loop.
+        """
+        if self.client is None:
+            return
+
+        if not self.message_queue.put(data):
+            logger.debug('Outbound buffer for %s overflowed, disconnecting.', self.address)
+            self.close()
+            return
+
+        if self.message_queue.policy == BLOCK and self.message_queue.full and self.reading:
+            # Stop reading requests from this client until it catches up on what we've already sent it.
+            self.server.outbound_stats['blocked'] += 1
+            self.reading = False
+            self.update_interest()
+
+        self.server.pending_workers.add(self)
+
+    def send_message(self, message):
+        self.send_data(self.server.encode_message(message))
 
+    def send_pending_messages(self):
+        # Everything queued since the last write goes out in one vectored write where the platform supports it, so
+        # pipelined requests cost one syscall per read instead of one per response.
+        vectored = hasattr(self.client, 'sendmsg')
+
+        while self.message_queue and self.client is not None:
             try:
-                self.send_pending_messages()
-            except Exception as e:
-                # TODO: should we consider the connection dead at this point?
-                logger.exception('Error during send_data: {}'.format(e))
+                if vectored and len(self.message_queue) > 1:
+                    sent = self.client.sendmsg(self.message_queue.peek_many(MAX_IOVECS))
+                else:
+                    sent = self.client.send(self.message_queue.peek())
+            except (BlockingIOError, InterruptedError):
+                if self.stalled_since is None:
+                    self.stalled_since = self.server.scheduler.time()
+
+                break
+
+            self.stalled_since = None
 
-        self.on_client_disconnect()
+            if self.server.recorder is not None:
+                self.record_sent(sent)
+
+            self.message_queue.consume(sent)
+            self.server.stats['bytes_out'] += sent
+
+        if self.client is None:
+            return
+
+        writing = bool(self.message_queue)
+        reading = self.reading or not self.message_queue.full
+
+        if writing != self.writing or reading != self.reading:
+            self.writing = writing
+            self.reading = reading
+            self.update_interest()
+
+    def record_sent(self, count):
+        """
+        Records the first count bytes of the queue once they have been written. Recording when data is queued instead
+        would include data drop-oldest discards or a disconnect loses, and replays would report false differences.
+        """
+        for data in self.message_queue.peek_many(MAX_IOVECS):
+            if count <= 0:
+                break
+
+            self.server.recorder.record(self.connection_id, SENT, bytes(data[:count]))
+            count -= len(data)
 
     def close(self):
         if self.client:
             self.on_client_disconnect()
 
-    def stop(self):
-        logger.debug('Stopping client worker {}'.format(self.thread.ident))
-        self._stop = True
-
 
 class TcpServer:
     """
@@ -137,99 +303,317 @@ class TcpServer:
     connection at a time and pushes data. If we want to emulate a shitty device that only accepts one connection at a
     time we'll need to create a new server type.
 
-    TODO: Find a way to prompt for login/password per client. This means we'll need some sort of session object that
-          will probably have to be passed to the handle_messages callback.
+    All sockets are served by a single selector loop thread. The loop only wakes up when a socket is readable or when
+    another thread hands it work (a broadcast, closing clients, shutting down) through the wakeup socket, so there is
+    no polling interval involved in responses, broadcasts, or shutdown.
+
+    handle_message is called as handle_message(message, session) with the client's ClientWorker as the Session, so
+    emulators can keep per client state such as a login prompt.
     """
     def __init__(self, port, handle_message, message_parser, encoding='ascii', delimiter='\r\n', welcome_message=None,
-                 debug=False):
+                 debug=False, outbound_limit=65536, overflow_policy=DROP_OLDEST, reuse_port=False,
+                 handle_messages=None, recorder=None, buffer_limit=65536, buffer_policy=DROP, rate_limit=None,
+                 rate_burst=None, rate_policy=PAUSE, broadcast_limit=10000, scheduler=None, backlog=128,
+                 max_connections=None, idle_timeout=None):
+        """
+        :param outbound_limit: The most bytes that may be waiting to be sent to a single client. Optional, defaults to
+        64KiB.
+        :param overflow_policy: What to do when a client's outbound buffer is full, one of drop-oldest, disconnect, or
+        block. See OutboundQueue for details. Optional, defaults to drop-oldest.
+        :param buffer_limit: The most bytes a client may send without completing a message, see InboundLimiter for this
+        and the other limits of what clients send. Optional, defaults to 64KiB.
+        :param buffer_policy: What to do when a client passes buffer_limit, drop or disconnect. Optional, defaults to
+        drop.
+        :param rate_limit: The most messages per second a client may send. Optional, defaults to no limit.
+        :param rate_burst: The most messages a client may send at once. Optional, defaults to rate_limit.
+        :param rate_policy: What to do with messages over the rate limit, one of drop, disconnect, or pause. Optional,
+        defaults to pause.
+        :param broadcast_limit: The most broadcasts from other threads that may wait for the loop, the oldest are
+        dropped past it. Optional, defaults to 10000.
+        :param scheduler: The Scheduler used to resume reading from paused clients and to reap connections. Optional,
+        defaults to the shared real time scheduler.
+        :param backlog: How many connections the OS may queue before they are accepted. Every pending connection is
+        accepted each time the listening socket is readable, up to backlog at a time. Optional, defaults to 128.
+        :param max_connections: The most clients connected at once, like the connection limit of a real device. Clients
+        connecting past it are closed right away. Optional, defaults to no limit.
+        :param idle_timeout: Close clients that haven't sent anything for this many seconds, or that haven't read what
+        they were sent for as long (half-open connections). Optional, defaults to never.
+        :param reuse_port: Listen with SO_REUSEPORT so several processes can share the port. Optional, defaults to
+        False.
+        :param handle_messages: If set, called with the list of every message parsed from a single read and the
+        session instead of calling handle_message for each one. It returns a list of responses in the same form
+        handle_message does. Optional.
+        :param recorder: A Recorder that records everything clients send and are sent, see imitar.recording. Optional.
+        """
         self.port = port
         self.handle_message = handle_message
+        self.handle_messages = handle_messages
+        self.recorder = recorder
         self.message_parser = message_parser
         self.encoding = encoding
         self.delimiter = delimiter
         self.welcome_message = welcome_message
         self.debug = debug
-        self.broadcast_queue = Queue()
-        self.client_queue = Queue()
-        self.client_workers = []
+        self.outbound_limit = outbound_limit
+        self.overflow_policy = overflow_policy
+        self.reuse_port = reuse_port
+        self.buffer_limit = buffer_limit
+        self.buffer_policy = buffer_policy
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.rate_policy = rate_policy
+        self.broadcast_limit = broadcast_limit
+        self.scheduler = scheduler or default_scheduler()
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.outbound_stats = new_outbound_stats()
+        self.inbound_stats = new_inbound_stats()
+        self.stats = new_transport_stats()
+        self.metrics = None
+        self.broadcast_queue = deque()
+        self.pending_calls = deque()
+        self.pending_workers = set()
+        self.client_workers = set()
         self.socket = None
-        self.accept_thread = threading.Thread(target=self.accept_loop, daemon=False)
-        self.client_thread = threading.Thread(target=self.broadcast_loop, daemon=False)
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self.io_thread = threading.Thread(target=self.run_loop, daemon=False)
         self._shutting_down = False
 
-        if self.encoding:
-            if welcome_message is not None:
-                self.welcome_message = self.welcome_message.encode(self.encoding)
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+        self.encoded_delimiter = encode_delimiter(delimiter, encoding)
+        # Fail on invalid limits now rather than when the first client connects.
+        self.new_inbound_limiter()
+        # Encoded once here rather than for every connection.
+        self.welcome_frame = self.encode_message(welcome_message) if welcome_message is not None else None
 
         if self.debug:
             logger.setLevel(DEBUG)
         else:
             logger.setLevel(INFO)
 
+    def encode_message(self, message):
+        """
+        Returns a str, bytes, or Frame message as a Frame, see imitar.frames.
+        """
+        return encode_message(message, self.encoding, self.delimiter, self.encoded_delimiter)
+
+    def new_inbound_limiter(self):
+        return InboundLimiter(self.buffer_limit, self.buffer_policy, self.rate_limit, self.rate_burst, self.rate_policy,
+                              self.inbound_stats, self.scheduler.time)
+
     def create_server_socket(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(('', self.port))
-        sock.listen(5)
+        sock = create_listening_socket(self.port, self.backlog, self.reuse_port)
+        # Binding to port 0 lets the OS pick a free port, keep track of the one it chose.
+        self.port = sock.getsockname()[1]
         self.socket = sock
 
-    def create_workers(self):
-        for i in range(0, 4):
-            worker = ClientWorker(self.client_queue, self.broadcast_queue, self.handle_message, self.message_parser,
-                                  self.encoding, self.delimiter, self.welcome_message)
-            self.client_workers.append(worker)
+    def in_loop(self):
+        """
+        Returns True if the caller is running on the selector loop thread.
+        """
+        return threading.current_thread() is self.io_thread
+
+    def wakeup(self):
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            # Either the wakeup socket is already full, so the loop is going to wake up anyway, or the loop has already
+            # exited and closed it.
+            pass
 
-    def broadcast_message(self, message, from_worker=None):
-        for worker in self.client_workers:
+    def on_wakeup(self, events):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def call_in_loop(self, fn, *args):
+        """
+        Runs fn on the selector loop thread, immediately if we're already on it.
+        """
+        if self.in_loop():
+            fn(*args)
+        else:
+            self.pending_calls.append((fn, args))
+            self.wakeup()
+
+    def remove_worker(self, worker):
+        self.client_workers.discard(worker)
+        self.pending_workers.discard(worker)
+
+        try:
+            self.selector.unregister(worker.client)
+        except (KeyError, ValueError):
+            pass
+
+    def _broadcast(self, message, from_worker=None):
+        start = time.perf_counter()
+        data = self.encode_message(message)
+
+        for worker in list(self.client_workers):
             # Only broadcast to workers that aren't the one that sent the message.
             if from_worker is None or worker != from_worker:
-                worker.send_message(message)
+                worker.send_data(data)
 
-    def broadcast_loop(self):
-        while not self._shutting_down:
-            try:
-                self.broadcast_message(*self.broadcast_queue.get(timeout=0.5))
-            except Empty:
-                # This is normal
-                pass
+        if self.metrics is not None:
+            self.metrics.observe_broadcast(time.perf_counter() - start)
+
+    def broadcast_message(self, message, from_worker=None):
+        """
+        Sends a message to every connected client except from_worker. Safe to call from any thread.
+        """
+        if self.in_loop():
+            self._broadcast(message, from_worker)
+        else:
+            if len(self.broadcast_queue) >= self.broadcast_limit:
+                # The loop has fallen behind, drop the oldest broadcast rather than queue without bound.
+                try:
+                    self.broadcast_queue.popleft()
+                    self.stats['broadcasts_dropped'] += 1
+                except IndexError:
+                    pass
+
+            self.broadcast_queue.append((message, from_worker))
+            self.wakeup()
 
     def accept_client(self, client, address):
-        logger.debug('Accepting connection from {}'.format(address))
-        client.settimeout(0.2)
-        self.client_queue.put((client, address))
+        if self.max_connections is not None and len(self.client_workers) >= self.max_connections:
+            logger.debug('Rejecting connection from %s, max_connections reached', address)
+            self.stats['connections_rejected'] += 1
+            client.close()
+            return
 
-    def accept_loop(self):
-        while not self._shutting_down:
+        logger.debug('Accepting connection from %s', address)
+        worker = ClientWorker(self, client, address)
+        self.stats['connections_accepted'] += 1
+        self.client_workers.add(worker)
+        self.selector.register(client, selectors.EVENT_READ, worker.on_events)
+
+        if self.welcome_frame is not None:
+            worker.send_data(self.welcome_frame)
+
+    def on_acceptable(self, events):
+        # Drain the backlog, when a whole control system reconnects at once there are many connections waiting.
+        for _ in range(self.backlog):
             try:
-                self.accept_client(*self.socket.accept())
+                client, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
             except socket.error as err:
-                logger.error('Error accepting a client socket: {}'.format(err))
+                # Typically out of file descriptors, log once per wakeup rather than for every connection.
+                self.stats['accept_errors'] += 1
+                logger.error('Error accepting a client socket: %s', err)
+                return
 
-    def start(self):
-        self.create_server_socket()
-        self.create_workers()
-        self.accept_thread.start()
-        self.client_thread.start()
+            client.setblocking(False)
+            # Responses are small and latency matters more than packet count, don't let Nagle hold them back.
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.accept_client(client, address)
 
-    def shutdown(self):
-        self._shutting_down = True
+    def reap_connections(self):
+        """
+        Closes idle and half-open clients, see idle_timeout. Runs periodically on the selector loop.
+        """
+        for worker, reason in expired_sessions(list(self.client_workers), self.scheduler.time(), self.idle_timeout):
+            logger.debug('Closing %s connection from %s', reason.replace('_', '-'), worker.address)
+            self.stats['connections_reaped_' + reason] += 1
+            worker.close()
+
+    def process_pending(self):
+        while self.pending_calls:
+            fn, args = self.pending_calls.popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                # A failing timer or callback must not take the loop, and every client with it, down.
+                logger.exception('Error running %s on the selector loop', fn)
+
+        while self.broadcast_queue:
+            self._broadcast(*self.broadcast_queue.popleft())
+
+        while self.pending_workers:
+            worker = self.pending_workers.pop()
+
+            try:
+                worker.send_pending_messages()
+            except Exception as e:
+                logger.debug('Error during send_data to %s: %s', worker.address, e)
+                worker.close()
+
+    def run_loop(self):
+        self.selector.register(self.socket, selectors.EVENT_READ, self.on_acceptable)
+        self.selector.register(self._wakeup_reader, selectors.EVENT_READ, self.on_wakeup)
+
+        while not self._shutting_down:
+            for key, events in self.selector.select():
+                try:
+                    key.data(events)
+                except Exception:
+                    logger.exception('Error handling selector events for %s', key.fileobj)
+
+            self.process_pending()
 
-        logger.debug('Stopping workers')
-        for worker in self.client_workers:
-            worker.stop()
+        self._close_all_clients()
+        self.selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
 
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
         except socket.error as err:
             if err.errno != errno.ENOTCONN:
-                logger.debug('Failed to shut down socket. {}'.format(err))
+                logger.debug('Failed to shut down socket. %s', err)
         finally:
             self.socket.close()
 
+    def gauges(self):
+        """
+        Returns the current size of the server's queues, safe to call from any thread.
+        """
+        workers = list(self.client_workers)
+
+        return {
+            'clients': len(workers),
+            'broadcast_queue': len(self.broadcast_queue),
+            'message_queue': sum(len(worker.message_queue) for worker in workers),
+            'message_queue_bytes': sum(worker.message_queue.size for worker in workers),
+        }
+
+    def start(self):
+        self.create_server_socket()
+        self.io_thread.start()
+
+        if self.idle_timeout is not None:
+            self.scheduler.call_every(min(self.idle_timeout / 2, 1.0), self.reap_connections,
+                                      executor=self.call_in_loop, owner=self)
+
+    def shutdown(self):
+        logger.debug('Stopping selector loop')
+        self._shutting_down = True
+        self.scheduler.cancel_all(self)
+
+        if not self.io_thread.is_alive():
+            return
+
+        self.wakeup()
+
+        if not self.in_loop():
+            self.io_thread.join()
+
+    def _close_all_clients(self):
+        for worker in list(self.client_workers):
+            worker.close()
+
     def close_all_clients(self):
         """
         Use this to close all the clients without shutting the server down. i.e. to emulate something like a Samsung DMD
-        that closes all connections during power on.
+        that closes all connections during power on. Safe to call from any thread.
         :return:
         """
-        for worker in self.client_workers:
-            worker.close()
+        self.call_in_loop(self._close_all_clients)
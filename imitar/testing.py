@@ -0,0 +1,38 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import pytest
+
+
+def emulator_fixture(emulator_class, disconnect=True, **kwargs):
+    """
+    Returns a pytest fixture that starts a single emulator the first time it is used and hands every test the same one,
+    restored to the state it started in. Restoring is much cheaper than starting a new emulator for every test: no new
+    transport, port, or threads. Timers the emulator started with state=True and control scripts are cancelled between
+    tests, other timers keep running across them, see Emulator.restore.
+
+        tv = emulator_fixture(FakeTvEmulator, transport_class=LoopbackTransport)
+
+        def test_volume(tv):
+            client = tv.transport.connect()
+            ...
+
+    :param emulator_class: An Emulator subclass.
+    :param disconnect: If True close the clients of the previous test before each test. Optional, defaults to True.
+    :param kwargs: Passed to the emulator's constructor.
+    """
+    kwargs.setdefault('handle_signals', False)
+    emulators = []
+
+    @pytest.fixture
+    def fixture(request):
+        if not emulators:
+            emulator = emulator_class(0, **kwargs)
+            emulator.start()
+            emulator.checkpoint('initial')
+            emulators.append(emulator)
+            request.config.add_cleanup(emulator.stop)
+        else:
+            emulators[0].restore('initial', disconnect=disconnect)
+
+        return emulators[0]
+
+    return fixture
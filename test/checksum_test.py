@@ -0,0 +1,76 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import pytest
+
+from imitar.checksum import SUM8, XOR8, CRC8, CRC8_MAXIM, CRC16_XMODEM, CRC16_CCITT_FALSE, CRC16_ARC, CRC16_MODBUS, \
+    CRC32, Crc, ChecksumFraming, ChecksumMessageParser
+from imitar.message_parser import CursorVariableLengthMessageParser, VariableLengthMessageParser
+
+
+@pytest.mark.parametrize('checksum, expected', [
+    (SUM8, 0xDD),
+    (XOR8, 0x31),
+    (CRC8, 0xF4),
+    (CRC8_MAXIM, 0xA1),
+    (CRC16_XMODEM, 0x31C3),
+    (CRC16_CCITT_FALSE, 0x29B1),
+    (CRC16_ARC, 0xBB3D),
+    (CRC16_MODBUS, 0x4B37),
+    # Not the CCITT polynomial, so the table is used instead of binascii.
+    (Crc(16, 0x8005), 0xFEE8),
+])
+def test_check_values(checksum, expected):
+    assert checksum.compute(b'123456789') == expected
+    assert checksum.compute(memoryview(bytearray(b'123456789'))) == expected
+
+
+def test_framing_round_trip():
+    framing = ChecksumFraming(CRC16_MODBUS, header=b'\x01', covers_header=True, byteorder='little')
+    frame = framing.build(b'\x03\x00\x00\x00\x0a')
+
+    assert frame == b'\x01\x03\x00\x00\x00\x0a\xc5\xcd'
+    assert framing.is_valid(frame)
+    assert not framing.is_valid(frame[:-1] + b'\x00')
+    assert not framing.is_valid(b'\x01')
+    assert framing.payload(frame) == b'\x03\x00\x00\x00\x0a'
+
+
+@pytest.mark.parametrize('parser_class', [VariableLengthMessageParser, CursorVariableLengthMessageParser])
+def test_checksum_message_parser(parser_class):
+    # Samsung MDC frames: header, command, id, length, data, and a checksum of everything but the header.
+    framing = ChecksumFraming(SUM8, header=b'\xaa')
+    mp = ChecksumMessageParser(parser_class(b'\xaa', 3, 1, include_header=True), framing)
+    good = framing.build(b'\x11\x00\x01\x01')
+    bad = good[:-1] + b'\x00'
+    buffer = mp.new_buffer()
+    buffer.extend(good + bad + good[:3])
+    messages, buffer = mp.process_buffer(buffer)
+
+    assert good == b'\xaa\x11\x00\x01\x01\x13'
+    assert messages == [b'\x11\x00\x01\x01']
+    assert mp.invalid == 1
+
+    buffer.extend(good[3:])
+    messages, buffer = mp.process_buffer(buffer)
+
+    assert messages == [b'\x11\x00\x01\x01']
+
+
+@pytest.mark.parametrize('checksum, expected', [
+    (CRC32, 0xCBF43926),
+    # CRC-32/JAMCRC and CRC-32/BZIP2, binascii with a different xor_out, and the table.
+    (Crc(32, 0x04C11DB7, 0xFFFFFFFF, reflect=True), 0x340BC6D9),
+    (Crc(32, 0x04C11DB7, 0xFFFFFFFF, xor_out=0xFFFFFFFF), 0xFC891918),
+])
+def test_crc32_check_values(checksum, expected):
+    assert checksum.compute(b'123456789') == expected
+    assert checksum.compute(memoryview(bytearray(b'123456789'))) == expected
+
+
+def test_crc_results_are_cached_per_message():
+    crc = Crc(16, 0x8005, 0xFFFF, reflect=True)
+
+    for _ in range(2):
+        assert crc.compute(b'123456789') == 0x4B37
+        assert crc.compute(bytearray(b'12345678')) == crc.compute(b'12345678')
+
+    assert crc.compute(b'12345678') != 0x4B37
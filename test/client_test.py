@@ -0,0 +1,115 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import asyncio
+import queue
+import threading
+
+import pytest
+
+from imitar.async_tcp_server import AsyncTcpServer
+from imitar.client import AsyncClient, AsyncClientPool, Client, ClientPool, same_command
+from imitar.dispatch import command
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.tcp_server import TcpServer
+
+
+@pytest.fixture(params=[TcpServer, AsyncTcpServer])
+def tv(request):
+    tv = FakeTvEmulator(0, transport_class=request.param, handle_signals=False)
+    tv.start()
+    yield tv
+    tv.transport.shutdown()
+
+
+def test_pipelined_requests(tv):
+    with Client('127.0.0.1', tv.transport.port, welcome=True) as client:
+        assert client.welcome_message == FakeTvEmulator.welcome_message
+        assert client.request_many(['VOLM 20', 'VOLM ?', 'MUTE ?']) == ['VOLM 20', 'VOLM 20', 'MUTE 0']
+
+
+def test_broadcast_subscriptions():
+    switcher = ExtronMps601Emulator(0, handle_signals=False)
+    switcher.start()
+    signals = queue.Queue()
+
+    try:
+        with Client('127.0.0.1', switcher.transport.port, is_broadcast=lambda message: message.startswith('Sig')) \
+                as client:
+            client.subscribe(signals.put, prefix='Sig')
+            switcher.set_connection_status(2, False)
+
+            assert signals.get(timeout=2) == 'Sig 1 1 0 1 1 1*1'
+            assert client.request('3!') == 'In3 All'
+    finally:
+        switcher.transport.shutdown()
+
+
+def test_correlates_responses_with_broadcasts(tv):
+    async def run():
+        options = dict(welcome=True, correlate=same_command)
+
+        async with AsyncClient('127.0.0.1', tv.transport.port, **options) as first, \
+                AsyncClient('127.0.0.1', tv.transport.port, **options) as second:
+            broadcasts = []
+            second.subscribe(broadcasts.append)
+            await first.request('VOLM 30')
+            # The volume broadcast arrives while the input query is in flight, it must not be taken as its response.
+            assert await second.request('INPT ?') == 'INPT HDMI_1'
+            assert await second.request('VOLM ?') == 'VOLM 30'
+            assert broadcasts == ['VOLM 30']
+
+    asyncio.run(run())
+
+
+def test_pool_reuses_connections(tv):
+    with ClientPool(size=2, welcome=True) as pool:
+        for _ in range(4):
+            assert pool.request('127.0.0.1', tv.transport.port, 'POWR ?') == 'POWR 0'
+
+        assert pool.request_many('127.0.0.1', tv.transport.port, ['VOLM 5', 'VOLM ?']) == ['VOLM 5', 'VOLM 5']
+        assert tv.transport.stats['connections_accepted'] == 2
+
+
+def test_async_pool_shares_connections_while_connecting(tv):
+    async def run():
+        pool = AsyncClientPool(welcome=True)
+        responses = await asyncio.gather(*[pool.request('127.0.0.1', tv.transport.port, 'POWR ?') for _ in range(10)])
+        await pool.close()
+
+        return responses
+
+    assert asyncio.run(run()) == ['POWR 0'] * 10
+    assert tv.transport.stats['connections_accepted'] == 1
+
+
+class SlowTvEmulator(FakeTvEmulator):
+    @command(r'SLOW', name='SLOW')
+    def handle_slow(self):
+        # Answers once the test has given up on the response.
+        self.answer.wait(5)
+
+        return 'SLOW', False
+
+
+def test_late_responses_are_not_taken_for_later_ones():
+    tv = SlowTvEmulator(0, handle_signals=False)
+    tv.answer = threading.Event()
+    tv.start()
+
+    try:
+        with Client('127.0.0.1', tv.transport.port, welcome=True) as client:
+            with pytest.raises(asyncio.TimeoutError):
+                client.request('SLOW', timeout=0.05)
+
+            tv.answer.set()
+
+            with pytest.raises(ConnectionError):
+                client.request('VOLM ?')
+    finally:
+        tv.transport.shutdown()
+
+
+def test_zero_timeout_is_not_the_default(tv):
+    with Client('127.0.0.1', tv.transport.port, welcome=True, timeout=5) as client:
+        with pytest.raises(asyncio.TimeoutError):
+            client.request('VOLM ?', timeout=0)
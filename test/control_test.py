@@ -0,0 +1,109 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import json
+import os
+import tempfile
+
+import pytest
+
+from imitar.control import Control, ControlError, method_call, set_value, toggle
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.loopback import LoopbackTransport
+from imitar.scheduler import Scheduler, VirtualClock
+
+
+def test_apply_is_one_update():
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    client = switcher.transport.connect()
+    version = switcher.state.version
+    reply = switcher.controller.execute({'op': 'apply', 'changes': [toggle('connection_state', 0),
+                                                                    toggle('connection_state', 1),
+                                                                    set_value('active_input', 4)]})
+
+    assert reply == {'ok': True, 'version': version + 1}
+    assert client.read_all() == ['Sig 0 0 1 1 1 1*1', 'In4 All']
+
+    switcher.controller.execute({'op': 'apply', 'calls': [method_call('set_connection_status', 0, True)]})
+
+    assert client.read_all() == ['Sig 1 0 1 1 1 1*1']
+
+
+def test_event_script():
+    clock = VirtualClock()
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False,
+                                    scheduler=Scheduler(clock))
+    client = switcher.transport.connect()
+    switcher.controller.every(0.01, [toggle('connection_state', 2)], duration=0.035)
+
+    for _ in range(5):
+        clock.advance(0.01)
+
+    assert client.read_all() == ['Sig 1 1 0 1 1 1*1', 'Sig 1 1 1 1 1 1*1', 'Sig 1 1 0 1 1 1*1']
+    assert switcher.controller.scripts == {}
+
+
+@pytest.mark.parametrize('use_unix_socket', [False, True])
+def test_control_server(use_unix_socket):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'control.sock') if use_unix_socket else None
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False,
+                                    control_port=None if use_unix_socket else 0, control_path=path)
+    switcher.start()
+    address = {'path': path} if use_unix_socket else {'port': switcher.control_server.port}
+
+    try:
+        with Control(**address) as control:
+            control.update(active_input=3)
+            control.call('set_connection_status', 5, False)
+
+            assert control.get('active_input', 'connection_state') == {'active_input': 3,
+                                                                       'connection_state': [1, 1, 1, 1, 1, 0, 1]}
+
+            script = control.after(60, set_value('active_input', 1))
+
+            assert control.cancel(script) == 1
+
+            with pytest.raises(ControlError):
+                control.call('stop')
+
+            with pytest.raises(ControlError):
+                control.update(missing=1)
+    finally:
+        switcher.stop()
+        os.rmdir(directory)
+
+
+@pytest.mark.parametrize('command', [
+    {'op': 'after', 'delay': 0, 'changes': [toggle('connection_state', 20)]},
+    {'op': 'after', 'delay': 0, 'changes': [toggle('active_input')]},
+    {'op': 'every', 'interval': 1, 'changes': [set_value('active_input', 2, index=0)]},
+    {'op': 'every', 'interval': 1, 'calls': [method_call('set_connection_status', 1)]},
+    {'op': 'every', 'interval': 0, 'changes': [toggle('connection_state', 2)]},
+    {'op': 'every', 'interval': -0.01, 'changes': [toggle('connection_state', 2)]},
+    {'op': 'every', 'interval': 0.01, 'duration': -1, 'changes': [toggle('connection_state', 2)]},
+    {'op': 'after', 'delay': -1, 'changes': [toggle('connection_state', 2)]},
+    {'op': 'after', 'delay': '1', 'changes': [toggle('connection_state', 2)]},
+])
+def test_scripts_are_validated_before_scheduling(command):
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False,
+                                    scheduler=Scheduler(VirtualClock()))
+    switcher.state.update(active_input=3)
+    reply = json.loads(switcher.controller.handle_line(json.dumps(command)))
+
+    assert reply['ok'] is False
+    assert switcher.controller.scripts == {}
+    assert switcher.scheduler.next_deadline() is None
+
+
+def test_failing_script_is_cancelled():
+    clock = VirtualClock()
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False,
+                                    scheduler=Scheduler(clock))
+    client = switcher.transport.connect()
+    # Valid arguments, but there is no input 9, so every run fails.
+    switcher.controller.every(0.01, calls=[method_call('set_connection_status', 9, True)])
+    clock.advance(0.01)
+    clock.advance(0.01)
+
+    assert switcher.controller.scripts == {}
+    assert switcher.scheduler.next_deadline() is None
+    assert client.read_all() == []
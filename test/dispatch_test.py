@@ -0,0 +1,134 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import threading
+
+from imitar.dispatch import CommandRouter, command, literal_prefix
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+
+
+def text(response):
+    message, broadcast = response
+
+    if isinstance(message, bytes):
+        message = message.decode('ascii')[:-2]
+
+    return message, broadcast
+
+
+def test_literal_prefix():
+    assert literal_prefix(r'VOLM (?P<value>.*)') == 'VOLM '
+    assert literal_prefix(r'\x1bAUSW') == '\x1bAUSW'
+    assert literal_prefix(r'POWR\?') == 'POWR?'
+    assert literal_prefix(r'ABC?') == 'AB'
+    assert literal_prefix(r'AB|CD') == ''
+    assert literal_prefix(r'(?P<n>\d)!') == ''
+    assert literal_prefix(b'\xaa\x01(?P<data>.*)') == b'\xaa\x01'
+
+
+def test_router_prefers_longest_prefix():
+    router = CommandRouter()
+    router.add(r'(?P<anything>.*)', 'fallback')
+    router.add(r'IN(?P<value>.*)', 'short')
+    router.add(r'INPT (?P<value>.*)', 'long')
+
+    route, match = router.match('INPT VGA')
+    assert route.handler == 'long'
+    assert match.group('value') == 'VGA'
+    assert router.match('INX')[0].handler == 'short'
+    assert router.match('OTHER')[0].handler == 'fallback'
+
+
+def test_router_scales_to_many_routes():
+    router = CommandRouter()
+
+    for i in range(1000):
+        router.add(r'CMD{:04d} (?P<value>\d+)'.format(i), i)
+
+    route, match = router.match('CMD0999 42')
+    assert route.handler == 999
+    assert match.group('value') == '42'
+    assert router.match('CMD1000 42') == (None, None)
+
+
+def test_fake_tv_routes():
+    tv = FakeTvEmulator(0, handle_signals=False)
+
+    assert text(tv.handle_message('VOLM 10')) == ('VOLM 10', True)
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 10', False)
+    assert text(tv.handle_message('VOLM 1 2')) == ('ERR', False)
+    assert text(tv.handle_message('POWR')) == ('ERR', False)
+    assert tv.command_label('INPT VGA') == 'INPT'
+    assert tv.command_label('BOGUS') == 'unknown'
+
+
+def test_extron_routes():
+    switcher = ExtronMps601Emulator(0, handle_signals=False)
+
+    assert text(switcher.handle_message('3!')) == ('In3 All', True)
+    assert text(switcher.handle_message('!')) == ('3', False)
+    assert text(switcher.handle_message('0LS')) == ('1 1 1 1 1 1*1', False)
+    assert text(switcher.handle_message('\x1b1AUSW')) == ('Ausw1', True)
+    assert text(switcher.handle_message('WAUSW')) == ('1', False)
+    assert text(switcher.handle_message('4!')) == ('E06', False)
+    assert text(switcher.handle_message('W1CV')) == ('Vrb1', False)
+    assert text(switcher.handle_message('BOGUS')) == ('E10', False)
+
+
+class CountingTvEmulator(FakeTvEmulator):
+    calls = 0
+
+    @command(r'VOLM \?', name='VOLM', depends=('volume',))
+    @command(r'VOLM (?P<value>[^ ]*)', name='VOLM')
+    def handle_volume(self, value='?'):
+        self.calls += 1
+
+        return super().handle_volume(value)
+
+
+def test_query_responses_are_cached_until_state_changes():
+    tv = CountingTvEmulator(0, handle_signals=False)
+
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 0', False)
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 0', False)
+    assert tv.calls == 1
+
+    tv.handle_message('VOLM 30')
+
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 30', False)
+    assert tv.calls == 3
+
+    tv.state.update(volume=40)
+
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 40', False)
+
+
+def test_in_place_changes_are_invalidated():
+    switcher = ExtronMps601Emulator(0, handle_signals=False)
+
+    assert text(switcher.handle_message('0LS')) == ('1 1 1 1 1 1*1', False)
+
+    switcher.set_connection_status(2, False)
+
+    assert text(switcher.handle_message('0LS')) == ('1 1 0 1 1 1*1', False)
+
+
+class RacingTvEmulator(FakeTvEmulator):
+    racing = False
+
+    def encode_message(self, message):
+        if self.racing:
+            # Another thread changes the volume after the query's handler has returned, before it is cached.
+            self.racing = False
+            thread = threading.Thread(target=self.state.update, kwargs={'volume': 50})
+            thread.start()
+            thread.join()
+
+        return super().encode_message(message)
+
+
+def test_changes_racing_a_query_are_not_cached():
+    tv = RacingTvEmulator(0, handle_signals=False)
+    tv.racing = True
+
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 0', False)
+    assert text(tv.handle_message('VOLM ?')) == ('VOLM 50', False)
@@ -0,0 +1,22 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import socket
+
+
+def read_line(sock):
+    data = b''
+
+    while not data.endswith(b'\r\n'):
+        chunk = sock.recv(1)
+        assert chunk != b''
+        data += chunk
+
+    return data[:-2].decode('ascii')
+
+
+def connect(port, welcome_message=None):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=2)
+
+    if welcome_message is not None:
+        assert read_line(sock) == welcome_message
+
+    return sock
@@ -0,0 +1,74 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import os
+import signal
+import socket
+import time
+
+from emulator_helpers import connect, read_line
+from imitar.farm import EmulatorFarm, REUSE_PORT
+from imitar.fake_tv_emulator import FakeTvEmulator
+
+TV = 'imitar.fake_tv_emulator.FakeTvEmulator'
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+def ports(farm):
+    return [emulator['labels']['port'] for worker in farm.stats()['workers'] for emulator in worker['emulators']]
+
+
+def test_shard_mode_restarts_crashed_workers():
+    farm = EmulatorFarm({'emulators': [{'class': TV, 'port': 0, 'count': 2}]}, workers=2, stats_interval=0.1,
+                        restart_delay=0)
+    farm.start()
+
+    try:
+        wait_for(lambda: len(ports(farm)) == 2)
+
+        for port in ports(farm):
+            client = connect(port, FakeTvEmulator.welcome_message)
+            client.sendall(b'POWR ?\r\n')
+            assert read_line(client) == 'POWR 0'
+            client.close()
+
+        wait_for(lambda: farm.stats()['counters']['messages_parsed'] == 2)
+        os.kill(farm.workers[0].process.pid, signal.SIGKILL)
+        wait_for(lambda: farm.stats()['restarts'] == 1 and len(ports(farm)) == 2)
+    finally:
+        farm.shutdown()
+
+
+def test_reuse_port_mode_shares_a_port():
+    port = free_port()
+    farm = EmulatorFarm({'emulators': [{'class': TV, 'port': port}]}, workers=2, mode=REUSE_PORT, stats_interval=0.1)
+    farm.start()
+    clients = []
+
+    try:
+        wait_for(lambda: len(ports(farm)) == 2)
+        assert ports(farm) == [port, port]
+
+        for _ in range(10):
+            client = connect(port, FakeTvEmulator.welcome_message)
+            clients.append(client)
+            client.sendall(b'VOLM ?\r\n')
+            assert read_line(client) == 'VOLM 0'
+
+        wait_for(lambda: farm.stats()['counters']['connections_accepted'] == 10)
+    finally:
+        for client in clients:
+            client.close()
+
+        farm.shutdown()
@@ -0,0 +1,48 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import json
+
+from emulator_helpers import connect, read_line
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.host import EmulatorHost
+
+
+def test_host_runs_emulators_from_config(tmpdir):
+    config = tmpdir.join('campus.json')
+    config.write(json.dumps({
+        'emulators': [
+            {'class': 'imitar.fake_tv_emulator.FakeTvEmulator', 'port': 0, 'count': 3, 'state': {'volume': 20}},
+            {'class': 'imitar.extron_mps_601_emulator.ExtronMps601Emulator', 'port': 0},
+        ]
+    }))
+    host = EmulatorHost()
+    emulators = host.load_config(str(config))
+    host.start()
+    clients = []
+
+    try:
+        assert [type(emulator) for emulator in emulators] == [FakeTvEmulator] * 3 + [ExtronMps601Emulator]
+        assert len({emulator.transport.port for emulator in emulators}) == 4
+
+        for tv in emulators[:3]:
+            client = connect(tv.transport.port, FakeTvEmulator.welcome_message)
+            clients.append(client)
+            client.sendall(b'VOLM ?\r\n')
+            assert read_line(client) == 'VOLM 20'
+
+        switcher = connect(emulators[3].transport.port)
+        clients.append(switcher)
+        switcher.sendall(b'0LS\r\n')
+        assert read_line(switcher) == '1 1 1 1 1 1*1'
+
+        # Emulators added after the host started are started right away.
+        tv = host.add(FakeTvEmulator, 0)
+        client = connect(tv.transport.port, FakeTvEmulator.welcome_message)
+        clients.append(client)
+        client.sendall(b'POWR ?\r\n')
+        assert read_line(client) == 'POWR 0'
+    finally:
+        for client in clients:
+            client.close()
+
+        host.shutdown()
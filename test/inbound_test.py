@@ -0,0 +1,132 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import pytest
+
+import emulator_helpers
+from imitar.async_tcp_server import AsyncTcpServer
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.inbound import InboundLimiter, DISCONNECT, DROP, PAUSE
+from imitar.loopback import LoopbackTransport
+from imitar.message_parser import ParseBuffer
+from imitar.scheduler import Scheduler, VirtualClock
+from imitar.tcp_server import TcpServer
+
+
+def test_buffer_limit_counts_unparsed_bytes():
+    limiter = InboundLimiter(buffer_limit=4, buffer_policy=DISCONNECT)
+    buffer = ParseBuffer(b'abcdefgh')
+    buffer.offset = 4
+
+    assert limiter.check_buffer(buffer) is None
+
+    buffer.offset = 3
+
+    assert limiter.check_buffer(buffer) == DISCONNECT
+    assert limiter.stats['buffer_disconnected'] == 1
+
+
+def test_rate_limit_policies():
+    clock = VirtualClock()
+    messages = ['a', 'b', 'c', 'd']
+    dropping = InboundLimiter(rate_limit=2, rate_policy=DROP, clock=clock.time)
+
+    assert dropping.admit(messages) == (['a', 'b'], DROP)
+    assert dropping.stats['rate_dropped'] == 2
+
+    clock.advance(0.5)
+
+    assert dropping.admit(messages) == (['a'], DROP)
+
+    disconnecting = InboundLimiter(rate_limit=2, rate_burst=3, rate_policy=DISCONNECT, clock=clock.time)
+
+    assert disconnecting.admit(messages) == (['a', 'b', 'c'], DISCONNECT)
+
+    pausing = InboundLimiter(rate_limit=2, rate_policy=PAUSE, clock=clock.time)
+
+    assert pausing.admit(messages) == (messages, PAUSE)
+    assert pausing.resume_delay() == 1.0
+
+    clock.advance(1)
+
+    assert pausing.admit(['e']) == (['e'], PAUSE)
+    assert pausing.resume_delay() == 0.5
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        InboundLimiter(buffer_policy=PAUSE)
+
+
+def test_paused_client_is_resumed():
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock),
+                        transport_options={'rate_limit': 2})
+    client = tv.transport.connect()
+    client.read_all()
+    client.send(b'VOLM 1\r\nVOLM 2\r\nVOLM 3\r\n')
+    client.send_message('VOLM ?')
+
+    assert client.read_all() == ['VOLM 1', 'VOLM 2', 'VOLM 3']
+
+    clock.advance(0.5)
+
+    # The held message is handled on resume, which puts the client back in debt.
+    assert client.read_all() == ['VOLM 3']
+    assert tv.transport.inbound_stats['rate_paused'] == 2
+
+
+def test_unparsed_data_is_dropped():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False,
+                        transport_options={'buffer_limit': 16})
+    client = tv.transport.connect()
+    client.read_all()
+    client.send(b'X' * 32)
+    client.send_message('VOLM ?')
+
+    assert client.read_all() == ['VOLM 0']
+    assert tv.transport.inbound_stats['buffer_dropped'] == 1
+
+
+@pytest.mark.parametrize('transport_class', [TcpServer, AsyncTcpServer])
+def test_flooding_client_is_disconnected(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False,
+                        transport_options={'buffer_limit': 1024, 'buffer_policy': DISCONNECT})
+    tv.start()
+    client = emulator_helpers.connect(tv.transport.port, FakeTvEmulator.welcome_message)
+
+    try:
+        try:
+            client.sendall(b'X' * 4096)
+        except ConnectionError:
+            pass
+
+        assert client.recv(1) == b''
+        assert tv.transport.inbound_stats['buffer_disconnected'] == 1
+    finally:
+        client.close()
+        tv.stop()
+
+
+class BatchTvEmulator(FakeTvEmulator):
+    def __init__(self, port, **kwargs):
+        super().__init__(port, **kwargs)
+        self.batches = []
+
+    def handle_messages(self, messages):
+        self.batches.append(len(messages))
+
+        return super().handle_messages(messages)
+
+
+def test_empty_batches_are_not_handled():
+    clock = VirtualClock()
+    tv = BatchTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock),
+                         transport_options={'rate_limit': 2, 'rate_policy': DROP})
+    client = tv.transport.connect()
+    client.read_all()
+    client.send(b'VOLM 1\r\nVOLM 2\r\n')
+    # Dropped by the rate limit, then a read without a complete message.
+    client.send(b'VOLM 3\r\n')
+    client.send(b'VOLM')
+
+    assert client.read_all() == ['VOLM 1', 'VOLM 2']
+    assert tv.batches == [2]
@@ -0,0 +1,39 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import logging
+
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.log import TrafficLog, read_traffic_log, RECEIVED, SENT
+from imitar.loopback import LoopbackTransport
+
+
+def test_binary_traffic_log(tmp_path):
+    path = str(tmp_path / 'traffic.bin')
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, traffic_log=TrafficLog(path=path))
+    client = tv.transport.connect()
+    client.send_message('VOLM 10')
+    client.send_message('BOGUS')
+    tv.stop()
+    records = [(direction, data) for _, direction, data in read_traffic_log(path)]
+
+    assert records == [(RECEIVED, b'VOLM 10'), (SENT, b'VOLM 10\r\n'), (RECEIVED, b'BOGUS'), (SENT, b'ERR\r\n')]
+
+
+def test_sampled_text_traffic_log(caplog):
+    traffic_log = TrafficLog('tv', sample_rate=0.5)
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, traffic_log=traffic_log)
+    client = tv.transport.connect()
+
+    with caplog.at_level(logging.INFO, logger='traffic.tv'):
+        for volume in range(4):
+            client.send_message('VOLM {}'.format(volume))
+
+    assert [record.getMessage() for record in caplog.records] == [
+        "tv < 'VOLM 1'", "tv > 'VOLM 1'", "tv < 'VOLM 3'", "tv > 'VOLM 3'",
+    ]
+
+
+def test_any_sample_rate_is_exact():
+    for sample_rate in (0.1, 0.5, 0.6, 0.7, 0.99, 1):
+        traffic_log = TrafficLog('tv', sample_rate=sample_rate)
+
+        assert sum(traffic_log.sampled() for _ in range(1000)) == round(1000 * sample_rate)
@@ -0,0 +1,84 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import pytest
+
+from imitar.dispatch import command
+from imitar.emulator import Emulator
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.frames import frame
+from imitar.loopback import LoopbackTransport
+from imitar.message_parser import CursorCharacterMessageParser
+from imitar.tcp_server import ClientDisconnectedError
+
+
+def test_responses_and_broadcasts():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    tv.start()
+    first = tv.transport.connect()
+    second = tv.transport.connect()
+
+    assert first.read_all() == [FakeTvEmulator.welcome_message]
+    assert second.read_all() == [FakeTvEmulator.welcome_message]
+
+    first.send_message('VOLM 10')
+    first.send_message('MUTE ?')
+
+    assert first.read_all() == ['VOLM 10', 'MUTE 0']
+    assert second.read_all() == ['VOLM 10']
+
+
+def test_partial_messages_are_buffered():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    client = tv.transport.connect()
+    client.read()
+    client.send(b'VOL')
+
+    assert client.read() is None
+
+    client.send(b'M ?\r\nINPT ?\r\n')
+
+    assert client.read_all() == ['VOLM 0', 'INPT HDMI_1']
+
+
+def test_unsolicited_broadcasts():
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    client = switcher.transport.connect()
+    switcher.set_connection_status(2, False)
+
+    assert client.read_all() == ['Sig 1 1 0 1 1 1*1']
+
+
+def test_close_all_clients():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    client = tv.transport.connect()
+    tv.transport.close_all_clients()
+
+    with pytest.raises(ClientDisconnectedError):
+        client.send_message('VOLM ?')
+
+
+class BytesEmulator(Emulator):
+    message_parser = CursorCharacterMessageParser(b'\n')
+    ERR = frame(b'ERR', None, b'\n')
+
+    def __init__(self, port, **kwargs):
+        super().__init__(port, self.message_parser, delimiter=b'\n', encoding=None, **kwargs)
+
+    @command(rb'PING (?P<token>.*)')
+    def handle_ping(self, token):
+        return b'PONG ' + token, True
+
+    def handle_message(self, message):
+        return self.dispatch(message, (self.ERR, False))
+
+
+def test_bytes_native_emulator():
+    emulator = BytesEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    first = emulator.transport.connect()
+    second = emulator.transport.connect()
+    first.send(b'PING 1\nBOGUS\n')
+
+    # The response is encoded once and the same frame is queued for every client.
+    assert first.inbox[0] is second.inbox[0]
+    assert first.read_all() == [b'PONG 1', b'ERR']
+    assert second.read_all() == [b'PONG 1']
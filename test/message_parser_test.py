@@ -1,5 +1,6 @@
 # Copyright 2015 jydo inc. All rights reserved.
-from imitar.message_parser import CharacterMessageParser, FixedLengthMessageParser, VariableLengthMessageParser
+from imitar.message_parser import CharacterMessageParser, FixedLengthMessageParser, VariableLengthMessageParser, \
+    CursorCharacterMessageParser, CursorFixedLengthMessageParser, CursorVariableLengthMessageParser, ParseBuffer
 
 
 def check_message_parser(mp, incoming, expected_messages, expected_buffer):
@@ -40,3 +41,67 @@ def test_variable_length_message_parser():
     mp = VariableLengthMessageParser(b'\xaa', 3, 1)
 
     check_message_parser(mp, incoming, [b'\x41\x12\x32\x00'], b'\xaa\xff\x00')
+
+
+def check_cursor_message_parser(mp, incoming, expected_messages, expected_buffer):
+    # Feed the stream one byte at a time into a single buffer, the parser has to pick up where it left off each time.
+    buffer = mp.new_buffer()
+    messages = []
+
+    for i in range(len(incoming)):
+        buffer.extend(incoming[i:i + 1])
+        new_messages, buffer = mp.process_buffer(buffer)
+        messages.extend(new_messages)
+
+    assert messages == expected_messages
+    assert buffer.unread() == expected_buffer
+
+    # Parsing the whole stream at once has to give the same result.
+    messages, buffer = mp.process_buffer(bytearray(incoming))
+
+    assert messages == expected_messages
+    assert buffer.unread() == expected_buffer
+
+
+def test_cursor_character_message_parser():
+    incoming = bytearray(b'MESSAGE ONE\r\nMESSAGE TWO\r\nMESS')
+    mp_with_encoding = CursorCharacterMessageParser('\r\n', 'ascii')
+    mp_without_encoding = CursorCharacterMessageParser(b'\r\n')
+
+    check_cursor_message_parser(mp_with_encoding, incoming, ['MESSAGE ONE', 'MESSAGE TWO'], b'MESS')
+    check_cursor_message_parser(mp_without_encoding, incoming, [b'MESSAGE ONE', b'MESSAGE TWO'], b'MESS')
+
+
+def test_cursor_fixed_length_message_parser():
+    incoming = bytearray(b'\xaa\xff\xff\xfe\xaa\x1b\x2b\x3b\xaa')
+    mp_no_header = CursorFixedLengthMessageParser(None, 3)
+    no_header_messages = [b'\xaa\xff\xff', b'\xfe\xaa\x1b', b'\x2b\x3b\xaa']
+    mp_with_header = CursorFixedLengthMessageParser(b'\xaa', 3)
+    with_header_messages = [b'\xaa\xff\xff', b'\xaa\x1b\x2b']
+
+    check_cursor_message_parser(mp_no_header, incoming, no_header_messages, b'')
+    check_cursor_message_parser(mp_with_header, incoming, with_header_messages, b'\x3b\xaa')
+
+
+def test_cursor_variable_length_message_parser():
+    incoming = bytearray(b'\xaa\xff\x00\x03\x41\x12\x32\x00\xaa\xff\x00')
+    mp = CursorVariableLengthMessageParser(b'\xaa', 3, 1)
+
+    check_cursor_message_parser(mp, incoming, [b'\x41\x12\x32\x00'], b'\xaa\xff\x00')
+
+
+def test_parse_buffer_compacts_consumed_data():
+    mp = CursorCharacterMessageParser(b'\r\n')
+    buffer = mp.new_buffer()
+    buffer.extend(b'A' * ParseBuffer.compact_threshold + b'\r\nPARTIAL')
+    messages, buffer = mp.process_buffer(buffer)
+
+    assert len(messages) == 1
+    assert buffer.offset == 0
+    assert bytes(buffer) == b'PARTIAL'
+
+    buffer.extend(b'\r\n')
+    messages, buffer = mp.process_buffer(buffer)
+
+    assert messages == [b'PARTIAL']
+    assert len(buffer) == 0
@@ -0,0 +1,68 @@
+# Copyright 2015 jydo inc. All rights reserved.
+from urllib.request import urlopen
+
+from emulator_helpers import connect, read_line
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.loopback import LoopbackTransport
+from imitar.metrics import Histogram
+
+
+def test_histogram_buckets():
+    histogram = Histogram((0.1, 1.0))
+
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    assert histogram.cumulative_counts() == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+
+
+def test_emulator_metrics():
+    tv = FakeTvEmulator(0, metrics_port=0, handle_signals=False)
+    tv.start()
+    client = connect(tv.transport.port, FakeTvEmulator.welcome_message)
+
+    try:
+        client.sendall(b'VOLM ?\r\nVOLM 10\r\nBOGUS\r\n')
+
+        assert read_line(client) == 'VOLM 0'
+        assert read_line(client) == 'VOLM 10'
+        assert read_line(client) == 'ERR'
+
+        snapshot = tv.metrics.snapshot()
+
+        assert snapshot['counters']['connections_accepted'] == 1
+        assert snapshot['counters']['messages_parsed'] == 3
+        assert snapshot['counters']['bytes_in'] == 24
+        assert snapshot['gauges']['clients'] == 1
+        assert snapshot['command_latency']['VOLM']['count'] == 2
+        assert snapshot['command_latency']['unknown']['count'] == 1
+        assert snapshot['broadcast_fanout']['count'] == 1
+
+        body = urlopen('http://127.0.0.1:{}/metrics'.format(tv.metrics_server.port)).read().decode('utf-8')
+
+        assert '# TYPE imitar_command_latency_seconds histogram' in body
+        assert 'imitar_messages_parsed_total{{emulator="FakeTvEmulator",port="{}"}} 3'.format(tv.transport.port) in body
+        assert 'imitar_command_latency_seconds_count{{emulator="FakeTvEmulator",port="{}",command="VOLM"}} 2'.format(
+            tv.transport.port) in body
+    finally:
+        client.close()
+        tv.transport.shutdown()
+        tv.metrics_server.shutdown()
+
+
+def test_messages_are_routed_once_with_metrics(monkeypatch):
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, metrics=True)
+    client = tv.transport.connect()
+    matches = []
+    match = tv.router.match
+    monkeypatch.setattr(tv.router, 'match', lambda message: matches.append(message) or match(message))
+
+    for message in ('VOLM 10', 'VOLM ?', 'VOLM ?', 'BOGUS'):
+        client.send_message(message)
+
+    # The second VOLM ? is answered from the query cache.
+    assert matches == ['VOLM 10', 'VOLM ?', 'BOGUS']
+    assert tv.metrics.command_latency['VOLM'].count == 3
+    assert tv.metrics.command_latency['unknown'].count == 1
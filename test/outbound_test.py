@@ -0,0 +1,75 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import pytest
+
+from imitar.outbound import OutboundQueue, BLOCK, DISCONNECT, DROP_OLDEST
+
+
+def test_drop_oldest():
+    queue = OutboundQueue(10, DROP_OLDEST)
+
+    for data in (b'aaaa', b'bbbb', b'cccc'):
+        assert queue.put(data)
+
+    assert list(queue.messages) == [b'bbbb', b'cccc']
+    assert queue.size == 8
+    assert queue.dropped == 1
+    assert queue.stats['dropped'] == 1
+
+
+def test_drop_oldest_keeps_partially_written_message():
+    queue = OutboundQueue(10, DROP_OLDEST)
+    queue.put(b'aaaa')
+    queue.put(b'bbbb')
+    queue.consume(2)
+    queue.put(b'cccccc')
+
+    assert [bytes(m) for m in queue.messages] == [b'aa', b'cccccc']
+    assert queue.size == 8
+
+
+def test_disconnect():
+    queue = OutboundQueue(10, DISCONNECT)
+
+    assert queue.put(b'aaaaaaaa')
+    assert not queue.put(b'bbbb')
+    assert queue.stats['disconnected'] == 1
+    assert list(queue.messages) == [b'aaaaaaaa']
+
+
+def test_block_queues_past_limit():
+    queue = OutboundQueue(10, BLOCK)
+
+    assert queue.put(b'aaaaaaaa')
+    assert queue.put(b'bbbb')
+    assert queue.full
+    assert queue.dropped == 0
+
+
+def test_consume_partial_writes():
+    queue = OutboundQueue()
+    queue.put(b'abc')
+    queue.put(b'def')
+    queue.consume(4)
+
+    assert bytes(queue.peek()) == b'ef'
+    queue.consume(2)
+    assert not queue
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(10, 'explode')
+
+
+def test_consume_across_messages():
+    queue = OutboundQueue(100)
+    queue.put(b'abc')
+    queue.put(b'def')
+    queue.put(b'ghi')
+
+    assert queue.peek_many(2) == [b'abc', b'def']
+
+    queue.consume(5)
+
+    assert [bytes(data) for data in queue.peek_many(10)] == [b'f', b'ghi']
+    assert queue.size == 4
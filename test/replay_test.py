@@ -0,0 +1,106 @@
+# Copyright 2015 jydo inc. All rights reserved.
+from emulator_helpers import connect, read_line
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.loopback import LoopbackTransport
+from imitar.recording import Recorder, Recording, CONNECTED, CLOSED, RECEIVED, SENT
+from imitar.replay import replay
+
+
+def record_session(path):
+    tv = FakeTvEmulator(0, handle_signals=False, recorder=Recorder(path))
+    tv.start()
+    client = connect(tv.transport.port, FakeTvEmulator.welcome_message)
+
+    try:
+        for command in (b'VOLM 15\r\n', b'MUTE 1\r\nINPT ?\r\n', b'BOGUS\r\n'):
+            client.sendall(command)
+
+        for _ in range(4):
+            read_line(client)
+    finally:
+        client.close()
+        tv.stop()
+
+
+def test_recorder_frames(tmp_path):
+    path = str(tmp_path / 'session.rec')
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, recorder=Recorder(path))
+    client = tv.transport.connect()
+    client.send_message('VOLM ?')
+    client.close()
+    tv.stop()
+
+    with Recording(path) as recording:
+        frames = [(connection, kind, bytes(data)) for _, connection, kind, data in recording.frames()]
+
+    assert frames == [
+        (0, CONNECTED, b''), (0, SENT, b'FakeTvServer v1.0.0\r\n'), (0, RECEIVED, b'VOLM ?\r\n'),
+        (0, SENT, b'VOLM 0\r\n'), (0, CLOSED, b''),
+    ]
+
+
+def test_replay_matches_recording(tmp_path):
+    path = str(tmp_path / 'session.rec')
+    record_session(path)
+    tv = FakeTvEmulator(0, handle_signals=False)
+    tv.start()
+
+    try:
+        report = replay(path, '127.0.0.1', tv.transport.port, speed=0, timeout=0.5)
+    finally:
+        tv.stop()
+
+    assert report.summary()['sessions'] == 1
+    assert report.mismatches == []
+
+
+def test_replay_reports_differences(tmp_path):
+    path = str(tmp_path / 'session.rec')
+    record_session(path)
+    tv = FakeTvEmulator(0, handle_signals=False)
+    tv.available_inputs.discard('HDMI_1')
+    tv.state.update(input='VGA')
+    tv.start()
+
+    try:
+        report = replay(path, '127.0.0.1', tv.transport.port, speed=0, clients=2, timeout=0.5)
+    finally:
+        tv.stop()
+
+    assert len(report.mismatches) == 2
+    assert "-b'INPT HDMI_1\\r\\n'" in report.mismatches[0].diff()
+
+
+def test_recording_leaves_out_dropped_data(tmp_path):
+    path = str(tmp_path / 'session.rec')
+    tv = FakeTvEmulator(0, handle_signals=False, recorder=Recorder(path), transport_options={'outbound_limit': 4096})
+    tv.start()
+    client = connect(tv.transport.port, FakeTvEmulator.welcome_message)
+    received = bytearray()
+
+    try:
+        # The client doesn't read until the socket buffers and the outbound queue are full, so some are dropped.
+        for number in range(2000):
+            tv.transport.broadcast_message('{:05} {}'.format(number, 'x' * 1000))
+
+        client.settimeout(0.5)
+
+        while True:
+            try:
+                data = client.recv(65536)
+            except OSError:
+                break
+
+            if not data:
+                break
+
+            received.extend(data)
+    finally:
+        client.close()
+        tv.stop()
+
+    with Recording(path) as recording:
+        sent = b''.join(bytes(data) for _, _, kind, data in recording.frames() if kind == SENT)
+
+    assert tv.transport.outbound_stats['dropped'] > 0
+    assert sent == b'FakeTvServer v1.0.0\r\n' + received
@@ -0,0 +1,94 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import threading
+
+import pytest
+
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.loopback import LoopbackTransport
+from imitar.scheduler import Scheduler, VirtualClock
+from imitar.tcp_server import ClientDisconnectedError
+
+
+def test_virtual_clock_runs_timers_in_order():
+    clock = VirtualClock()
+    scheduler = Scheduler(clock)
+    calls = []
+    scheduler.call_later(2, calls.append, 'second')
+    scheduler.call_later(1, calls.append, 'first')
+    cancelled = scheduler.call_later(1.5, calls.append, 'cancelled')
+    cancelled.cancel()
+    clock.advance(1)
+
+    assert calls == ['first']
+
+    clock.advance(5)
+
+    assert calls == ['first', 'second']
+
+
+def test_periodic_and_chained_timers():
+    clock = VirtualClock()
+    scheduler = Scheduler(clock)
+    ticks = []
+    chained = []
+    timer = scheduler.call_every(1, lambda: ticks.append(clock.time()))
+    scheduler.call_later(1, lambda: scheduler.call_later(1, chained.append, clock.time()))
+    clock.advance(3.5)
+
+    assert ticks == [1, 2, 3]
+    assert chained == [1]
+
+    timer.cancel()
+    clock.advance(3)
+
+    assert ticks == [1, 2, 3]
+
+
+def test_real_time_scheduler():
+    scheduler = Scheduler()
+    fired = threading.Event()
+    scheduler.call_later(0.01, fired.set)
+
+    try:
+        assert fired.wait(5)
+    finally:
+        scheduler.shutdown()
+
+
+def test_power_off_with_virtual_clock():
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock))
+    first = tv.transport.connect()
+    second = tv.transport.connect()
+    first.send_message('POWR 1')
+    first.send_message('POWR 0')
+    first.read_all()
+    second.read_all()
+    clock.advance(2.9)
+
+    assert first.read_all() == []
+
+    clock.advance(0.1)
+
+    assert first.read_all() == ['POWR 0']
+    assert second.read_all() == ['POWR 0']
+
+    # Messages are discarded while the TV powers off, then every client is disconnected.
+    second.send_message('VOLM ?')
+
+    assert second.read_all() == []
+
+    clock.advance(3)
+
+    with pytest.raises(ClientDisconnectedError):
+        first.send_message('VOLM ?')
+
+
+@pytest.mark.parametrize('interval', [0, -1])
+def test_intervals_must_be_positive(interval):
+    scheduler = Scheduler(VirtualClock())
+
+    with pytest.raises(ValueError):
+        scheduler.call_every(interval, print)
+
+    assert scheduler.next_deadline() is None
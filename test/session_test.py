@@ -0,0 +1,48 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import gc
+import tracemalloc
+
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.loopback import LoopbackTransport
+from imitar.session import Session
+from imitar.tcp_server import ClientWorker
+
+
+def test_session_values():
+    session = Session()
+
+    assert session.get('verbose_mode') is None
+    assert 'verbose_mode' not in session
+
+    session['verbose_mode'] = 3
+
+    assert session['verbose_mode'] == 3
+    assert Session().id != session.id
+
+
+def test_verbose_mode_is_per_connection():
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    first = switcher.transport.connect()
+    second = switcher.transport.connect()
+    first.send_message('W3CV')
+    first.send_message('WCV')
+    second.send_message('WCV')
+
+    assert first.read_all() == ['Vrb3', '3']
+    assert second.read_all() == ['1']
+
+
+def test_idle_connections_are_small():
+    tv = FakeTvEmulator(0, handle_signals=False)
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        workers = [ClientWorker(tv.transport, None, ('127.0.0.1', 4000)) for _ in range(1000)]
+        per_connection = (tracemalloc.get_traced_memory()[0] - before) / len(workers)
+    finally:
+        tracemalloc.stop()
+
+    assert per_connection < 1024
@@ -0,0 +1,69 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import pytest
+
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.loopback import LoopbackTransport
+from imitar.scheduler import Scheduler, VirtualClock
+from imitar.tcp_server import ClientDisconnectedError
+from imitar.testing import emulator_fixture
+
+tv = emulator_fixture(FakeTvEmulator, transport_class=LoopbackTransport)
+
+
+def test_restore_checkpoint():
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock))
+    client = tv.transport.connect()
+    client.read_all()
+    tv.checkpoint('off')
+    client.send_message('POWR 1')
+    client.send_message('VOLM 30')
+    snapshot = tv.snapshot()
+    client.send_message('POWR 0')
+    tv.restore(snapshot)
+
+    # Restoring is quiet by default, and the pending power off belonged to the discarded state.
+    assert client.read_all() == ['POWR 1', 'VOLM 30']
+
+    clock.advance(10)
+
+    assert client.read_all() == []
+    assert tv.state['power'] == '1'
+
+    client.send_message('VOLM ?')
+    tv.restore('off', broadcast=True)
+    client.send_message('VOLM ?')
+
+    assert client.read_all() == ['VOLM 30', 'VOLM 0', 'VOLM 0']
+
+
+def test_restore_keeps_timers_that_are_not_state():
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock))
+    ticks = []
+    tv.call_every(1, ticks.append, 'tick')
+    tv.call_later(1, tv.state.update, {'volume': 50}, state=True)
+    tv.restore(tv.snapshot())
+    clock.advance(2)
+
+    assert ticks == ['tick', 'tick']
+    assert tv.state['volume'] == 0
+
+
+def test_restore_disconnects():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    client = tv.transport.connect()
+    tv.restore(tv.snapshot(), disconnect=True)
+
+    with pytest.raises(ClientDisconnectedError):
+        client.send_message('VOLM ?')
+
+
+@pytest.mark.parametrize('volume', [10, 20])
+def test_fixture_resets_state(tv, volume):
+    client = tv.transport.connect()
+    client.read_all()
+    client.send_message('VOLM ?')
+    client.send_message('VOLM {}'.format(volume))
+
+    assert client.read_all() == ['VOLM 0', 'VOLM {}'.format(volume)]
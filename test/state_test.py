@@ -0,0 +1,212 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import sys
+import threading
+
+from imitar.control import toggle
+from imitar.extron_mps_601_emulator import ExtronMps601Emulator
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.loopback import LoopbackTransport
+from imitar.scheduler import Scheduler, VirtualClock
+from imitar.state import DeviceState
+
+
+def test_updates_only_report_changes():
+    state = DeviceState({'volume': 0, 'mute': '0'})
+    calls = []
+    state.subscribe(lambda changes, version: calls.append((changes, version)), ('volume',))
+
+    assert state.update(volume=10, mute='0') == {'volume': (0, 10)}
+    assert state.update(volume=10) == {}
+    assert state.update(mute='1') == {'mute': ('0', '1')}
+    assert state.snapshot() == (2, {'volume': 10, 'mute': '1'})
+    assert calls == [({'volume': (0, 10)}, 1)]
+
+
+def test_unsubscribe():
+    state = DeviceState()
+    calls = []
+    unsubscribe = state.subscribe(lambda changes, version: calls.append(version))
+    state.update(volume=1)
+    unsubscribe()
+    state.update(volume=2)
+
+    assert calls == [1]
+
+
+def test_concurrent_modifications_are_atomic():
+    state = DeviceState({'count': 0})
+
+    def increment():
+        for _ in range(1000):
+            state.modify('count', lambda count: count + 1)
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert state.snapshot() == (4000, {'count': 4000})
+
+
+def test_state_changes_are_broadcast():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    first = tv.transport.connect()
+    second = tv.transport.connect()
+    first.read_all()
+    second.read_all()
+
+    # A change made outside a handler is broadcast to every client.
+    tv.state.update(volume=30)
+
+    assert first.read_all() == ['VOLM 30']
+    assert second.read_all() == ['VOLM 30']
+
+    # Setting a value to what it already is only answers the client that asked.
+    first.send_message('VOLM 30')
+
+    assert first.read_all() == ['VOLM 30']
+    assert second.read_all() == []
+
+    first.send_message('VOLM 40')
+
+    assert first.read_all() == ['VOLM 40']
+    assert second.read_all() == ['VOLM 40']
+
+
+def test_coalesced_broadcasts():
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock),
+                        coalesce={'volume': 0.1})
+    first = tv.transport.connect()
+    second = tv.transport.connect()
+    first.read_all()
+    second.read_all()
+
+    for volume in range(1, 11):
+        first.send_message('VOLM {}'.format(volume))
+
+    # The client ramping the volume gets every reply right away, everyone gets the final value once.
+    assert first.read_all() == ['VOLM {}'.format(volume) for volume in range(1, 11)]
+    assert second.read_all() == []
+
+    clock.advance(0.1)
+
+    assert first.read_all() == ['VOLM 10']
+    assert second.read_all() == ['VOLM 10']
+
+    # Nothing is broadcast if the value is back where it started by the end of the window.
+    first.send_message('VOLM 11')
+    first.send_message('VOLM 10')
+    clock.advance(0.1)
+
+    assert second.read_all() == []
+
+    # Keys that aren't coalesced are broadcast right away.
+    first.send_message('MUTE 1')
+
+    assert second.read_all() == ['MUTE 1']
+
+
+def test_powering_back_on_cancels_power_off():
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False, scheduler=Scheduler(clock))
+    client = tv.transport.connect()
+    client.read_all()
+    client.send_message('POWR 1')
+    client.send_message('POWR 0')
+    clock.advance(1)
+    client.send_message('POWR 1')
+    clock.advance(10)
+
+    # No POWR 0 broadcast, and no disconnect, from the cancelled power off.
+    assert client.read_all() == ['POWR 1', 'POWR 1']
+    assert not client.closed
+
+
+def test_changes_from_other_threads_do_not_deadlock_handlers():
+    switcher = ExtronMps601Emulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    client = switcher.transport.connect()
+
+    def flap():
+        for _ in range(500):
+            switcher.controller.apply([toggle('connection_state', 2)])
+
+    def switch():
+        # Switching inputs takes the state lock while the transport's lock is held.
+        for number in range(500):
+            client.send_message('{}!'.format(number % 6 + 1))
+
+    threads = [threading.Thread(target=flap, daemon=True), threading.Thread(target=switch, daemon=True)]
+    # Switch threads often so the two interleave inside their locks.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    try:
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join(5)
+            assert not thread.is_alive()
+    finally:
+        sys.setswitchinterval(interval)
+
+
+def test_coalesce_flush_after_restore(caplog):
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, handle_signals=False, scheduler=Scheduler(clock), coalesce={'volume': 0.1})
+    snapshot = tv.snapshot()
+    tv.state.update(volume=5)
+    # The flush timer fires, but the loop isn't running yet, so it waits in the loop's queue while restore runs.
+    clock.advance(0.1)
+    tv.restore(snapshot)
+    flushed = threading.Event()
+    tv.transport.call_in_loop(flushed.set)
+    tv.start()
+
+    try:
+        assert flushed.wait(5)
+    finally:
+        tv.stop()
+
+    assert tv.state['volume'] == 0
+    assert not [record for record in caplog.records if record.exc_info]
+
+
+def test_handler_and_control_changes_race():
+    tv = FakeTvEmulator(0, transport_class=LoopbackTransport, handle_signals=False)
+    first = tv.transport.connect()
+    second = tv.transport.connect()
+    first.read_all()
+    second.read_all()
+
+    def flap():
+        for _ in range(300):
+            tv.controller.apply([toggle('mute')])
+
+    thread = threading.Thread(target=flap, daemon=True)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    try:
+        thread.start()
+
+        # Often handled while the control thread is passing its changes on, the handler's change included.
+        for volume in range(1, 101):
+            first.send_message('VOLM {}'.format(volume))
+
+        thread.join(5)
+        assert not thread.is_alive()
+    finally:
+        sys.setswitchinterval(interval)
+
+    expected = ['VOLM {}'.format(volume) for volume in range(1, 101)]
+
+    for client in (first, second):
+        messages = client.read_all()
+
+        assert [message for message in messages if message.startswith('VOLM')] == expected
+        assert len([message for message in messages if message.startswith('MUTE')]) == 300
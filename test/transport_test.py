@@ -0,0 +1,208 @@
+# Copyright 2015 jydo inc. All rights reserved.
+import threading
+
+import pytest
+
+import emulator_helpers
+from emulator_helpers import read_line
+from imitar.async_tcp_server import AsyncTcpServer
+from imitar.fake_tv_emulator import FakeTvEmulator
+from imitar.scheduler import Scheduler, VirtualClock
+from imitar.tcp_server import TcpServer
+
+transports = pytest.mark.parametrize('transport_class', [TcpServer, AsyncTcpServer])
+
+
+def connect(port):
+    return emulator_helpers.connect(port, FakeTvEmulator.welcome_message)
+
+
+@transports
+def test_serves_more_clients_than_worker_pool(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False)
+    tv.start()
+    clients = [connect(tv.transport.port) for _ in range(20)]
+
+    try:
+        for client in clients:
+            client.sendall(b'VOLM ?\r\n')
+
+        for client in clients:
+            assert read_line(client) == 'VOLM 0'
+    finally:
+        for client in clients:
+            client.close()
+
+        tv.transport.shutdown()
+
+
+@transports
+def test_broadcasts_to_other_clients(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False)
+    tv.start()
+    clients = [connect(tv.transport.port) for _ in range(3)]
+
+    try:
+        clients[0].sendall(b'VOLM 20\r\n')
+
+        for client in clients:
+            assert read_line(client) == 'VOLM 20'
+
+        tv.transport.broadcast_message('INPT VGA')
+
+        for client in clients:
+            assert read_line(client) == 'INPT VGA'
+    finally:
+        for client in clients:
+            client.close()
+
+        tv.transport.shutdown()
+
+
+@transports
+def test_shutdown_is_not_delayed_by_polling(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False)
+    tv.start()
+    client = connect(tv.transport.port)
+    stopped = threading.Event()
+
+    def shutdown():
+        tv.transport.shutdown()
+        stopped.set()
+
+    # The loop waits for events without a timeout, shutdown has to wake it up rather than wait for a poll.
+    threading.Thread(target=shutdown, daemon=True).start()
+
+    assert stopped.wait(5)
+    assert client.recv(1) == b''
+    client.close()
+
+
+class BatchTvEmulator(FakeTvEmulator):
+    def __init__(self, port, **kwargs):
+        super().__init__(port, **kwargs)
+        self.batches = []
+
+    def handle_messages(self, messages):
+        self.batches.append(len(messages))
+
+        return super().handle_messages(messages)
+
+
+@transports
+def test_pipelined_batch(transport_class):
+    tv = BatchTvEmulator(0, transport_class=transport_class, handle_signals=False)
+    tv.start()
+    client = connect(tv.transport.port)
+
+    try:
+        client.sendall(b''.join('VOLM {}\r\n'.format(i).encode('ascii') for i in range(50)))
+
+        assert [read_line(client) for _ in range(50)] == ['VOLM {}'.format(i) for i in range(50)]
+        assert sum(tv.batches) == 50
+        assert max(tv.batches) > 1
+    finally:
+        client.close()
+        tv.transport.shutdown()
+
+
+def closed_by_server(client):
+    try:
+        return client.recv(1024) == b''
+    except ConnectionResetError:
+        return True
+
+
+@transports
+def test_rejects_clients_past_max_connections(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False,
+                        transport_options={'max_connections': 2, 'backlog': 16})
+    tv.start()
+    clients = [connect(tv.transport.port) for _ in range(2)]
+    rejected = emulator_helpers.connect(tv.transport.port)
+
+    try:
+        assert closed_by_server(rejected)
+        assert tv.transport.stats['connections_rejected'] == 1
+        clients[0].sendall(b'VOLM ?\r\n')
+        assert read_line(clients[0]) == 'VOLM 0'
+    finally:
+        for client in clients + [rejected]:
+            client.close()
+
+        tv.transport.shutdown()
+
+
+@transports
+def test_reaps_idle_clients(transport_class):
+    clock = VirtualClock()
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False, scheduler=Scheduler(clock),
+                        transport_options={'idle_timeout': 0.2})
+    tv.start()
+    idle = connect(tv.transport.port)
+    active = connect(tv.transport.port)
+
+    try:
+        for _ in range(4):
+            clock.advance(0.1)
+            active.sendall(b'VOLM ?\r\n')
+            assert read_line(active) == 'VOLM 0'
+
+        assert closed_by_server(idle)
+        assert tv.transport.stats['connections_reaped_idle'] == 1
+    finally:
+        idle.close()
+        active.close()
+        tv.transport.shutdown()
+
+
+@transports
+def test_failing_timer_does_not_stop_the_server(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False)
+    tv.start()
+    ran = threading.Event()
+    tv.call_later(0, lambda: 1 / 0)
+    tv.call_later(0, ran.set)
+
+    assert ran.wait(2)
+
+    client = connect(tv.transport.port)
+
+    try:
+        client.sendall(b'VOLM ?\r\n')
+        assert read_line(client) == 'VOLM 0'
+    finally:
+        client.close()
+        tv.transport.shutdown()
+
+
+@transports
+def test_broadcasts_from_other_threads_are_bounded(transport_class):
+    tv = FakeTvEmulator(0, transport_class=transport_class, handle_signals=False,
+                        transport_options={'broadcast_limit': 2})
+    tv.start()
+    client = connect(tv.transport.port)
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def block():
+        blocked.set()
+        release.wait(2)
+
+    try:
+        # Hold the loop up so the broadcasts have to wait for it.
+        tv.transport.call_in_loop(block)
+        assert blocked.wait(2)
+
+        for volume in range(5):
+            tv.transport.broadcast_message('VOLM {}'.format(volume))
+
+        release.set()
+
+        assert read_line(client) == 'VOLM 3'
+        assert read_line(client) == 'VOLM 4'
+        assert tv.transport.stats['broadcasts_dropped'] == 3
+    finally:
+        release.set()
+        client.close()
+        tv.transport.shutdown()